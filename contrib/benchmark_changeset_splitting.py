@@ -0,0 +1,210 @@
+#! /usr/bin/python
+
+# (Be in -*- python -*- mode.)
+#
+# ====================================================================
+# Copyright (c) 2008 CollabNet.  All rights reserved.
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution.
+#
+# This software consists of voluntary contributions made by many
+# individuals.  For exact contribution history, see the revision
+# history and logs.
+# ====================================================================
+
+"""Benchmark the splitting of changesets with internal dependencies.
+
+usage: benchmark_changeset_splitting.py [SCALE]
+
+Time InitializeChangesetsPass.break_all_internal_dependencies() on
+synthetic changesets of the kinds that occur when big imports or
+scripted commits reuse the same author and log message, and compare
+it with the original algorithm, which split a changeset at one
+position at a time.  Report the time taken by each algorithm and the
+number of changesets that it produced.  SCALE (default 1) multiplies
+the sizes of the test cases.  The original algorithm is skipped for
+cases where it would take too long."""
+
+
+import sys
+import os
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from cvs2svn_lib.passes import InitializeChangesetsPass
+
+
+class CVSFile:
+  def __init__(self, cvs_path):
+    self.cvs_path = cvs_path
+
+
+class CVSRevision:
+  """Just enough of a CVSRevision for splitting changesets."""
+
+  def __init__(self, id, cvs_file, rev, timestamp):
+    self.id = id
+    self.cvs_file = cvs_file
+    self.rev = rev
+    self.timestamp = timestamp
+    self.succ_ids = []
+
+  def get_succ_ids(self):
+    return self.succ_ids
+
+
+def make_changeset(files, revs_per_file, timestamp):
+  """Return the CVSRevisions of a changeset.
+
+  The changeset consists of REVS_PER_FILE consecutive revisions on
+  trunk in each of FILES files, each revision depending on its
+  predecessor in the same file.  TIMESTAMP(file_index, rev_index)
+  returns the timestamp of a revision."""
+
+  items = []
+  for i in range(files):
+    cvs_file = CVSFile('dir%d/file%d,v' % (i % 100, i,))
+    pred = None
+    for j in range(revs_per_file):
+      cvs_rev = CVSRevision(
+          len(items), cvs_file, '1.%d' % (j + 1,), timestamp(i, j)
+          )
+      if pred is not None:
+        pred.succ_ids.append(cvs_rev.id)
+      items.append(cvs_rev)
+      pred = cvs_rev
+  return items
+
+
+def get_cases(scale):
+  """Return a list of (description, changeset_items, run_old)."""
+
+  return [
+      (
+          'import with one revision per file (no splits)',
+          make_changeset(20000 * scale, 1, lambda i, j: 1000 + i),
+          True,
+          ),
+      (
+          'import followed by a second scripted commit',
+          make_changeset(20000 * scale, 2, lambda i, j: 1000 + i + j),
+          True,
+          ),
+      (
+          'scripted commits in lockstep (equal gaps)',
+          make_changeset(
+              500 * scale, 20, lambda i, j: 1000 + 500 * scale * j + i
+              ),
+          True,
+          ),
+      (
+          'one file with a long chain of equal timestamps',
+          make_changeset(1, 2000 * scale, lambda i, j: 1000),
+          True,
+          ),
+      (
+          'many files with long chains of equal timestamps',
+          make_changeset(1000 * scale, 20, lambda i, j: 1000),
+          False,
+          ),
+      ]
+
+
+def old_break_internal_dependencies(changeset_items):
+  """The original algorithm, which splits CHANGESET_ITEMS at most once."""
+
+  dependencies = []
+  changeset_cvs_item_ids = set([cvs_rev.id for cvs_rev in changeset_items])
+  for cvs_item in changeset_items:
+    for next_id in cvs_item.get_succ_ids():
+      if next_id in changeset_cvs_item_ids:
+        dependencies.append((cvs_item.id, next_id,))
+
+  if not dependencies:
+    return [changeset_items]
+
+  changeset_items.sort(InitializeChangesetsPass.compare_items)
+  indexes = {}
+  for (i, changeset_item) in enumerate(changeset_items):
+    indexes[changeset_item.id] = i
+
+  breaks = [0] * len(changeset_items)
+  for (pred, succ,) in dependencies:
+    pred_index = indexes[pred]
+    succ_index = indexes[succ]
+    breaks[min(pred_index, succ_index)] += 1
+    breaks[max(pred_index, succ_index)] -= 1
+  for i in range(1, len(breaks)):
+    breaks[i] += breaks[i - 1]
+
+  best_i = None
+  best_count = -1
+  best_gap = 0
+  for i in range(0, len(breaks) - 1):
+    gap = changeset_items[i + 1].timestamp - changeset_items[i].timestamp
+    if breaks[i] > best_count or breaks[i] == best_count and gap > best_gap:
+      best_i = i
+      best_count = breaks[i]
+      best_gap = gap
+
+  return [changeset_items[:best_i + 1], changeset_items[best_i + 1:]]
+
+
+def old_break_all_internal_dependencies(changeset_items):
+  changesets_to_split = [changeset_items]
+  while changesets_to_split:
+    changesets = old_break_internal_dependencies(changesets_to_split.pop())
+    if len(changesets) == 1:
+      [changeset_items] = changesets
+      yield changeset_items
+    else:
+      changesets.reverse()
+      changesets_to_split.extend(changesets)
+
+
+def check_changesets(changesets, count):
+  """Verify that CHANGESETS contain COUNT items without dependencies."""
+
+  assert sum([len(changeset) for changeset in changesets]) == count
+  for changeset in changesets:
+    ids = set([cvs_rev.id for cvs_rev in changeset])
+    for cvs_rev in changeset:
+      for succ_id in cvs_rev.get_succ_ids():
+        assert succ_id not in ids
+
+
+def measure(f, changeset_items):
+  start = time.time()
+  changesets = list(f(list(changeset_items)))
+  elapsed = time.time() - start
+  check_changesets(changesets, len(changeset_items))
+  return (elapsed, len(changesets))
+
+
+def main(args):
+  if args:
+    [scale] = args
+    scale = int(scale)
+  else:
+    scale = 1
+
+  splitter = InitializeChangesetsPass()
+  for (description, changeset_items, run_old) in get_cases(scale):
+    print '%s (%d items):' % (description, len(changeset_items),)
+    (elapsed, count) = measure(
+        splitter.break_all_internal_dependencies, changeset_items
+        )
+    print '    new: %8.3f s, %6d changesets' % (elapsed, count,)
+    if run_old:
+      (elapsed, count) = measure(
+          old_break_all_internal_dependencies, changeset_items
+          )
+      print '    old: %8.3f s, %6d changesets' % (elapsed, count,)
+    else:
+      print '    old: skipped'
+
+
+if __name__ == '__main__':
+  main(sys.argv[1:])
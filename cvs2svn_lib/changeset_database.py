@@ -14,6 +14,7 @@
 """This module contains classes to store changesets."""
 
 
+from cvs2svn_lib import config
 from cvs2svn_lib.changeset import Changeset
 from cvs2svn_lib.changeset import RevisionChangeset
 from cvs2svn_lib.changeset import OrderedChangeset
@@ -23,20 +24,33 @@ from cvs2svn_lib.changeset import TagChangeset
 from cvs2svn_lib.record_table import UnsignedIntegerPacker
 from cvs2svn_lib.record_table import MmapRecordTable
 from cvs2svn_lib.record_table import RecordTable
+from cvs2svn_lib.record_table import OverlayRecordTable
+from cvs2svn_lib.record_table import IndexTable
 from cvs2svn_lib.indexed_database import IndexedStore
 from cvs2svn_lib.serializer import PrimedPickleSerializer
 
 
 # Should the CVSItemToChangesetTable database files be memory mapped?
 # This speeds up the converstion but can cause the computer's virtual
-# address space to be exhausted.  This option can be changed
-# externally, affecting any CVSItemToChangesetTables opened subsequent
-# to the change:
-use_mmap_for_cvs_item_to_changeset_table = False
+# address space to be exhausted.  If None, the setting of
+# record_table.use_mmap_for_index_tables is used.  This option can be
+# changed externally, affecting any CVSItemToChangesetTables opened
+# subsequent to the change:
+use_mmap_for_cvs_item_to_changeset_table = None
 
 
-def CVSItemToChangesetTable(filename, mode):
-  if use_mmap_for_cvs_item_to_changeset_table:
+def CVSItemToChangesetTable(filename, mode, base=None):
+  """Open the CVSItemToChangesetTable at FILENAME in MODE.
+
+  If BASE is specified, it is a CVSItemToChangesetTable opened for
+  reading, and FILENAME only holds the parts of the table that differ
+  from it (see OverlayRecordTable)."""
+
+  if base is not None:
+    return OverlayRecordTable(filename, mode, base)
+  elif use_mmap_for_cvs_item_to_changeset_table is None:
+    return IndexTable(filename, mode, UnsignedIntegerPacker())
+  elif use_mmap_for_cvs_item_to_changeset_table:
     return MmapRecordTable(filename, mode, UnsignedIntegerPacker())
   else:
     return RecordTable(filename, mode, UnsignedIntegerPacker())
@@ -53,7 +67,11 @@ class ChangesetDatabase(IndexedStore):
         TagChangeset,
         )
     IndexedStore.__init__(
-        self, filename, index_filename, mode, PrimedPickleSerializer(primer))
+        self, filename, index_filename, mode, PrimedPickleSerializer(primer),
+        buffered=True,
+        compact_min_dead_bytes=config.CHANGESETS_COMPACT_MIN_DEAD_BYTES,
+        compact_dead_fraction=config.CHANGESETS_COMPACT_DEAD_FRACTION,
+        )
 
   def store(self, changeset):
     self.add(changeset)
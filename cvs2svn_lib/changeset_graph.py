@@ -15,10 +15,17 @@
 
 
 import heapq
+import array
+import collections
 
+from cvs2svn_lib.context import Ctx
 from cvs2svn_lib.log import logger
+from cvs2svn_lib.key_generator import KeyGenerator
+from cvs2svn_lib.time_range import TimeRange
+from cvs2svn_lib.changeset_graph_node import ChangesetGraphNode
 from cvs2svn_lib.changeset import RevisionChangeset
 from cvs2svn_lib.changeset import OrderedChangeset
+from cvs2svn_lib.changeset import SymbolChangeset
 from cvs2svn_lib.changeset import BranchChangeset
 from cvs2svn_lib.changeset import TagChangeset
 
@@ -79,6 +86,10 @@ class _NoPredNodes(object):
 class ChangesetGraph(object):
   """A graph of changesets and their dependencies."""
 
+  # While a cycle is being broken by consume_graph_by_scc(), the list
+  # of the ids of the changesets added via add_new_changeset():
+  _added_ids = None
+
   def __init__(self, changeset_db, cvs_item_to_changeset_id):
     self._changeset_db = changeset_db
     self._cvs_item_to_changeset_id = cvs_item_to_changeset_id
@@ -133,6 +144,8 @@ class ChangesetGraph(object):
 
     self.add_changeset(changeset)
     self.store_changeset(changeset)
+    if self._added_ids is not None:
+      self._added_ids.append(changeset.id)
 
   def delete_changeset(self, changeset):
     """Remove CHANGESET from the graph and also from the databases.
@@ -189,6 +202,11 @@ class ChangesetGraph(object):
   def __iter__(self):
     return self.nodes.itervalues()
 
+  def _iter_pred_ids(self, id):
+    """Generate the ids of the predecessors of ID, in increasing order."""
+
+    return iter(sorted(self.nodes[id].pred_ids))
+
   def _get_path(self, reachable_changesets, starting_node_id, ending_node_id):
     """Return the shortest path from ENDING_NODE_ID to STARTING_NODE_ID.
 
@@ -367,6 +385,159 @@ class ChangesetGraph(object):
       else:
         raise CycleInGraphException(cycle)
 
+  def _find_sccs(self, ids):
+    """Return the strongly connected components of the subgraph IDS.
+
+    IDS is a set of ids of nodes in the graph; only the dependencies
+    among them are considered.  Return a list of the components that
+    contain more than one node (i.e., that contain cycles), each as a
+    sorted list of ids, sorted by their lowest id.
+
+    This is Tarjan's algorithm, written non-recursively to avoid any
+    possible problems with recursion depth."""
+
+    # Maps {id : number} of the order in which the nodes were visited
+    # and of the lowest number of a node reachable from each node that
+    # is still on the stack:
+    index = {}
+    lowlink = {}
+    stack = []
+    on_stack = set()
+    sccs = []
+
+    for root_id in sorted(ids):
+      if root_id in index:
+        continue
+
+      index[root_id] = lowlink[root_id] = len(index)
+      stack.append(root_id)
+      on_stack.add(root_id)
+      # A list of (id, pred_id_iterator) for the nodes whose
+      # predecessors are being visited:
+      work = [(root_id, self._iter_pred_ids(root_id))]
+      while work:
+        (id, pred_ids) = work[-1]
+        for pred_id in pred_ids:
+          if pred_id not in ids:
+            pass
+          elif pred_id not in index:
+            index[pred_id] = lowlink[pred_id] = len(index)
+            stack.append(pred_id)
+            on_stack.add(pred_id)
+            work.append((pred_id, self._iter_pred_ids(pred_id)))
+            break
+          elif pred_id in on_stack:
+            lowlink[id] = min(lowlink[id], index[pred_id])
+        else:
+          # All predecessors of ID have been visited:
+          work.pop()
+          if work:
+            parent_id = work[-1][0]
+            lowlink[parent_id] = min(lowlink[parent_id], lowlink[id])
+          if lowlink[id] == index[id]:
+            scc = []
+            while True:
+              member_id = stack.pop()
+              on_stack.remove(member_id)
+              scc.append(member_id)
+              if member_id == id:
+                break
+            if len(scc) > 1:
+              scc.sort()
+              sccs.append(scc)
+
+    sccs.sort()
+    return sccs
+
+  def _find_cycle_in_scc(self, scc_ids, starting_node_id):
+    """Find a cycle within the strongly connected component SCC_IDS.
+
+    SCC_IDS is a set of node ids that form a strongly connected
+    component of more than one node.  Start at STARTING_NODE_ID and
+    follow the lowest-numbered predecessor within SCC_IDS until a node
+    is seen a second time.  Return the cycle as for find_cycle()."""
+
+    id = starting_node_id
+
+    # A map {id : index} of the nodes seen so far, and a list of them:
+    seen_indexes = {id : 0}
+    seen_ids = [id]
+
+    while True:
+      for pred_id in self._iter_pred_ids(id):
+        if pred_id in scc_ids:
+          break
+      else:
+        raise NoPredNodeInGraphException('%x' % (id,))
+      id = pred_id
+      i = seen_indexes.get(id)
+      if i is None:
+        seen_indexes[id] = len(seen_ids)
+        seen_ids.append(id)
+      else:
+        seen_ids = seen_ids[i:]
+        seen_ids.reverse()
+        return [self._changeset_db[id] for id in seen_ids]
+
+  def _break_scc(self, scc, cycle_breaker):
+    """Break all cycles within SCC, a list of ids as from _find_sccs().
+
+    Break one cycle at a time using CYCLE_BREAKER.  Then find the
+    strongly connected components among the nodes that remain of SCC
+    plus the nodes that CYCLE_BREAKER added, and continue with those
+    that still contain cycles.  Cycles cannot involve other nodes,
+    because splitting a changeset cannot create a dependency path that
+    did not exist before."""
+
+    # A stack of the components that still have to be handled; the
+    # one with the lowest id is handled first:
+    sccs = [scc]
+    while sccs:
+      scc = sccs.pop()
+      cycle = self._find_cycle_in_scc(set(scc), scc[0])
+
+      self._added_ids = []
+      try:
+        cycle_breaker(cycle)
+        added_ids = self._added_ids
+      finally:
+        self._added_ids = None
+
+      ids = set([id for id in scc if id in self])
+      ids.update([id for id in added_ids if id in self])
+      new_sccs = self._find_sccs(ids)
+      new_sccs.reverse()
+      sccs.extend(new_sccs)
+
+  def consume_graph_by_scc(self, cycle_breaker, scc_breaker_pool=None):
+    """Remove and yield changesets from this graph in dependency order.
+
+    Yield (changeset, time_range) tuples like consume_graph(), and
+    break cycles using CYCLE_BREAKER, but find the cycles in batches:
+    whenever no more nodes without predecessors are left, determine
+    all of the strongly connected components of the remaining graph
+    at once, and break the cycles in each component separately.  The
+    components are handled in order by their lowest changeset id, so
+    the result is deterministic.
+
+    If SCC_BREAKER_POOL, an SCCBreakerPool, is specified, then the
+    cycles in the larger components are broken in its worker
+    processes."""
+
+    while True:
+      for (changeset, time_range) in self.consume_nopred_nodes():
+        yield (changeset, time_range)
+
+      if not self:
+        return
+
+      sccs = self._find_sccs(set(self.keys()))
+      if scc_breaker_pool is None:
+        for scc in sccs:
+          self._break_scc(scc, cycle_breaker)
+      else:
+        scc_breaker_pool.break_sccs(self, sccs, cycle_breaker)
+
   def __repr__(self):
     """For convenience only.  The format is subject to change at any time."""
 
@@ -439,3 +610,551 @@ class ChangesetGraph(object):
     f.write('}\n')
 
 
+
+
+class _ChangesetDict(dict):
+  """An in-memory stand-in for a ChangesetDatabase."""
+
+  def store(self, changeset):
+    self[changeset.id] = changeset
+
+  def close(self):
+    pass
+
+
+def _break_scc_in_worker(break_cycle, changesets, first_id):
+  """Break all cycles among CHANGESETS, which form one component.
+
+  This function is run in a worker process of an SCCBreakerPool.
+  Build a graph of CHANGESETS alone, then break its cycles using
+  BREAK_CYCLE(changeset_graph, changeset_key_generator, cycle), giving
+  the new changesets provisional ids starting at FIRST_ID.
+
+  Return a tuple (deleted_ids, new_changesets, id_count), where
+  DELETED_IDS is a list of the ids of the changesets from CHANGESETS
+  that were split, NEW_CHANGESETS is a list of the resulting
+  changesets in the order that they were created, and ID_COUNT is the
+  number of provisional ids that were used, including those of any
+  new changesets that were split again."""
+
+  changeset_db = _ChangesetDict()
+  changeset_graph = ChangesetGraph(changeset_db, {})
+  for changeset in changesets:
+    changeset_graph.store_changeset(changeset)
+  for changeset in changesets:
+    changeset_graph.add_changeset(changeset)
+
+  changeset_key_generator = KeyGenerator(first_id)
+
+  def cycle_breaker(cycle):
+    break_cycle(changeset_graph, changeset_key_generator, cycle)
+
+  changeset_graph._break_scc(
+      [changeset.id for changeset in changesets], cycle_breaker
+      )
+
+  deleted_ids = [
+      changeset.id
+      for changeset in changesets
+      if changeset.id not in changeset_db
+      ]
+  new_changesets = [
+      changeset_db[id]
+      for id in sorted(changeset_db.keys())
+      if id >= first_id
+      ]
+  return (
+      deleted_ids, new_changesets, changeset_key_generator.gen_id() - first_id,
+      )
+
+
+class SCCBreakerPool(object):
+  """Break the cycles in large strongly connected components in parallel.
+
+  The components that have at least MIN_SIZE nodes are sent to the
+  worker processes of POOL, a multiprocessing.Pool, where their cycles
+  are broken by BREAK_CYCLE(changeset_graph, changeset_key_generator,
+  cycle); BREAK_CYCLE has to be a module-level function.  The smaller
+  components are handled in the main process.
+
+  The components do not depend on each other while their cycles are
+  broken, except for the allocation of ids for the new changesets.
+  So each worker numbers its new changesets provisionally, and when
+  its results are merged into the graph (in the order of the
+  components), they are renumbered using CHANGESET_KEY_GENERATOR in
+  the order that they were created.  This gives exactly the same ids
+  as breaking the cycles of the components one after the other in the
+  main process, so the results do not depend on the number of worker
+  processes."""
+
+  def __init__(self, pool, break_cycle, changeset_key_generator, min_size):
+    self._pool = pool
+    self._break_cycle = break_cycle
+    self._changeset_key_generator = changeset_key_generator
+    self._min_size = min_size
+
+  def break_sccs(self, changeset_graph, sccs, cycle_breaker):
+    """Break the cycles in SCCS, the components of CHANGESET_GRAPH.
+
+    SCCS is a list of components as returned by _find_sccs().  Break
+    the cycles in the smaller components using CYCLE_BREAKER."""
+
+    # A list of the AsyncResults for the components that are handled
+    # by the workers, or None for those that are handled here:
+    results = []
+    for scc in sccs:
+      if len(scc) < self._min_size:
+        results.append(None)
+      else:
+        changesets = [changeset_graph._changeset_db[id] for id in scc]
+        results.append(self._pool.apply_async(
+            _break_scc_in_worker,
+            # The provisional ids only have to differ from those in
+            # the component:
+            (self._break_cycle, changesets, scc[-1] + 1,),
+            ))
+
+    for (scc, result) in zip(sccs, results):
+      if result is None:
+        changeset_graph._break_scc(scc, cycle_breaker)
+      else:
+        self._merge(changeset_graph, scc[-1] + 1, result.get())
+
+  def _merge(self, changeset_graph, first_id, result):
+    """Apply RESULT, as returned by _break_scc_in_worker(), to the graph.
+
+    FIRST_ID is the first provisional id that the worker used."""
+
+    (deleted_ids, new_changesets, id_count) = result
+
+    ids = [self._changeset_key_generator.gen_id() for i in range(id_count)]
+
+    if logger.is_on(logger.DEBUG):
+      logger.debug(
+          'Merging %d changesets that were split in a worker process'
+          % (len(deleted_ids),)
+          )
+
+    for id in deleted_ids:
+      changeset_graph.delete_changeset(changeset_graph._changeset_db[id])
+
+    for changeset in new_changesets:
+      changeset.id = ids[changeset.id - first_id]
+      changeset_graph.add_new_changeset(changeset)
+
+
+class CompactChangesetGraph(ChangesetGraph):
+  """A ChangesetGraph that stores the graph in compact arrays.
+
+  ChangesetGraph keeps a ChangesetGraphNode with two sets of ids for
+  every changeset, which takes a lot of memory for big conversions.
+  This class instead keeps parallel arrays indexed by changeset id
+  (changeset ids are small integers that are allocated densely):
+  whether the node is (still) in the graph, its time range, and how
+  many of its predecessors are still in the graph.  Nodes that are
+  removed from the graph are only marked as dead.
+
+  The dependencies are collected into two flat arrays while the graph
+  is being built.  The first time that the graph is examined or
+  changed, they are converted into CSR form (for each node, the
+  predecessors or successors are a slice of a single array, whose
+  bounds are stored in an array of offsets).  The dependencies of
+  changesets that are added after that (when changesets are split to
+  break cycles) are kept in dicts of lists.
+
+  ChangesetGraphNodes are only created on demand by __getitem__()
+  and __iter__().  The changesets that are ready to be processed are
+  ordered exactly as by ChangesetGraph, but where ChangesetGraph
+  chooses an arbitrary node or predecessor (to start a search for a
+  cycle or to follow a cycle), this class chooses the one with the
+  lowest id.  Therefore the cycles that are found, and thus the
+  results of cycle breaking, can differ from those of ChangesetGraph,
+  but they do not depend on the order of the items in Python sets."""
+
+  def __init__(self, changeset_db, cvs_item_to_changeset_id):
+    self._changeset_db = changeset_db
+    self._cvs_item_to_changeset_id = cvs_item_to_changeset_id
+
+    # The following arrays are indexed by changeset id.  1 iff the
+    # node is in the graph:
+    self._alive = bytearray()
+    # The time ranges of the nodes:
+    self._t_min = array.array('l')
+    self._t_max = array.array('l')
+    # The _sort_order of the nodes' changesets:
+    self._sort_order = bytearray()
+    # The number of predecessors of each node that are still in the
+    # graph (only valid once the graph has been frozen):
+    self._pred_counts = array.array('I')
+
+    # A map {changeset_id : symbol} for SymbolChangesets, which sort
+    # by symbol:
+    self._symbols = {}
+
+    # The number of nodes in the graph:
+    self._count = 0
+
+    # The lowest id that might still be in the graph:
+    self._first_id = 0
+
+    # The dependencies (pred, succ) recorded before the graph was
+    # frozen:
+    self._edge_preds = array.array('I')
+    self._edge_succs = array.array('I')
+
+    # After the graph has been frozen: the predecessors of node ID are
+    # self._pred_ids[self._pred_offsets[id]:self._pred_offsets[id + 1]],
+    # and similarly for the successors:
+    self._frozen = False
+    self._pred_offsets = None
+    self._pred_ids = None
+    self._succ_offsets = None
+    self._succ_ids = None
+
+    # Maps {id : [id,...]} of dependencies that were added after the
+    # graph was frozen:
+    self._extra_preds = {}
+    self._extra_succs = {}
+
+  def _grow(self, id):
+    """Make sure that the per-node arrays have an entry for ID."""
+
+    n = id + 1 - len(self._alive)
+    if n > 0:
+      # Grow by at least 1/8 to avoid copying the arrays too often:
+      n = max(n, len(self._alive) // 8)
+      self._alive.extend(bytearray(n))
+      self._t_min.extend(array.array('l', [0]) * n)
+      self._t_max.extend(array.array('l', [0]) * n)
+      self._sort_order.extend(bytearray(n))
+      self._pred_counts.extend(array.array('I', [0]) * n)
+
+  def _is_alive(self, id):
+    return id < len(self._alive) and self._alive[id]
+
+  def _build_csr(self, keys, values):
+    """Return (offsets, ids) for the dependencies KEYS[i] -> VALUES[i].
+
+    The ids of the nodes related to node ID are
+    ids[offsets[id]:offsets[id + 1]], in increasing order."""
+
+    n = len(self._alive)
+    offsets = array.array('L', [0]) * (n + 1)
+    for key in keys:
+      offsets[key + 1] += 1
+    for i in xrange(n):
+      offsets[i + 1] += offsets[i]
+
+    ids = array.array('I', [0]) * len(keys)
+    positions = array.array('L', offsets)
+    for i in xrange(len(keys)):
+      key = keys[i]
+      ids[positions[key]] = values[i]
+      positions[key] += 1
+
+    for id in xrange(n):
+      start = offsets[id]
+      end = offsets[id + 1]
+      if end - start > 1:
+        ids[start:end] = array.array('I', sorted(ids[start:end]))
+
+    return (offsets, ids)
+
+  def _freeze(self):
+    """Convert the dependencies that have been recorded to CSR form."""
+
+    if self._frozen:
+      return
+
+    (self._pred_offsets, self._pred_ids) = self._build_csr(
+        self._edge_succs, self._edge_preds
+        )
+    (self._succ_offsets, self._succ_ids) = self._build_csr(
+        self._edge_preds, self._edge_succs
+        )
+    self._edge_preds = None
+    self._edge_succs = None
+
+    pred_offsets = self._pred_offsets
+    for id in xrange(len(self._alive)):
+      self._pred_counts[id] = pred_offsets[id + 1] - pred_offsets[id]
+
+    self._frozen = True
+
+  def _iter_related(self, id, offsets, ids, extra):
+    if id + 1 < len(offsets):
+      alive = self._alive
+      for i in xrange(offsets[id], offsets[id + 1]):
+        related_id = ids[i]
+        if alive[related_id]:
+          yield related_id
+    for related_id in extra.get(id, ()):
+      if self._alive[related_id]:
+        yield related_id
+
+  def _iter_pred_ids(self, id):
+    """Generate the ids of the predecessors of ID that are in the graph."""
+
+    self._freeze()
+    return self._iter_related(
+        id, self._pred_offsets, self._pred_ids, self._extra_preds
+        )
+
+  def _iter_succ_ids(self, id):
+    """Generate the ids of the successors of ID that are in the graph."""
+
+    self._freeze()
+    return self._iter_related(
+        id, self._succ_offsets, self._succ_ids, self._extra_succs
+        )
+
+  def add_changeset(self, changeset):
+    """Add CHANGESET to this graph.
+
+    Determine and record any dependencies to changesets that are
+    already in the graph.  This method does not affect the databases."""
+
+    node = changeset.create_graph_node(self._cvs_item_to_changeset_id)
+    id = node.id
+    self._grow(id)
+
+    pred_ids = [
+        pred_id
+        for pred_id in node.pred_ids
+        if pred_id != id and self._is_alive(pred_id)
+        ]
+    pred_ids.sort()
+    succ_ids = [
+        succ_id
+        for succ_id in node.succ_ids
+        if succ_id != id and self._is_alive(succ_id)
+        ]
+    succ_ids.sort()
+
+    if not self._frozen:
+      for pred_id in pred_ids:
+        self._edge_preds.append(pred_id)
+        self._edge_succs.append(id)
+      for succ_id in succ_ids:
+        self._edge_preds.append(id)
+        self._edge_succs.append(succ_id)
+    else:
+      if pred_ids:
+        self._extra_preds[id] = pred_ids
+      for pred_id in pred_ids:
+        self._extra_succs.setdefault(pred_id, []).append(id)
+      if succ_ids:
+        self._extra_succs[id] = succ_ids
+      for succ_id in succ_ids:
+        self._extra_preds.setdefault(succ_id, []).append(id)
+        self._pred_counts[succ_id] += 1
+      self._pred_counts[id] = len(pred_ids)
+
+    self._alive[id] = 1
+    self._t_min[id] = node.time_range.t_min
+    self._t_max[id] = node.time_range.t_max
+    self._sort_order[id] = changeset._sort_order
+    if isinstance(changeset, SymbolChangeset):
+      self._symbols[id] = changeset.symbol
+    self._count += 1
+
+  def __nonzero__(self):
+    """Instances are considered True iff they contain any nodes."""
+
+    return self._count > 0
+
+  def __contains__(self, id):
+    """Return True if the specified ID is contained in this graph."""
+
+    return self._is_alive(id)
+
+  def _get_time_range(self, id):
+    time_range = TimeRange()
+    time_range.t_min = self._t_min[id]
+    time_range.t_max = self._t_max[id]
+    return time_range
+
+  def __getitem__(self, id):
+    """Return a ChangesetGraphNode for ID, created on the fly."""
+
+    if not self._is_alive(id):
+      raise KeyError(id)
+
+    return ChangesetGraphNode(
+        self._changeset_db[id], self._get_time_range(id),
+        set(self._iter_pred_ids(id)), set(self._iter_succ_ids(id)),
+        )
+
+  def get(self, id):
+    if self._is_alive(id):
+      return self[id]
+    else:
+      return None
+
+  def __delitem__(self, id):
+    """Remove the node corresponding to ID.
+
+    The node is only marked as dead, so references to it from other
+    nodes are ignored from now on.  This method does not affect the
+    databases."""
+
+    if not self._is_alive(id):
+      raise KeyError(id)
+
+    for succ_id in self._iter_succ_ids(id):
+      self._pred_counts[succ_id] -= 1
+
+    self._alive[id] = 0
+    self._count -= 1
+    self._symbols.pop(id, None)
+    self._extra_preds.pop(id, None)
+    self._extra_succs.pop(id, None)
+
+  def keys(self):
+    return list(self._iter_ids())
+
+  def _iter_ids(self):
+    """Generate the ids of the nodes in the graph, in increasing order."""
+
+    alive = self._alive
+    for id in xrange(self._first_id, len(alive)):
+      if alive[id]:
+        yield id
+
+  def __iter__(self):
+    for id in self._iter_ids():
+      yield self[id]
+
+  def search_for_path(self, starting_node_id, stop_set):
+    """Search for paths to prerequisites of STARTING_NODE_ID.
+
+    See ChangesetGraph.search_for_path().  The predecessors of each
+    node are examined in order by id."""
+
+    reachable_changesets = {}
+
+    open_nodes = collections.deque([(starting_node_id, 0)])
+    while open_nodes:
+      (id, steps) = open_nodes.popleft()
+      steps += 1
+      for pred_id in self._iter_pred_ids(id):
+        if pred_id not in reachable_changesets:
+          reachable_changesets[pred_id] = (steps, id)
+          open_nodes.append((pred_id, steps))
+
+          if pred_id in stop_set:
+            return self._get_path(
+                reachable_changesets, starting_node_id, pred_id
+                )
+
+    return None
+
+  def _get_heap_entry(self, id):
+    """Return a tuple for ID that sorts in the desired commit order.
+
+    The tuples sort like the (time_range, changeset) tuples used by
+    _NoPredNodes."""
+
+    return (
+        self._t_max[id], self._t_min[id],
+        self._sort_order[id], self._symbols.get(id), id,
+        )
+
+  def consume_nopred_nodes(self):
+    """Remove and yield changesets in dependency order.
+
+    See ChangesetGraph.consume_nopred_nodes()."""
+
+    self._freeze()
+
+    pred_counts = self._pred_counts
+    nopred_nodes = [
+        self._get_heap_entry(id)
+        for id in self._iter_ids()
+        if not pred_counts[id]
+        ]
+    heapq.heapify(nopred_nodes)
+
+    while nopred_nodes:
+      id = heapq.heappop(nopred_nodes)[-1]
+      changeset = self._changeset_db[id]
+      time_range = self._get_time_range(id)
+      succ_ids = list(self._iter_succ_ids(id))
+      del self[id]
+      for succ_id in succ_ids:
+        if not pred_counts[succ_id]:
+          heapq.heappush(nopred_nodes, self._get_heap_entry(succ_id))
+      yield (changeset, time_range)
+
+  def find_cycle(self, starting_node_id):
+    """Find a cycle in the dependency graph and return it.
+
+    See ChangesetGraph.find_cycle().  This method always follows the
+    predecessor with the lowest id."""
+
+    id = starting_node_id
+
+    # A map {id : index} of the nodes seen so far, and a list of them:
+    seen_indexes = {id : 0}
+    seen_ids = [id]
+
+    while True:
+      for pred_id in self._iter_pred_ids(id):
+        break
+      else:
+        raise NoPredNodeInGraphException('%x' % (id,))
+      id = pred_id
+      i = seen_indexes.get(id)
+      if i is None:
+        seen_indexes[id] = len(seen_ids)
+        seen_ids.append(id)
+      else:
+        seen_ids = seen_ids[i:]
+        seen_ids.reverse()
+        return [self._changeset_db[id] for id in seen_ids]
+
+  def consume_graph(self, cycle_breaker=None):
+    """Remove and yield changesets from this graph in dependency order.
+
+    See ChangesetGraph.consume_graph().  The search for a cycle starts
+    at the node with the lowest id."""
+
+    while True:
+      for (changeset, time_range) in self.consume_nopred_nodes():
+        yield (changeset, time_range)
+
+      if not self:
+        return
+
+      # New nodes get higher ids than any old ones, so the lowest id
+      # in the graph never decreases:
+      alive = self._alive
+      while not alive[self._first_id]:
+        self._first_id += 1
+
+      cycle = self.find_cycle(self._first_id)
+
+      if cycle_breaker is not None:
+        cycle_breaker(cycle)
+      else:
+        raise CycleInGraphException(cycle)
+
+  def __repr__(self):
+    """For convenience only.  The format is subject to change at any time."""
+
+    if self:
+      return 'CompactChangesetGraph:\n%s' \
+             % ''.join(['  %r\n' % node for node in self])
+    else:
+      return 'CompactChangesetGraph:\n  EMPTY\n'
+
+
+def create_changeset_graph(changeset_db, cvs_item_to_changeset_id):
+  """Return a new ChangesetGraph or CompactChangesetGraph.
+
+  Which one is chosen by Ctx().compact_changeset_graph."""
+
+  if Ctx().compact_changeset_graph:
+    return CompactChangesetGraph(changeset_db, cvs_item_to_changeset_id)
+  else:
+    return ChangesetGraph(changeset_db, cvs_item_to_changeset_id)
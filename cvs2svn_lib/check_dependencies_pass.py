@@ -122,7 +122,8 @@ class CheckIndexedItemStoreDependenciesPass(CheckDependenciesPass):
     self._register_temp_file_needed(self.cvs_items_store_index_file)
 
   def iter_cvs_items(self):
-    return self.cvs_item_store.itervalues()
+    for (id, cvs_item) in self.cvs_item_store.iter_in_offset_order():
+      yield cvs_item
 
   def get_cvs_item(self, item_id):
     return self.cvs_item_store[item_id]
@@ -86,6 +86,7 @@ from cvs2svn_lib.log import logger
 from cvs2svn_lib.artifact_manager import artifact_manager
 from cvs2svn_lib.cvs_item import CVSRevisionModification
 from cvs2svn_lib.indexed_database import IndexedDatabase
+from cvs2svn_lib.content_store import ContentStore
 from cvs2svn_lib.rcs_stream import RCSStream
 from cvs2svn_lib.rcs_stream import MalformedDeltaException
 from cvs2svn_lib.keyword_expander import expand_keywords
@@ -94,6 +95,8 @@ from cvs2svn_lib.revision_manager import RevisionCollector
 from cvs2svn_lib.revision_manager import RevisionReader
 from cvs2svn_lib.serializer import MarshalSerializer
 from cvs2svn_lib.serializer import CompressingSerializer
+from cvs2svn_lib.serializer import get_compression_codec
+from cvs2svn_lib.serializer import ZlibPresetDictionary
 from cvs2svn_lib.serializer import PrimedPickleSerializer
 from cvs2svn_lib.apple_single_filter import get_maybe_apple_single
 
@@ -220,7 +223,7 @@ class DeltaTextRecord(TextRecord):
       del text_record_db[self.id]
     else:
       # Store a new CheckedOutTextRecord in place of ourselves:
-      text_record_db.checkout_db['%x' % self.id] = text
+      text_record_db.checkout_db[self.id] = text
       new_text_record = CheckedOutTextRecord(self.id)
       new_text_record.refcount = self.refcount
       text_record_db.replace(new_text_record)
@@ -252,12 +255,12 @@ class CheckedOutTextRecord(TextRecord):
     (self.id, self.refcount,) = state
 
   def checkout(self, text_record_db):
-    text = text_record_db.checkout_db['%x' % self.id]
+    text = text_record_db.checkout_db[self.id]
     self.decrement_refcount(text_record_db)
     return text
 
   def free(self, text_record_db):
-    del text_record_db.checkout_db['%x' % self.id]
+    del text_record_db.checkout_db[self.id]
 
   def __str__(self):
     return 'CheckedOutTextRecord(%x, %d)' % (self.id, self.refcount,)
@@ -509,6 +512,7 @@ class _Sink(Sink):
         # that we can compute deltas backwards in time.
         self._rcs_stream = RCSStream(text)
         self._rcs_stream_revision = revision
+        self.revision_collector._set_head_text(text)
       else:
         # Any other trunk revision is a backward delta.  Apply the
         # delta to the RCSStream to mutate it to the contents of this
@@ -560,32 +564,214 @@ class _Sink(Sink):
     return None
 
 
+def _sample_dictionary(text, size):
+  """Return a preset compression dictionary of at most SIZE bytes for TEXT.
+
+  If TEXT is too long to be used as a whole, use evenly-spaced
+  1 kiB pieces of it."""
+
+  if len(text) <= size:
+    return text
+
+  piece_size = 1024
+  count = size // piece_size
+  stride = len(text) // count
+  return ''.join([
+      text[i * stride:i * stride + piece_size]
+      for i in range(count)
+      ])
+
+
+class DictionaryDeltaDatabase:
+  """A delta database whose texts are compressed using dictionaries.
+
+  The texts of each CVS file are compressed by zlib against a preset
+  dictionary that is sampled from the fulltext of the file's HEAD
+  revision.  Successive revisions of a file share most of their
+  contents, so this compresses small deltas much better than
+  compressing each of them separately.
+
+  DELTA_DB is an IndexedDatabase that maps cvs_rev_id to a tuple
+  (cvs_file_id, compressed_text); DICTIONARY_DB is an IndexedDatabase
+  that maps cvs_file_id to the file's dictionary.
+
+  When writing, start_file() must be called before the texts of a file
+  are stored, and set_dictionary() should be called with the fulltext
+  of its HEAD revision before any deltas are stored; otherwise an
+  empty dictionary is used.  When reading, the dictionaries of the
+  files that were used most recently are kept in memory."""
+
+  def __init__(self, delta_db, dictionary_db, level=None):
+    self.delta_db = delta_db
+    self.dictionary_db = dictionary_db
+    if level is None:
+      level = 9
+    self.level = level
+
+    # The file whose texts are currently being written, and its
+    # ZlibPresetDictionary (or None if it has not been set yet):
+    self._file_id = None
+    self._dictionary = None
+
+    # A map {cvs_file_id : ZlibPresetDictionary} of the dictionaries
+    # that are in memory for reading, and a map {cvs_file_id : tick}
+    # recording when each was last used:
+    self._dictionaries = {}
+    self._last_used = {}
+    self._tick = 0
+
+    self._raw_bytes = 0
+    self._compressed_bytes = 0
+
+  def start_file(self, cvs_file_id):
+    self._file_id = cvs_file_id
+    self._dictionary = None
+
+  def set_dictionary(self, text):
+    dictionary = _sample_dictionary(text, config.DELTA_DICTIONARY_SIZE)
+    self.dictionary_db[self._file_id] = dictionary
+    self._dictionary = ZlibPresetDictionary(dictionary, self.level)
+
+  def __setitem__(self, id, text):
+    if self._dictionary is None:
+      self.set_dictionary('')
+    compressed = self._dictionary.compress(text)
+    self.delta_db[id] = (self._file_id, compressed,)
+    self._raw_bytes += len(text)
+    self._compressed_bytes += len(compressed)
+
+  def _get_dictionary(self, cvs_file_id):
+    self._tick += 1
+    self._last_used[cvs_file_id] = self._tick
+    try:
+      return self._dictionaries[cvs_file_id]
+    except KeyError:
+      pass
+
+    if len(self._dictionaries) >= config.DELTA_DICTIONARY_CACHE_SIZE:
+      # Discard the least recently used quarter of the dictionaries:
+      entries = [
+          (tick, id)
+          for (id, tick) in self._last_used.iteritems()
+          if id in self._dictionaries
+          ]
+      entries.sort()
+      for (tick, id) in entries[:len(entries) // 4 + 1]:
+        del self._dictionaries[id]
+        del self._last_used[id]
+
+    dictionary = ZlibPresetDictionary(
+        self.dictionary_db[cvs_file_id], self.level
+        )
+    self._dictionaries[cvs_file_id] = dictionary
+    return dictionary
+
+  def __getitem__(self, id):
+    (cvs_file_id, compressed) = self.delta_db[id]
+    return self._get_dictionary(cvs_file_id).decompress(compressed)
+
+  def __delitem__(self, id):
+    del self.delta_db[id]
+
+  def close(self):
+    if self._raw_bytes:
+      logger.verbose(
+          'RCS delta database (zlib:%d with dictionaries): '
+          'compressed %d bytes to %d (%.1f%%)'
+          % (
+              self.level, self._raw_bytes, self._compressed_bytes,
+              100.0 * self._compressed_bytes / self._raw_bytes,
+              )
+          )
+    self.delta_db.close()
+    self.delta_db = None
+    self.dictionary_db.close()
+    self.dictionary_db = None
+    self._dictionaries = None
+
+
+def _check_dictionaries(compress, codec, dictionaries):
+  if dictionaries and not (compress and codec == 'zlib'):
+    raise FatalError(
+        'Compression dictionaries can only be used with the zlib codec'
+        )
+
+
+def _log_compression_stats(serializer, name):
+  if isinstance(serializer, CompressingSerializer):
+    serializer.log_stats(name)
+
+
 class InternalRevisionCollector(RevisionCollector):
   """The RevisionCollector used by InternalRevisionReader."""
 
-  def __init__(self, compress):
+  def __init__(self, compress, codec='zlib', level=None, dictionaries=False):
+    """Initialize the collector.
+
+    If COMPRESS is True, compress the deltas that are stored using
+    compression codec CODEC at LEVEL (see
+    serializer.CompressingSerializer).  If DICTIONARIES is True, the
+    deltas of each file are compressed against a dictionary taken from
+    the file (see DictionaryDeltaDatabase); this requires CODEC to be
+    'zlib'."""
+
     RevisionCollector.__init__(self)
     self._compress = compress
+    self._codec = codec
+    self._level = level
+    self._dictionaries = dictionaries
+    if self._compress:
+      # Check the codec now rather than when the pass starts:
+      get_compression_codec(self._codec, self._level)
+    _check_dictionaries(self._compress, self._codec, self._dictionaries)
 
   def register_artifacts(self, which_pass):
     artifact_manager.register_temp_file(
         config.RCS_DELTAS_INDEX_TABLE, which_pass
         )
     artifact_manager.register_temp_file(config.RCS_DELTAS_STORE, which_pass)
+    if self._dictionaries:
+      artifact_manager.register_temp_file(
+          config.RCS_DELTA_DICTIONARIES_INDEX_TABLE, which_pass
+          )
+      artifact_manager.register_temp_file(
+          config.RCS_DELTA_DICTIONARIES_STORE, which_pass
+          )
     artifact_manager.register_temp_file(
         config.RCS_TREES_INDEX_TABLE, which_pass
         )
     artifact_manager.register_temp_file(config.RCS_TREES_STORE, which_pass)
 
   def start(self):
-    serializer = MarshalSerializer()
-    if self._compress:
-      serializer = CompressingSerializer(serializer)
-    self._delta_db = IndexedDatabase(
-        artifact_manager.get_temp_file(config.RCS_DELTAS_STORE),
-        artifact_manager.get_temp_file(config.RCS_DELTAS_INDEX_TABLE),
-        DB_OPEN_NEW, serializer,
-        )
+    if self._dictionaries:
+      self._delta_db = DictionaryDeltaDatabase(
+          IndexedDatabase(
+              artifact_manager.get_temp_file(config.RCS_DELTAS_STORE),
+              artifact_manager.get_temp_file(config.RCS_DELTAS_INDEX_TABLE),
+              DB_OPEN_NEW, MarshalSerializer(),
+              ),
+          IndexedDatabase(
+              artifact_manager.get_temp_file(
+                  config.RCS_DELTA_DICTIONARIES_STORE
+                  ),
+              artifact_manager.get_temp_file(
+                  config.RCS_DELTA_DICTIONARIES_INDEX_TABLE
+                  ),
+              DB_OPEN_NEW, CompressingSerializer(MarshalSerializer()),
+              ),
+          self._level,
+          )
+    else:
+      serializer = MarshalSerializer()
+      if self._compress:
+        serializer = CompressingSerializer(
+            serializer, self._codec, self._level
+            )
+      self._delta_db = IndexedDatabase(
+          artifact_manager.get_temp_file(config.RCS_DELTAS_STORE),
+          artifact_manager.get_temp_file(config.RCS_DELTAS_INDEX_TABLE),
+          DB_OPEN_NEW, serializer,
+          )
     primer = (FullTextRecord, DeltaTextRecord)
     self._rcs_trees = IndexedDatabase(
         artifact_manager.get_temp_file(config.RCS_TREES_STORE),
@@ -593,6 +779,12 @@ class InternalRevisionCollector(RevisionCollector):
         DB_OPEN_NEW, PrimedPickleSerializer(primer),
         )
 
+  def _set_head_text(self, text):
+    """TEXT is the fulltext of the HEAD revision of the current file."""
+
+    if self._dictionaries:
+      self._delta_db.set_dictionary(text)
+
   def _writeout(self, text_record, text):
     self.text_record_db.add(text_record)
     self._delta_db[text_record.id] = text
@@ -607,6 +799,9 @@ class InternalRevisionCollector(RevisionCollector):
     # A map from cvs_rev_id to TextRecord instance:
     self.text_record_db = TextRecordDatabase(self._delta_db, NullDatabase())
 
+    if self._dictionaries:
+      self._delta_db.start_file(cvs_file_items.cvs_file.id)
+
     f = open(cvs_file_items.cvs_file.rcs_path, 'rb')
     try:
       parse(f, _Sink(self, cvs_file_items))
@@ -619,6 +814,8 @@ class InternalRevisionCollector(RevisionCollector):
     del self.text_record_db
 
   def finish(self):
+    if not self._dictionaries:
+      _log_compression_stats(self._delta_db.serializer, 'RCS delta database')
     self._delta_db.close()
     self._rcs_trees.close()
 
@@ -626,14 +823,21 @@ class InternalRevisionCollector(RevisionCollector):
 class InternalRevisionReader(RevisionReader):
   """A RevisionReader that reads the contents from an own delta store."""
 
-  def __init__(self, compress):
-    # Only import Database if an InternalRevisionReader is really
-    # instantiated, because the import fails if a decent dbm is not
-    # installed.
-    from cvs2svn_lib.database import Database
-    self._Database = Database
+  def __init__(self, compress, codec='zlib', level=None, dictionaries=False):
+    """Initialize the reader.
+
+    If COMPRESS is True, compress the fulltexts in the checkout
+    database using compression codec CODEC at LEVEL.  (The deltas are
+    read using whatever codec they were written with.)  DICTIONARIES
+    must have the same value as for the InternalRevisionCollector."""
 
     self._compress = compress
+    self._codec = codec
+    self._level = level
+    self._dictionaries = dictionaries
+    if self._compress:
+      get_compression_codec(self._codec, self._level)
+    _check_dictionaries(self._compress, self._codec, self._dictionaries)
 
   def register_artifacts(self, which_pass):
     artifact_manager.register_temp_file(config.CVS_CHECKOUT_DB, which_pass)
@@ -643,6 +847,13 @@ class InternalRevisionReader(RevisionReader):
     artifact_manager.register_temp_file_needed(
         config.RCS_DELTAS_INDEX_TABLE, which_pass
         )
+    if self._dictionaries:
+      artifact_manager.register_temp_file_needed(
+          config.RCS_DELTA_DICTIONARIES_STORE, which_pass
+          )
+      artifact_manager.register_temp_file_needed(
+          config.RCS_DELTA_DICTIONARIES_INDEX_TABLE, which_pass
+          )
     artifact_manager.register_temp_file_needed(
         config.RCS_TREES_STORE, which_pass
         )
@@ -656,6 +867,20 @@ class InternalRevisionReader(RevisionReader):
         artifact_manager.get_temp_file(config.RCS_DELTAS_INDEX_TABLE),
         DB_OPEN_READ,
         )
+    if self._dictionaries:
+      self._delta_db = DictionaryDeltaDatabase(
+          self._delta_db,
+          IndexedDatabase(
+              artifact_manager.get_temp_file(
+                  config.RCS_DELTA_DICTIONARIES_STORE
+                  ),
+              artifact_manager.get_temp_file(
+                  config.RCS_DELTA_DICTIONARIES_INDEX_TABLE
+                  ),
+              DB_OPEN_READ,
+              ),
+          self._level,
+          )
     self._delta_db.__delitem__ = lambda id: None
     self._tree_db = IndexedDatabase(
         artifact_manager.get_temp_file(config.RCS_TREES_STORE),
@@ -664,10 +889,11 @@ class InternalRevisionReader(RevisionReader):
         )
     serializer = MarshalSerializer()
     if self._compress:
-      serializer = CompressingSerializer(serializer)
-    self._co_db = self._Database(
-        artifact_manager.get_temp_file(config.CVS_CHECKOUT_DB),
-        DB_OPEN_NEW, serializer,
+      serializer = CompressingSerializer(serializer, self._codec, self._level)
+    self._co_db = ContentStore(
+        artifact_manager.get_temp_file(config.CVS_CHECKOUT_DB), serializer,
+        config.CHECKOUT_DB_COMPACT_MIN_DEAD_BYTES,
+        config.CHECKOUT_DB_COMPACT_DEAD_FRACTION,
         )
 
     # The set of CVSFile instances whose TextRecords have already been
@@ -750,6 +976,9 @@ class InternalRevisionReader(RevisionReader):
     self._text_record_db.log_leftovers()
 
     del self._text_record_db
+    if not self._dictionaries:
+      _log_compression_stats(self._delta_db.serializer, 'RCS delta database')
+    _log_compression_stats(self._co_db.serializer, 'Checkout database')
     self._delta_db.close()
     self._tree_db.close()
     self._co_db.close()
@@ -45,6 +45,9 @@ or branch.
 
 
 import re
+import traceback
+import multiprocessing
+from collections import deque
 
 from cvs2svn_lib import config
 from cvs2svn_lib.common import DB_OPEN_NEW
@@ -52,6 +55,7 @@ from cvs2svn_lib.common import warning_prefix
 from cvs2svn_lib.common import error_prefix
 from cvs2svn_lib.common import is_trunk_revision
 from cvs2svn_lib.common import is_branch_revision_number
+from cvs2svn_lib.common import InternalError
 from cvs2svn_lib.log import logger
 from cvs2svn_lib.context import Ctx
 from cvs2svn_lib.artifact_manager import artifact_manager
@@ -70,6 +74,7 @@ from cvs2svn_lib.cvs_item_database import NewCVSItemStore
 from cvs2svn_lib.symbol_statistics import SymbolStatisticsCollector
 from cvs2svn_lib.metadata_database import MetadataDatabase
 from cvs2svn_lib.metadata_database import MetadataLogger
+from cvs2svn_lib.parse_cache import ParseCache
 
 from cvs2svn_lib.rcsparser import Sink
 from cvs2svn_lib.rcsparser import parse
@@ -520,7 +525,13 @@ class _FileDataCollector(Sink):
   """Class responsible for collecting RCS data for a particular file.
 
   Any collected data that need to be remembered are stored into the
-  referenced CollectData instance."""
+  referenced CollectData instance.
+
+  The contents of the revisions are not needed in this pass (only
+  whether each deltatext is empty), so the parser is told to skip
+  over them."""
+
+  needs_text = False
 
   def __init__(self, pdc, cvs_file):
     """Create an object that is prepared to receive data for CVS_FILE.
@@ -975,6 +986,108 @@ class _FileDataCollector(Sink):
     self._cvs_file_items.check_link_consistency()
 
 
+# The version of the format of the parse results produced by
+# _parse_rcs_file().  It is stored in parse caches, and has to be
+# incremented whenever the format changes, so that stale caches are
+# discarded.
+_PARSE_RESULTS_FORMAT = 1
+
+
+class _SinkRecorder(Sink):
+  """A Sink that records the callbacks that _FileDataCollector needs.
+
+  This is used to parse a ,v file in a worker process when
+  CollectRevsPass is run with --jobs.  The recorded events are sent
+  back to the parent process and replayed into a _FileDataCollector
+  there, so that all ids are still allocated by the parent, in the
+  same order as in a serial conversion.
+
+  The deltatexts themselves are not needed, because
+  _FileDataCollector only needs to know whether each one is empty.  So
+  the parser is told to skip over them, and the TEXT argument of
+  set_revision_info() is recorded as a boolean."""
+
+  needs_text = False
+
+  def __init__(self):
+    # A list [(method_name, args), ...] of the callbacks received so
+    # far, in the order that they were received:
+    self.events = []
+
+  def set_principal_branch(self, branch):
+    self.events.append(('set_principal_branch', (branch,)))
+
+  def define_tag(self, name, revision):
+    self.events.append(('define_tag', (name, revision,)))
+
+  def set_expansion(self, mode):
+    self.events.append(('set_expansion', (mode,)))
+
+  def admin_completed(self):
+    self.events.append(('admin_completed', ()))
+
+  def define_revision(self, revision, timestamp, author, state,
+                      branches, next):
+    self.events.append((
+        'define_revision',
+        (revision, timestamp, author, state, branches, next,),
+        ))
+
+  def tree_completed(self):
+    self.events.append(('tree_completed', ()))
+
+  def set_description(self, description):
+    self.events.append(('set_description', (description,)))
+
+  def set_revision_info(self, revision, log, text):
+    self.events.append(('set_revision_info', (revision, log, bool(text),)))
+
+  def parse_completed(self):
+    self.events.append(('parse_completed', ()))
+
+
+def _parse_rcs_file(rcs_path):
+  """Parse the ,v file at RCS_PATH and return the results.
+
+  This function is run in a worker process.  Return a tuple (events,
+  error), where EVENTS is the list of events recorded by a
+  _SinkRecorder and ERROR is None if the parse succeeded.  If the
+  parse failed, ERROR is a tuple (exception_class, message) describing
+  the failure, and EVENTS contains the callbacks that were made before
+  the failure occurred.  (Exceptions are not raised directly because
+  not all exception instances survive being pickled.)"""
+
+  recorder = _SinkRecorder()
+  try:
+    f = open(rcs_path, 'rb')
+    try:
+      parse(f, recorder)
+    finally:
+      f.close()
+  except (RCSParseError, RuntimeError), e:
+    return (recorder.events, (RCSParseError, str(e)))
+  except ValueError, e:
+    return (recorder.events, (ValueError, str(e)))
+  except Exception:
+    return (recorder.events, (InternalError, traceback.format_exc()))
+  else:
+    return (recorder.events, None)
+
+
+def _replay_parse(parse_results, sink):
+  """Replay PARSE_RESULTS, as returned by _parse_rcs_file(), into SINK.
+
+  If the original parse failed, raise an exception of the same type
+  after replaying the callbacks that preceded the failure."""
+
+  (events, error) = parse_results
+  for (method_name, args) in events:
+    getattr(sink, method_name)(*args)
+  if error is not None:
+    (exception_class, message) = error
+    raise exception_class(message)
+
+
 class _ProjectDataCollector:
   def __init__(self, collect_data, project):
     self.collect_data = collect_data
@@ -1039,15 +1152,26 @@ class _ProjectDataCollector:
               % (old_name, new_name, count,)
               )
 
-  def process_file(self, cvs_file):
+  def process_file(self, cvs_file, parse_results=None):
+    """Collect the data for CVS_FILE and return its CVSFileItems.
+
+    If PARSE_RESULTS is None, parse CVS_FILE's ,v file directly.
+    Otherwise, PARSE_RESULTS is the value returned by
+    _parse_rcs_file() for CVS_FILE (possibly in a worker process or
+    during an earlier conversion), and it is replayed instead of
+    parsing the file again."""
+
     logger.normal(cvs_file.rcs_path)
     fdc = _FileDataCollector(self, cvs_file)
     try:
-      f = open(cvs_file.rcs_path, 'rb')
-      try:
-        parse(f, fdc)
-      finally:
-        f.close()
+      if parse_results is None:
+        f = open(cvs_file.rcs_path, 'rb')
+        try:
+          parse(f, fdc)
+        finally:
+          f.close()
+      else:
+        _replay_parse(parse_results, fdc)
     except (RCSParseError, RuntimeError):
       self.collect_data.record_fatal_error(
           "%r is not a valid ,v file" % (cvs_file.rcs_path,)
@@ -1099,6 +1223,25 @@ class CollectData:
     # Key generator for Symbols:
     self.symbol_key_generator = KeyGenerator()
 
+    # If a parse cache directory was configured, a ParseCache holding
+    # the parse results from previous conversions:
+    if Ctx().parse_cache_dir is not None:
+      self._parse_cache = ParseCache(
+          Ctx().parse_cache_dir, _PARSE_RESULTS_FORMAT,
+          max_size=Ctx().parse_cache_max_size,
+          checksums=Ctx().parse_cache_checksums,
+          )
+    else:
+      self._parse_cache = None
+
+    # If more than one job was requested, a pool of worker processes
+    # that parse ,v files on our behalf.  It is created here, before
+    # much memory has been allocated, to keep the forked workers small.
+    if Ctx().jobs > 1:
+      self._pool = multiprocessing.Pool(Ctx().jobs)
+    else:
+      self._pool = None
+
   def record_fatal_error(self, err):
     """Record that fatal error ERR was found.
 
@@ -1154,15 +1297,90 @@ class CollectData:
     self.add_cvs_file_items(cvs_file_items)
     self.symbol_stats.register(cvs_file_items)
 
+  def _store_parse_results(self, cvs_file, file_id, parse_results):
+    """Store PARSE_RESULTS for CVS_FILE to the parse cache, if any.
+
+    FILE_ID is the file id that the parse cache returned for CVS_FILE
+    before it was parsed.  The results of failed parses are not
+    cached."""
+
+    (events, error) = parse_results
+    if self._parse_cache is not None and error is None:
+      self._parse_cache.put(cvs_file.rcs_path, file_id, parse_results)
+
+  def _iter_parse_results(self, cvs_paths):
+    """Generate (cvs_path, parse_results) for each of CVS_PATHS, in order.
+
+    PARSE_RESULTS is either the value returned by _parse_rcs_file()
+    for that file, or None if the file should be parsed directly, in
+    process_file().  PARSE_RESULTS is always None for CVSDirectories.
+
+    If there is a parse cache, the results for unchanged files are
+    taken from it.  If there is a worker pool, the other ,v files are
+    handed to the workers in advance (but never more than a bounded
+    number at a time).  Either way the CVSPaths are generated in the
+    order that they were produced by CVS_PATHS, so the conversion
+    does not depend on the order in which the workers finish."""
+
+    if self._pool is None:
+      for cvs_path in cvs_paths:
+        parse_results = None
+        if self._parse_cache is not None \
+               and not isinstance(cvs_path, CVSDirectory):
+          (parse_results, file_id) = \
+              self._parse_cache.get(cvs_path.rcs_path)
+          if parse_results is None:
+            parse_results = _parse_rcs_file(cvs_path.rcs_path)
+            self._store_parse_results(cvs_path, file_id, parse_results)
+        yield (cvs_path, parse_results)
+      return
+
+    max_pending = Ctx().jobs * config.COLLECT_DATA_PENDING_FILES_PER_JOB
+
+    # A FIFO of (cvs_path, parse_results, file_id, AsyncResult).  For
+    # files that are being parsed by a worker, PARSE_RESULTS is None
+    # and FILE_ID is the id returned by the parse cache (if any); for
+    # CVSDirectories and for files whose results were found in the
+    # parse cache, AsyncResult is None:
+    pending = deque()
+
+    def pop_pending():
+      (cvs_path, parse_results, file_id, result) = pending.popleft()
+      if result is not None:
+        parse_results = result.get()
+        self._store_parse_results(cvs_path, file_id, parse_results)
+      return (cvs_path, parse_results)
+
+    for cvs_path in cvs_paths:
+      if isinstance(cvs_path, CVSDirectory):
+        pending.append((cvs_path, None, None, None))
+      else:
+        (parse_results, file_id) = (None, None)
+        if self._parse_cache is not None:
+          (parse_results, file_id) = \
+              self._parse_cache.get(cvs_path.rcs_path)
+        if parse_results is None:
+          pending.append((
+              cvs_path, None, file_id,
+              self._pool.apply_async(_parse_rcs_file, (cvs_path.rcs_path,)),
+              ))
+        else:
+          pending.append((cvs_path, parse_results, None, None))
+      while len(pending) > max_pending:
+        yield pop_pending()
+
+    while pending:
+      yield pop_pending()
+
   def process_project(self, project, cvs_paths):
     pdc = _ProjectDataCollector(self, project)
 
     found_rcs_file = False
-    for cvs_path in cvs_paths:
+    for (cvs_path, parse_results) in self._iter_parse_results(cvs_paths):
       if isinstance(cvs_path, CVSDirectory):
         self.add_cvs_directory(cvs_path)
       else:
-        cvs_file_items = pdc.process_file(cvs_path)
+        cvs_file_items = pdc.process_file(cvs_path, parse_results)
         self._process_cvs_file_items(cvs_file_items)
         found_rcs_file = True
 
@@ -1197,12 +1415,30 @@ class CollectData:
       if directory.parent_directory is not None:
         directory.parent_directory.empty_subdirectory_ids.append(directory.id)
 
+  def terminate_workers(self):
+    """Stop the worker processes, if any, without waiting for them.
+
+    This is used if the conversion fails while the files are being
+    processed, so that no worker processes are left behind."""
+
+    if self._pool is not None:
+      self._pool.terminate()
+      self._pool.join()
+      self._pool = None
+
   def close(self):
     """Close the data structures associated with this instance.
 
     Return a list of fatal errors encountered while processing input.
     Each list entry is a string describing one fatal error."""
 
+    if self._pool is not None:
+      self._pool.close()
+      self._pool.join()
+      self._pool = None
+    if self._parse_cache is not None:
+      self._parse_cache.close()
+      self._parse_cache = None
     self.symbol_stats.purge_ghost_symbols()
     self.symbol_stats.close()
     self.symbol_stats = None
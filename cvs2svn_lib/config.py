@@ -45,6 +45,12 @@ CVS_REVS_SORTED_DATAFILE = 'revs-s.dat'
 CVS_SYMBOLS_DATAFILE = 'symbols.dat'
 CVS_SYMBOLS_SORTED_DATAFILE = 'symbols-s.dat'
 
+# Pickled lists of the offsets of the sorted runs in CVS_REVS_DATAFILE
+# and CVS_SYMBOLS_DATAFILE, if FilterSymbolsPass wrote them as sorted
+# runs (see ctx.presort_cvs_items), or None otherwise:
+CVS_REVS_RUNS = 'revs-runs.pck'
+CVS_SYMBOLS_RUNS = 'symbols-runs.pck'
+
 # A mapping from CVSItem id to Changeset id.
 CVS_ITEM_TO_CHANGESET = 'cvs-item-to-changeset.dat'
 
@@ -84,6 +90,13 @@ CHANGESETS_SYMBROKEN_STORE = 'changesets-symbroken.pck'
 CHANGESETS_ALLBROKEN_INDEX = 'changesets-allbroken-index.dat'
 CHANGESETS_ALLBROKEN_STORE = 'changesets-allbroken.pck'
 
+# Each of the changeset databases above is compacted at the end of the
+# pass that writes it if the changesets that were deleted or replaced
+# while breaking cycles take up at least this many bytes and more than
+# this fraction of the file:
+CHANGESETS_COMPACT_MIN_DEAD_BYTES = 64 * 1024 * 1024
+CHANGESETS_COMPACT_DEAD_FRACTION = 0.25
+
 # The RevisionChangesets in commit order.  Each line contains the
 # changeset id and timestamp of one changeset, in hexadecimal, in the
 # order that the changesets should be committed to svn.
@@ -161,6 +174,39 @@ CVS_REVS_TO_SVN_REVNUMS = 'cvs-revs-to-svn-revnums.dat'
 SVN_COMMITS_INDEX_TABLE = 'svn-commits-index.dat'
 SVN_COMMITS_STORE = 'svn-commits.pck'
 
+# When CollectRevsPass is run with more than one job, the maximum
+# number of ,v files per job that may be queued for parsing at any
+# one time.  The queue allows the workers to keep busy while the
+# parent process is occupied with a file that takes long to process.
+COLLECT_DATA_PENDING_FILES_PER_JOB = 16
+
+# When changeset cycles are broken using more than one job, the
+# strongly connected components of the changeset graph with fewer than
+# this many changesets are handled in the main process, because it
+# would take longer to send them to a worker process.  This is the
+# default value of ctx.cycle_breaking_min_parallel_scc_size:
+CYCLE_BREAKING_MIN_PARALLEL_SCC_SIZE = 50
+
+# When the repository is walked using several threads, how many
+# directory listings to request ahead of time per thread.  Each
+# pending listing holds the stat() results for all of the entries in
+# the directory.
+WALK_READ_AHEAD_DIRECTORIES_PER_THREAD = 16
+
+# How many (cvs_item_id, value) entries to collect before writing them
+# to a RecordTable in one batch (see RecordTable.set_many()).  Larger
+# batches contain longer runs of consecutive ids:
+RECORD_TABLE_BATCH_SIZE = 100000
+
+# The intermediate data files whose in-memory sort is estimated to
+# need no more than this many bytes of RAM are sorted in memory in one
+# step rather than via temporary files.  The estimate includes the
+# per-record overhead of Python strings and of any sort keys, so only
+# files that are considerably smaller than this are sorted in memory.
+# Sorting via temporary files only needs about MERGE_BUFFER_MEMORY
+# bytes (see sort.py) plus the chunks that are sorted in memory:
+SORT_MEMORY_LIMIT = 128 * 1024 * 1024
+
 # How many bytes to read at a time from a pipe.  128 kiB should be
 # large enough to be efficient without wasting too much memory.
 PIPE_READ_SIZE = 128 * 1024
@@ -185,6 +231,19 @@ METADATA_CLEAN_STORE = 'metadata-clean.pck'
 RCS_DELTAS_INDEX_TABLE = 'rcs-deltas-index.dat'
 RCS_DELTAS_STORE = 'rcs-deltas.pck'
 
+# If the deltas are compressed using per-file dictionaries, this
+# records the dictionary of each CVS file:
+RCS_DELTA_DICTIONARIES_INDEX_TABLE = 'rcs-delta-dictionaries-index.dat'
+RCS_DELTA_DICTIONARIES_STORE = 'rcs-delta-dictionaries.pck'
+
+# The maximum size of a per-file compression dictionary for the RCS
+# deltas.  Only the last 32 kiB of a dictionary can be used by zlib.
+DELTA_DICTIONARY_SIZE = 32 * 1024
+
+# How many per-file compression dictionaries to keep in memory while
+# reading the RCS deltas during OutputPass:
+DELTA_DICTIONARY_CACHE_SIZE = 256
+
 # Records the revision tree of each RCS file.  The format is a list of
 # list of integers.  The outer list holds lines of development, the inner list
 # revisions within the LODs, revisions are CVSItem ids.  Branches "closer
@@ -199,6 +258,12 @@ RCS_TREES_STORE = 'rcs-trees.pck'
 # be checked out.
 CVS_CHECKOUT_DB = 'cvs-checkout.db'
 
+# The checkout database is compacted once the fulltexts that have been
+# deleted from it take up at least this many bytes and more than this
+# fraction of the file:
+CHECKOUT_DB_COMPACT_MIN_DEAD_BYTES = 64 * 1024 * 1024
+CHECKOUT_DB_COMPACT_DEAD_FRACTION = 0.5
+
 # End of DBs related to --use-internal-co.
 
 # Hold the generated blob content for the git back end.
@@ -0,0 +1,151 @@
+# (Be in -*- python -*- mode.)
+#
+# ====================================================================
+# Copyright (c) 2000-2009 CollabNet.  All rights reserved.
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution.
+#
+# This software consists of voluntary contributions made by many
+# individuals.  For exact contribution history, see the revision
+# history and logs.
+# ====================================================================
+
+"""A temporary store of serialized objects kept in an append-only log.
+
+This is used instead of a dbm database for data that are written,
+read a few times, and then deleted again during a single pass, such
+as the fulltexts in the checkout database of InternalRevisionReader.
+It does not depend on any dbm module and its performance does not
+degrade as the data churn."""
+
+
+from cvs2svn_lib.log import logger
+
+
+class ContentStore:
+  """A map {key : object} whose values are stored in a single log file.
+
+  The objects are serialized using a Serializer and appended to the
+  end of the file; the offset and length of each live record are kept
+  in memory.  Records that are deleted or overwritten leave dead space
+  behind in the file (except that a record at the end of the file is
+  reclaimed immediately).  Once the dead space amounts to at least
+  COMPACT_MIN_DEAD_BYTES bytes and to more than COMPACT_DEAD_FRACTION
+  of the file, the file is compacted in place by moving the live
+  records towards its start.
+
+  The file is always created anew, and its contents do not outlive
+  the ContentStore instance."""
+
+  def __init__(
+        self, filename, serializer,
+        compact_min_dead_bytes, compact_dead_fraction,
+        ):
+    self.filename = filename
+    self.serializer = serializer
+    self.compact_min_dead_bytes = compact_min_dead_bytes
+    self.compact_dead_fraction = compact_dead_fraction
+
+    self.f = open(self.filename, 'wb+')
+
+    # A map {key : (offset, length)} for the live records:
+    self._index = {}
+
+    # The size of the file and the total length of the live records
+    # in it:
+    self._eofp = 0
+    self._live_bytes = 0
+
+    # Statistics, which are logged when the store is closed:
+    self._max_size = 0
+    self._compactions = 0
+    self._bytes_reclaimed = 0
+
+  def __setitem__(self, key, value):
+    if key in self._index:
+      self._discard(key)
+
+    s = self.serializer.dumps(value)
+    self.f.seek(self._eofp)
+    self.f.write(s)
+    self._index[key] = (self._eofp, len(s))
+    self._eofp += len(s)
+    self._live_bytes += len(s)
+    self._max_size = max(self._max_size, self._eofp)
+
+  def __getitem__(self, key):
+    (offset, length) = self._index[key]
+    self.f.seek(offset)
+    return self.serializer.loads(self.f.read(length))
+
+  def get(self, key, default=None):
+    try:
+      return self[key]
+    except KeyError:
+      return default
+
+  def __contains__(self, key):
+    return key in self._index
+
+  def __len__(self):
+    return len(self._index)
+
+  def __delitem__(self, key):
+    self._discard(key)
+
+    dead_bytes = self._eofp - self._live_bytes
+    if dead_bytes >= self.compact_min_dead_bytes \
+           and dead_bytes > self.compact_dead_fraction * self._eofp:
+      self.compact()
+
+  def _discard(self, key):
+    """Remove the record for KEY from the index."""
+
+    (offset, length) = self._index.pop(key)
+    self._live_bytes -= length
+    if offset + length == self._eofp:
+      # The record is at the end of the file, so its space can be
+      # reused right away:
+      self._eofp = offset
+
+  def compact(self):
+    """Move the live records to the start of the file and truncate it.
+
+    The records are moved in the order of their offsets, so a record
+    is never written over one that has not been moved yet."""
+
+    records = [
+        (offset, length, key)
+        for (key, (offset, length)) in self._index.iteritems()
+        ]
+    records.sort()
+
+    new_eofp = 0
+    for (offset, length, key) in records:
+      if offset != new_eofp:
+        self.f.seek(offset)
+        s = self.f.read(length)
+        self.f.seek(new_eofp)
+        self.f.write(s)
+        self._index[key] = (new_eofp, length)
+      new_eofp += length
+
+    self.f.truncate(new_eofp)
+    self._compactions += 1
+    self._bytes_reclaimed += self._eofp - new_eofp
+    self._eofp = new_eofp
+
+  def close(self):
+    logger.verbose(
+        '%s: %d compactions reclaimed %d bytes; maximum size %d bytes'
+        % (self, self._compactions, self._bytes_reclaimed, self._max_size,)
+        )
+    self._index = None
+    self.f.close()
+    self.f = None
+
+  def __str__(self):
+    return 'ContentStore(%r)' % (self.filename,)
+
+
@@ -56,6 +56,26 @@ class Ctx:
     self.file_property_setters = []
     self.revision_property_setters = []
     self.tmpdir = None
+    self.jobs = 1
+    self.walk_threads = 1
+    self.sort_jobs = 1
+    self.sort_compression = None
+    self.sort_tmpdirs = []
+    self.sort_memory_limit = config.SORT_MEMORY_LIMIT
+    self.columnar_cvs_item_store = False
+    self.struct_cvs_item_serializer = False
+    self.binary_sortable_cvs_items = False
+    self.presort_cvs_items = False
+    self.compact_changeset_graph = False
+    self.scc_cycle_breaking = False
+    self.cycle_breaking_jobs = 1
+    self.cycle_breaking_min_parallel_scc_size = \
+        config.CYCLE_BREAKING_MIN_PARALLEL_SCC_SIZE
+    self.cvs_item_to_changeset_overlay = False
+    self.consolidate_cvs_item_to_changeset = False
+    self.parse_cache_dir = None
+    self.parse_cache_max_size = None
+    self.parse_cache_checksums = False
     self.skip_cleanup = False
     self.keep_cvsignore = False
     self.cross_project_commits = True
@@ -14,9 +14,17 @@
 """This module contains a database that can store arbitrary CVSItems."""
 
 
+import os
 import re
+import struct
+import mmap
+import marshal
 import cPickle
 
+from cvs2svn_lib.common import DB_OPEN_READ
+from cvs2svn_lib.common import DB_OPEN_WRITE
+from cvs2svn_lib.common import DB_OPEN_NEW
+from cvs2svn_lib.context import Ctx
 from cvs2svn_lib.cvs_item import CVSRevisionAdd
 from cvs2svn_lib.cvs_item import CVSRevisionChange
 from cvs2svn_lib.cvs_item import CVSRevisionDelete
@@ -29,6 +37,8 @@ from cvs2svn_lib.cvs_file_items import CVSFileItems
 from cvs2svn_lib.serializer import Serializer
 from cvs2svn_lib.serializer import PrimedPickleSerializer
 from cvs2svn_lib.indexed_database import IndexedStore
+from cvs2svn_lib.sort import LengthPrefixedFormat
+from cvs2svn_lib.sort import SortedRunWriter
 
 
 cvs_item_primer = (
@@ -155,13 +165,220 @@ class LinewiseSerializer(Serializer):
     return self.wrapee.loads(self._decode_newlines(s[:-1]))
 
 
+class CVSItemSerializer(Serializer):
+  """A compact binary serializer for the CVSItem classes.
+
+  Each CVSItem is written as a fixed-size header packed with struct,
+  followed by a marshalled tuple of the members of its state that are
+  not fixed-size.  The header contains the type tag of the item, a
+  mask telling which of the integer members are None, a bit for each
+  boolean member, the length of the marshalled data, and the values
+  of the integer members (ids and timestamps).  This avoids the cost
+  of setting up a primed pickler or unpickler for each item.
+
+  An item that does not fit this scheme (for example, an id that
+  doesn't fit in 32 bits) is pickled instead, with type tag 0."""
+
+  # A list [(cls, kinds)] of the classes that can be serialized.  The
+  # type tag of a class is one more than its index in this list.
+  # KINDS has one character for each member of the tuple returned by
+  # the class's __getstate__() method: 'i' for an id (a non-negative
+  # integer or None), 't' for a timestamp (an integer or None), 'b'
+  # for a boolean, and 'm' for anything else (which must be
+  # marshallable).
+  _revision_kinds = 'iitiiimbiibiimmmmmmbm'
+  _branch_kinds = 'iiimiiimmmm'
+  _tag_kinds = 'iiiiim'
+  CLASSES = [
+      (CVSRevisionAdd, _revision_kinds),
+      (CVSRevisionChange, _revision_kinds),
+      (CVSRevisionDelete, _revision_kinds),
+      (CVSRevisionNoop, _revision_kinds),
+      (CVSBranch, _branch_kinds),
+      (CVSBranchNoop, _branch_kinds),
+      (CVSTag, _tag_kinds),
+      (CVSTagNoop, _tag_kinds),
+      ]
+
+  # The header of a pickled item: its type tag (0) and the length of
+  # the pickle:
+  _pickle_header = struct.Struct('<BI')
+
+  def __init__(self):
+    self._init_layouts()
+
+  def _init_layouts(self):
+    # A map {cls : layout} and a list [layout] indexed by type tag.
+    # Each layout is a tuple (tag, cls, length, header, int_indexes,
+    # timestamp_indexes, bool_indexes, marshal_indexes), where HEADER
+    # is the struct.Struct of the header and the *_INDEXES are lists
+    # of indexes into the state tuple.
+    self._layouts = {}
+    self._layouts_by_tag = [None]
+    for (i, (cls, kinds)) in enumerate(self.CLASSES):
+      format = '<BIBI'
+      int_indexes = []
+      timestamp_indexes = []
+      bool_indexes = []
+      marshal_indexes = []
+      for (j, kind) in enumerate(kinds):
+        if kind in 'it':
+          int_indexes.append(j)
+          if kind == 'i':
+            format += 'I'
+          else:
+            format += 'q'
+            timestamp_indexes.append(j)
+        elif kind == 'b':
+          bool_indexes.append(j)
+        else:
+          marshal_indexes.append(j)
+      layout = (
+          i + 1, cls, len(kinds), struct.Struct(format),
+          int_indexes, timestamp_indexes, bool_indexes, marshal_indexes,
+          )
+      self._layouts[cls] = layout
+      self._layouts_by_tag.append(layout)
+
+  def __getstate__(self):
+    # The layouts are rebuilt when unpickling; just record the version
+    # of the format:
+    return (1,)
+
+  def __setstate__(self, state):
+    self._init_layouts()
+
+  def _dumps_pickle(self, cvs_item):
+    s = cPickle.dumps(cvs_item, -1)
+    return self._pickle_header.pack(0, len(s)) + s
+
+  def dumps(self, cvs_item):
+    try:
+      (
+          tag, cls, length, header,
+          int_indexes, timestamp_indexes, bool_indexes, marshal_indexes,
+          ) = self._layouts[cvs_item.__class__]
+    except KeyError:
+      return self._dumps_pickle(cvs_item)
+
+    state = cvs_item.__getstate__()
+    if len(state) != length:
+      return self._dumps_pickle(cvs_item)
+
+    for i in timestamp_indexes:
+      if not isinstance(state[i], (int, long, type(None))):
+        # struct would silently truncate a float:
+        return self._dumps_pickle(cvs_item)
+
+    none_mask = 0
+    values = []
+    bit = 1
+    for i in int_indexes:
+      value = state[i]
+      if value is None:
+        none_mask |= bit
+        value = 0
+      values.append(value)
+      bit <<= 1
+
+    flags = 0
+    bit = 1
+    for i in bool_indexes:
+      value = state[i]
+      if value is True:
+        flags |= bit
+      elif value is not False:
+        return self._dumps_pickle(cvs_item)
+      bit <<= 1
+
+    try:
+      rest = marshal.dumps(tuple([state[i] for i in marshal_indexes]))
+      return header.pack(tag, none_mask, flags, len(rest), *values) + rest
+    except (ValueError, struct.error):
+      return self._dumps_pickle(cvs_item)
+
+  def dumpf(self, f, cvs_item):
+    f.write(self.dumps(cvs_item))
+
+  def loads(self, s):
+    tag = ord(s[0])
+    if tag == 0:
+      return cPickle.loads(s[self._pickle_header.size:])
+
+    (
+        tag, cls, length, header,
+        int_indexes, timestamp_indexes, bool_indexes, marshal_indexes,
+        ) = self._layouts_by_tag[tag]
+    fields = header.unpack_from(s)
+    (none_mask, flags) = fields[1:3]
+
+    state = [None] * length
+    j = 4
+    bit = 1
+    for i in int_indexes:
+      if not none_mask & bit:
+        state[i] = fields[j]
+      j += 1
+      bit <<= 1
+
+    bit = 1
+    for i in bool_indexes:
+      state[i] = bool(flags & bit)
+      bit <<= 1
+
+    rest = marshal.loads(s[header.size:])
+    for (i, value) in zip(marshal_indexes, rest):
+      state[i] = value
+
+    cvs_item = cls.__new__(cls)
+    cvs_item.__setstate__(tuple(state))
+    return cvs_item
+
+  def loadf(self, f):
+    s = f.read(1)
+    if not s:
+      raise EOFError()
+    tag = ord(s)
+    if tag == 0:
+      header = self._pickle_header
+    else:
+      header = self._layouts_by_tag[tag][3]
+    s += f.read(header.size - 1)
+    if len(s) < header.size:
+      raise EOFError()
+    n = header.unpack_from(s)[-1 if tag == 0 else 3]
+    data = f.read(n)
+    if len(data) < n:
+      raise EOFError()
+    return self.loads(s + data)
+
+
+def get_cvs_item_serializer():
+  """Return a serializer for CVSItems.
+
+  The type of the serializer depends on
+  Ctx().struct_cvs_item_serializer."""
+
+  if Ctx().struct_cvs_item_serializer:
+    return CVSItemSerializer()
+  else:
+    return PrimedPickleSerializer(cvs_item_primer)
+
+
 class NewSortableCVSRevisionDatabase(object):
   """A serially-accessible, sortable file for holding CVSRevisions.
 
+  If PRESORT is True, the items are written as sorted runs (see
+  sort.SortedRunWriter), whose offsets are stored to self.run_starts
+  by close(); otherwise self.run_starts is set to None.
+
   This class creates such files."""
 
-  def __init__(self, filename, serializer):
-    self.f = open(filename, 'w')
+  def __init__(self, filename, serializer, presort=False):
+    if presort:
+      self.f = SortedRunWriter(filename)
+    else:
+      self.f = open(filename, 'w')
     self.serializer = LinewiseSerializer(serializer)
 
   def add(self, cvs_rev):
@@ -173,7 +390,7 @@ class NewSortableCVSRevisionDatabase(object):
         )
 
   def close(self):
-    self.f.close()
+    self.run_starts = self.f.close()
     self.f = None
 
 
@@ -200,10 +417,15 @@ class OldSortableCVSRevisionDatabase(object):
 class NewSortableCVSSymbolDatabase(object):
   """A serially-accessible, sortable file for holding CVSSymbols.
 
+  PRESORT works as for NewSortableCVSRevisionDatabase.
+
   This class creates such files."""
 
-  def __init__(self, filename, serializer):
-    self.f = open(filename, 'w')
+  def __init__(self, filename, serializer, presort=False):
+    if presort:
+      self.f = SortedRunWriter(filename)
+    else:
+      self.f = open(filename, 'w')
     self.serializer = LinewiseSerializer(serializer)
 
   def add(self, cvs_symbol):
@@ -212,7 +434,7 @@ class NewSortableCVSSymbolDatabase(object):
         )
 
   def close(self):
-    self.f.close()
+    self.run_starts = self.f.close()
     self.f = None
 
 
@@ -236,10 +458,557 @@ class OldSortableCVSSymbolDatabase(object):
     pass
 
 
+# The sort keys of the records in the binary sortable CVSRevision
+# files: (metadata_id, timestamp + TIMESTAMP_BIAS, id), big-endian so
+# that the keys sort as strings in numerical order:
+_cvs_revision_sort_key = struct.Struct('>IQQ')
+
+# The sort keys of the records in the binary sortable CVSSymbol files:
+# (symbol.id, id):
+_cvs_symbol_sort_key = struct.Struct('>IQ')
+
+# This is added to timestamps to make them non-negative:
+TIMESTAMP_BIAS = 1 << 63
+
+# The record formats of the binary sortable CVSRevision and CVSSymbol
+# files, to be passed to sort.sort_file():
+CVS_REVISION_RECORD_FORMAT = LengthPrefixedFormat(_cvs_revision_sort_key.size)
+CVS_SYMBOL_RECORD_FORMAT = LengthPrefixedFormat(_cvs_symbol_sort_key.size)
+
+
+class NewBinarySortableCVSRevisionDatabase(object):
+  """A serially-accessible, sortable file for holding CVSRevisions.
+
+  Each CVSRevision is stored as a record in CVS_REVISION_RECORD_FORMAT
+  whose key contains its metadata_id, timestamp, and id and whose
+  payload is the serialized CVSRevision.  The keys are unique, so the
+  file can be sorted by comparing the records as strings, and the
+  payloads never need to be escaped.
+
+  The sort order differs from that of NewSortableCVSRevisionDatabase,
+  whose lines are ordered by the hex representation of the
+  metadata_id and by the escaped serialized CVSRevision rather than
+  by the numerical metadata_id and the id.  Since the order of the
+  sorted CVSRevisions determines the order in which changesets are
+  created and their cycles are broken, the two formats can lead to
+  different changesets.
+
+  PRESORT works as for NewSortableCVSRevisionDatabase.
+
+  This class creates such files."""
+
+  def __init__(self, filename, serializer, presort=False):
+    if presort:
+      self.f = SortedRunWriter(filename)
+    else:
+      self.f = open(filename, 'wb')
+    self.serializer = serializer
+
+  def add(self, cvs_rev):
+    self.f.write(
+        CVS_REVISION_RECORD_FORMAT.pack(
+            _cvs_revision_sort_key.pack(
+                cvs_rev.metadata_id, cvs_rev.timestamp + TIMESTAMP_BIAS,
+                cvs_rev.id,
+                ),
+            self.serializer.dumps(cvs_rev),
+            )
+        )
+
+  def close(self):
+    self.run_starts = self.f.close()
+    self.f = None
+
+
+class OldBinarySortableCVSRevisionDatabase(object):
+  """A serially-accessible, sortable file for holding CVSRevisions.
+
+  This class reads the files written by
+  NewBinarySortableCVSRevisionDatabase."""
+
+  def __init__(self, filename, serializer):
+    self.filename = filename
+    self.serializer = serializer
+
+  def __iter__(self):
+    f = open(self.filename, 'rb')
+    for record in CVS_REVISION_RECORD_FORMAT.iter_records(f):
+      yield self.serializer.loads(
+          CVS_REVISION_RECORD_FORMAT.get_payload(record)
+          )
+    f.close()
+
+  def close(self):
+    pass
+
+
+class NewBinarySortableCVSSymbolDatabase(object):
+  """A serially-accessible, sortable file for holding CVSSymbols.
+
+  Each CVSSymbol is stored as a record in CVS_SYMBOL_RECORD_FORMAT
+  whose key contains its symbol's id and its own id.
+
+  PRESORT works as for NewSortableCVSRevisionDatabase.
+
+  This class creates such files."""
+
+  def __init__(self, filename, serializer, presort=False):
+    if presort:
+      self.f = SortedRunWriter(filename)
+    else:
+      self.f = open(filename, 'wb')
+    self.serializer = serializer
+
+  def add(self, cvs_symbol):
+    self.f.write(
+        CVS_SYMBOL_RECORD_FORMAT.pack(
+            _cvs_symbol_sort_key.pack(cvs_symbol.symbol.id, cvs_symbol.id),
+            self.serializer.dumps(cvs_symbol),
+            )
+        )
+
+  def close(self):
+    self.run_starts = self.f.close()
+    self.f = None
+
+
+class OldBinarySortableCVSSymbolDatabase(object):
+  """A serially-accessible, sortable file for holding CVSSymbols.
+
+  This class reads the files written by
+  NewBinarySortableCVSSymbolDatabase."""
+
+  def __init__(self, filename, serializer):
+    self.filename = filename
+    self.serializer = serializer
+
+  def __iter__(self):
+    f = open(self.filename, 'rb')
+    for record in CVS_SYMBOL_RECORD_FORMAT.iter_records(f):
+      yield self.serializer.loads(
+          CVS_SYMBOL_RECORD_FORMAT.get_payload(record)
+          )
+    f.close()
+
+  def close(self):
+    pass
+
+
+class ColumnarCVSItemStore(object):
+  """A store of CVSItems, indexed by id, that keeps fields in columns.
+
+  The fixed-width fields of the CVSItems (their type, the ids of their
+  file, LOD, and neighbors, their timestamp and metadata_id) are
+  stored in a column file, which is memory-mapped when reading.  The
+  other fields (revision numbers, lists of branch and tag ids,
+  properties, etc.) are serialized into a heap file, and the column
+  file records their location in the heap.
+
+  The column file consists of blocks of BLOCK_SIZE rows; row I
+  describes the CVSItem with id I.  Within a block, the values of
+  each column are stored contiguously, so that a column can be
+  scanned (see iter_column()) without touching the other columns or
+  the heap.  A row whose type is 0 is empty.  Gaps in the id sequence
+  therefore only cost space in the column file, which is filled with
+  zeros.
+
+  CVSItem objects are only created when they are requested, using the
+  classes' __setstate__() methods.  The store supports the subset of
+  the IndexedStore interface that is used for CVSItems: add(),
+  __getitem__(), get(), get_many(), iterkeys(), itervalues(),
+  __delitem__(), and close()."""
+
+  # The number of rows in each block of the column file:
+  BLOCK_SIZE = 1024
+
+  # The number of blocks to keep in memory while writing:
+  CACHE_BLOCKS = 256
+
+  # A list [(name, format)] of the columns, in the order that they
+  # appear within a block.  FORMAT is a struct format character.
+  # Columns with format 'I' store ids, and use _NONE to represent
+  # None.
+  COLUMNS = [
+      ('type', 'B'),
+      ('cvs_file_id', 'I'),
+      ('timestamp', 'q'),
+      ('metadata_id', 'I'),
+      ('lod_id', 'I'),
+      ('source_lod_id', 'I'),
+      ('prev_id', 'I'),
+      ('next_id', 'I'),
+      ('heap_offset', 'Q'),
+      ('heap_length', 'I'),
+      ]
+
+  _NONE = 0xffffffff
+
+  # A map {cvs_item_class : {column_name : state_index}}, telling
+  # which members of the tuple returned by each class's __getstate__()
+  # are stored in which columns.  The other members (except for the
+  # id, which is implied by the row number) are stored in the heap.
+  # The revision classes store their prev_id in the 'prev_id' column;
+  # the symbol classes store their source_id there.
+  _revision_columns = {
+      'cvs_file_id' : 1, 'timestamp' : 2, 'metadata_id' : 3,
+      'prev_id' : 4, 'next_id' : 5, 'lod_id' : 8,
+      }
+  _branch_columns = {
+      'cvs_file_id' : 1, 'lod_id' : 2, 'source_lod_id' : 4,
+      'prev_id' : 5, 'next_id' : 6,
+      }
+  _tag_columns = {
+      'cvs_file_id' : 1, 'lod_id' : 2, 'source_lod_id' : 3, 'prev_id' : 4,
+      }
+  _state_columns = {
+      CVSRevisionAdd : _revision_columns,
+      CVSRevisionChange : _revision_columns,
+      CVSRevisionDelete : _revision_columns,
+      CVSRevisionNoop : _revision_columns,
+      CVSBranch : _branch_columns,
+      CVSBranchNoop : _branch_columns,
+      CVSTag : _tag_columns,
+      CVSTagNoop : _tag_columns,
+      }
+
+  def __init__(self, filename, index_filename, mode):
+    """Open a store with heap file FILENAME and column file INDEX_FILENAME."""
+
+    self.filename = filename
+    self.index_filename = index_filename
+    self.mode = mode
+
+    # The list of CVSItem classes; a row's type is one more than the
+    # index of its class in this list:
+    self._types = list(cvs_item_primer)
+
+    # A map {column_name : (format, offset_within_block, width)}:
+    self._columns = {}
+    offset = 0
+    for (name, format) in self.COLUMNS:
+      width = struct.calcsize('<' + format)
+      self._columns[name] = ('<' + format, offset, width)
+      offset += width * self.BLOCK_SIZE
+    self._block_len = offset
+    self._row_len = offset // self.BLOCK_SIZE
+
+    # A map {cls : [(column_name, state_index)]}:
+    self._layouts = {}
+    for (cls, state_columns) in self._state_columns.items():
+      self._layouts[cls] = state_columns.items()
+
+    # A cache of the return values of _get_heap_indexes():
+    self._heap_indexes = {}
+
+    if self.mode == DB_OPEN_NEW:
+      self.f = open(self.filename, 'wb+')
+      self.column_file = open(self.index_filename, 'wb+')
+    elif self.mode == DB_OPEN_WRITE:
+      self.f = open(self.filename, 'rb+')
+      self.column_file = open(self.index_filename, 'rb+')
+    elif self.mode == DB_OPEN_READ:
+      self.f = open(self.filename, 'rb')
+      self.column_file = open(self.index_filename, 'rb')
+    else:
+      raise RuntimeError('Invalid mode %r' % self.mode)
+
+    # The number of blocks in the column file:
+    self._block_count = (
+        (os.path.getsize(self.index_filename) + self._block_len - 1)
+        // self._block_len
+        )
+
+    if self.mode == DB_OPEN_READ:
+      self._heap = self._map(self.f)
+      self._column_map = self._map(self.column_file)
+    else:
+      self.f.seek(0, 2)
+      self._heap_end = self.f.tell()
+      self._heap = None
+      self._column_map = None
+
+    # When writing: a map {block_number : bytearray} of the blocks
+    # that are held in memory.  All of them are written to disk when
+    # the cache fills up.
+    self._blocks = {}
+
+  def _get_heap_indexes(self, cls, state_len):
+    """Return the indexes of the state members of CLS that are in the heap.
+
+    STATE_LEN is the length of the state tuple."""
+
+    key = (cls, state_len)
+    try:
+      return self._heap_indexes[key]
+    except KeyError:
+      in_columns = set([i for (name, i) in self._layouts[cls]])
+      heap_indexes = [i for i in xrange(1, state_len) if i not in in_columns]
+      self._heap_indexes[key] = heap_indexes
+      return heap_indexes
+
+  @staticmethod
+  def _map(f):
+    size = os.fstat(f.fileno()).st_size
+    if size == 0:
+      return ''
+    else:
+      return mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+
+  def _flush_blocks(self):
+    blocks = self._blocks.items()
+    blocks.sort()
+    for (block_number, block) in blocks:
+      self.column_file.seek(block_number * self._block_len)
+      self.column_file.write(str(block))
+    self.column_file.flush()
+    self._blocks.clear()
+
+  def _get_block(self, block_number):
+    """Return the block with number BLOCK_NUMBER as a bytearray.
+
+    This method is only used when writing."""
+
+    try:
+      return self._blocks[block_number]
+    except KeyError:
+      if len(self._blocks) >= self.CACHE_BLOCKS:
+        self._flush_blocks()
+      if block_number < self._block_count:
+        self.column_file.seek(block_number * self._block_len)
+        s = self.column_file.read(self._block_len)
+      else:
+        s = ''
+      block = bytearray(s)
+      block.extend('\0' * (self._block_len - len(block)))
+      self._blocks[block_number] = block
+      self._block_count = max(self._block_count, block_number + 1)
+      return block
+
+  def _locate(self, id):
+    """Return (buffer, offset_of_block) for the row of ID.
+
+    Raise KeyError if the row is outside of the column file."""
+
+    if id < 0:
+      raise KeyError(id)
+    (block_number, row) = divmod(id, self.BLOCK_SIZE)
+    if self._column_map is not None:
+      if block_number >= self._block_count:
+        raise KeyError(id)
+      return (self._column_map, block_number * self._block_len, row)
+    elif block_number in self._blocks or block_number < self._block_count:
+      return (self._get_block(block_number), 0, row)
+    else:
+      raise KeyError(id)
+
+  def _get_value(self, buf, block_offset, row, name):
+    (format, offset, width) = self._columns[name]
+    value = struct.unpack_from(
+        format, buf, block_offset + offset + row * width
+        )[0]
+    if value == self._NONE and format == '<I':
+      return None
+    return value
+
+  def add(self, cvs_item):
+    """Write CVS_ITEM into the store, indexed by CVS_ITEM.id."""
+
+    self[cvs_item.id] = cvs_item
+
+  def __setitem__(self, id, cvs_item):
+    if self.mode == DB_OPEN_READ:
+      raise RuntimeError('%s is open for reading' % (self,))
+    if id < 0:
+      raise KeyError(id)
+
+    cls = type(cvs_item)
+    column_indexes = self._layouts[cls]
+    state = cvs_item.__getstate__()
+
+    heap_state = tuple([
+        state[i]
+        for i in self._get_heap_indexes(cls, len(state))
+        ])
+    try:
+      s = 'm' + marshal.dumps(heap_state)
+    except ValueError:
+      # Some item contains objects that marshal cannot handle:
+      s = 'p' + cPickle.dumps(heap_state, -1)
+    self.f.seek(self._heap_end)
+    self.f.write(s)
+
+    values = [
+        ('type', self._types.index(cls) + 1),
+        ('heap_offset', self._heap_end),
+        ('heap_length', len(s)),
+        ]
+    self._heap_end += len(s)
+    for (name, i) in column_indexes:
+      value = state[i]
+      if value is None:
+        value = self._NONE
+      values.append((name, value))
+
+    (block_number, row) = divmod(id, self.BLOCK_SIZE)
+    block = self._get_block(block_number)
+    for (name, value) in values:
+      (format, offset, width) = self._columns[name]
+      struct.pack_into(format, block, offset + row * width, value)
+
+  def _load(self, id, buf, block_offset, row):
+    """Return the CVSItem in ROW of the block at BLOCK_OFFSET in BUF.
+
+    Raise KeyError(ID) if the row is empty."""
+
+    type_code = self._get_value(buf, block_offset, row, 'type')
+    if type_code == 0:
+      raise KeyError(id)
+    cls = self._types[type_code - 1]
+    column_indexes = self._layouts[cls]
+
+    heap_offset = self._get_value(buf, block_offset, row, 'heap_offset')
+    heap_length = self._get_value(buf, block_offset, row, 'heap_length')
+    if self._column_map is not None:
+      s = self._heap[heap_offset:heap_offset + heap_length]
+    else:
+      self.f.seek(heap_offset)
+      s = self.f.read(heap_length)
+    if s[0] == 'm':
+      heap_state = marshal.loads(s[1:])
+    else:
+      heap_state = cPickle.loads(s[1:])
+
+    state_len = 1 + len(column_indexes) + len(heap_state)
+    state = [None] * state_len
+    state[0] = id
+    for (name, i) in column_indexes:
+      state[i] = self._get_value(buf, block_offset, row, name)
+    heap_indexes = self._get_heap_indexes(cls, state_len)
+    for (i, value) in zip(heap_indexes, heap_state):
+      state[i] = value
+
+    cvs_item = cls.__new__(cls)
+    cvs_item.__setstate__(tuple(state))
+    return cvs_item
+
+  def __getitem__(self, id):
+    (buf, block_offset, row) = self._locate(id)
+    return self._load(id, buf, block_offset, row)
+
+  def get(self, id, default=None):
+    try:
+      return self[id]
+    except KeyError:
+      return default
+
+  def get_many(self, ids, default=None):
+    """Yield (id, cvs_item) tuples for IDS, in arbitrary order.
+
+    Yield (id, default) for ids with no defined values."""
+
+    # Like IndexedDatabase, yield the items in the order in which they
+    # were written (which also reads the heap sequentially):
+    rows = []
+    for id in ids:
+      try:
+        (buf, block_offset, row) = self._locate(id)
+      except KeyError:
+        yield (id, default)
+        continue
+      if self._get_value(buf, block_offset, row, 'type') == 0:
+        yield (id, default)
+      else:
+        heap_offset = self._get_value(buf, block_offset, row, 'heap_offset')
+        rows.append((heap_offset, id))
+
+    rows.sort()
+    for (heap_offset, id) in rows:
+      yield (id, self[id])
+
+  def iter_in_offset_order(self):
+    """Yield (id, cvs_item) tuples for all CVSItems, in heap order."""
+
+    return self.get_many(self.iterkeys())
+
+  def __delitem__(self, id):
+    # As with IndexedDatabase, the space in the heap is not reclaimed.
+    self[id]
+    (block_number, row) = divmod(id, self.BLOCK_SIZE)
+    (format, offset, width) = self._columns['type']
+    struct.pack_into(
+        format, self._get_block(block_number), offset + row * width, 0
+        )
+
+  def _iter_rows(self):
+    """Yield (id, buf, block_offset, row) for each non-empty row."""
+
+    for block_number in xrange(self._block_count):
+      if self._column_map is not None:
+        buf = self._column_map
+        block_offset = block_number * self._block_len
+      else:
+        buf = self._get_block(block_number)
+        block_offset = 0
+      (format, offset, width) = self._columns['type']
+      types = buf[
+          block_offset + offset:block_offset + offset + self.BLOCK_SIZE * width
+          ]
+      for row in xrange(self.BLOCK_SIZE):
+        if types[row] != '\0' and types[row] != 0:
+          yield (
+              block_number * self.BLOCK_SIZE + row, buf, block_offset, row
+              )
+
+  def iter_column(self, name):
+    """Yield (id, value) for the column NAME of each stored CVSItem.
+
+    The values are read from the column file without creating CVSItem
+    objects.  The meaning of a column depends on the type of the
+    CVSItem; see _state_columns.  Values that do not apply to a
+    CVSItem are 0 or None."""
+
+    for (id, buf, block_offset, row) in self._iter_rows():
+      yield (id, self._get_value(buf, block_offset, row, name))
+
+  def iterkeys(self):
+    for (id, buf, block_offset, row) in self._iter_rows():
+      yield id
+
+  def itervalues(self):
+    for (id, buf, block_offset, row) in self._iter_rows():
+      yield self._load(id, buf, block_offset, row)
+
+  def close(self):
+    if self._column_map is None:
+      self._flush_blocks()
+    else:
+      if self._column_map:
+        self._column_map.close()
+      if self._heap:
+        self._heap.close()
+    self._blocks = None
+    self._column_map = None
+    self._heap = None
+    self.column_file.close()
+    self.column_file = None
+    self.f.close()
+    self.f = None
+
+  def __str__(self):
+    return 'ColumnarCVSItemStore(%r)' % (self.filename,)
+
+
 def IndexedCVSItemStore(filename, index_filename, mode):
-  return IndexedStore(
-      filename, index_filename, mode,
-      PrimedPickleSerializer(cvs_item_primer)
-      )
+  """Return a store for CVSItems indexed by id.
+
+  The type of the store depends on Ctx().columnar_cvs_item_store."""
+
+  if Ctx().columnar_cvs_item_store:
+    return ColumnarCVSItemStore(filename, index_filename, mode)
+  else:
+    return IndexedStore(
+        filename, index_filename, mode, get_cvs_item_serializer(),
+        buffered=True,
+        )
 
 
@@ -14,13 +14,17 @@
 """This module contains database facilities used by cvs2svn."""
 
 
+import os
 import cPickle
+import cStringIO
+from array import array
 
 from cvs2svn_lib.common import DB_OPEN_READ
 from cvs2svn_lib.common import DB_OPEN_WRITE
 from cvs2svn_lib.common import DB_OPEN_NEW
+from cvs2svn_lib.log import logger
 from cvs2svn_lib.record_table import FileOffsetPacker
-from cvs2svn_lib.record_table import RecordTable
+from cvs2svn_lib.record_table import IndexTable
 
 
 class IndexedDatabase:
@@ -44,17 +48,78 @@ class IndexedDatabase:
   advantage that one can create a modified version of a database that
   shares the main data file with an old version by copying the index
   file.  But it has the disadvantage that space is wasted whenever
-  objects are written multiple times."""
-
-  def __init__(self, filename, index_filename, mode, serializer=None):
+  objects are written multiple times.  get_space_usage() reports how
+  much of the file is taken up by live and by dead objects, and
+  compact() rewrites the file without the dead ones.  If
+  COMPACT_MIN_DEAD_BYTES and COMPACT_DEAD_FRACTION are passed to the
+  constructor, a database that was opened for writing is compacted
+  when it is closed if the dead objects take up at least
+  COMPACT_MIN_DEAD_BYTES bytes and more than COMPACT_DEAD_FRACTION of
+  the file.  (Compaction of course breaks the sharing of the data file
+  described above, so it must not be used with such databases.)
+
+  If the database is opened with BUFFERED=True, new objects are
+  collected in memory and written to the file in large chunks, and
+  objects are read out of a bounded pool of large, aligned blocks of
+  the file rather than by seeking the file for each object.  This
+  requires a serializer whose loadf() method can read from any
+  file-like object and raises an exception if the data end before the
+  object is complete.  The exception is not necessarily EOFError (for
+  example, cPickle raises UnpicklingError if a text opcode is cut
+  off), so if an object cannot be read from the blocks in memory it
+  is read directly from the file instead."""
+
+  # The number of bytes of serialized objects to collect before
+  # writing them to the file (if BUFFERED):
+  WRITE_BUFFER_SIZE = 1024 * 1024
+
+  # The size of the blocks that are read from the file (if BUFFERED):
+  BLOCK_SIZE = 64 * 1024
+
+  # The maximum number of blocks to keep in memory (if BUFFERED):
+  CACHE_BLOCKS = 64
+
+  # iter_in_offset_order() sorts the index entries of each region of
+  # the file of this size separately, to limit its memory usage:
+  SCAN_REGION_SIZE = 16 * 1024 * 1024
+
+  def __init__(
+        self, filename, index_filename, mode, serializer=None, buffered=False,
+        compact_min_dead_bytes=None, compact_dead_fraction=None,
+        ):
     """Initialize an IndexedDatabase, writing the serializer if necessary.
 
     SERIALIZER is only used if MODE is DB_OPEN_NEW; otherwise the
-    serializer is read from the file."""
+    serializer is read from the file.  If BUFFERED is True, buffer the
+    reads and writes as described in the class docstring.  If
+    COMPACT_MIN_DEAD_BYTES and COMPACT_DEAD_FRACTION are set, compact
+    the database when it is closed as described in the class
+    docstring."""
 
     self.filename = filename
     self.index_filename = index_filename
     self.mode = mode
+    self.buffered = buffered
+    self.compact_min_dead_bytes = compact_min_dead_bytes
+    self.compact_dead_fraction = compact_dead_fraction
+    self._open(serializer)
+
+    if self.mode == DB_OPEN_NEW:
+      # There are no objects yet, so the space accounting can start
+      # right away:
+      self._lengths = array('I')
+      self._live_bytes = 0
+    else:
+      # The lengths of the existing objects are only determined (by
+      # reading them) if get_space_usage() is called:
+      self._lengths = None
+      self._live_bytes = None
+
+  def _open(self, serializer=None):
+    """Open the data and index files in self.mode.
+
+    SERIALIZER is only used if self.mode is DB_OPEN_NEW."""
+
     if self.mode == DB_OPEN_NEW:
       self.f = open(self.filename, 'wb+')
     elif self.mode == DB_OPEN_WRITE:
@@ -64,7 +129,7 @@ class IndexedDatabase:
     else:
       raise RuntimeError('Invalid mode %r' % self.mode)
 
-    self.index_table = RecordTable(
+    self.index_table = IndexTable(
         self.index_filename, self.mode, FileOffsetPacker()
         )
 
@@ -76,24 +141,189 @@ class IndexedDatabase:
       # Read the memo from the first pickle:
       self.serializer = cPickle.load(self.f)
 
+    # The offset of the first object:
+    self._data_start = self.f.tell()
+
     # Seek to the end of the file, and record that position:
     self.f.seek(0, 2)
     self.fp = self.f.tell()
     self.eofp = self.fp
 
+    # Serialized objects that have not yet been written to the file,
+    # their total size, and the size of the file itself (self.eofp
+    # includes the objects in the buffer):
+    self._write_buffer = []
+    self._write_buffer_size = 0
+    self._flushed_eofp = self.eofp
+
+    # A map {block_number : data} of the blocks of the file that are
+    # in memory.  The last block of the file might be shorter than
+    # BLOCK_SIZE.
+    self._blocks = {}
+
+    # A map {block_number : tick} recording when each block in
+    # self._blocks was last used:
+    self._last_used = {}
+    self._tick = 0
+
   def __setitem__(self, index, item):
     """Write ITEM into the database indexed by INDEX."""
 
+    if self.buffered:
+      self.index_table[index] = self.eofp
+      s = self.serializer.dumps(item)
+      self._record_length(index, len(s))
+      self._write_buffer.append(s)
+      self._write_buffer_size += len(s)
+      self.eofp += len(s)
+      if self._write_buffer_size >= self.WRITE_BUFFER_SIZE:
+        self.flush()
+      return
+
     # Make sure we're at the end of the file:
     if self.fp != self.eofp:
       self.f.seek(self.eofp)
     self.index_table[index] = self.eofp
     s = self.serializer.dumps(item)
+    self._record_length(index, len(s))
     self.f.write(s)
     self.eofp += len(s)
     self.fp = self.eofp
 
+  def _record_length(self, index, length):
+    """Record that the object for INDEX is now LENGTH bytes long.
+
+    LENGTH is 0 if the object was deleted.  Update the space
+    accounting, if it is being done."""
+
+    if self._lengths is None:
+      return
+
+    if index >= len(self._lengths):
+      self._lengths.extend(
+          array('I', [0]) * (index + 1 - len(self._lengths))
+          )
+    self._live_bytes += length - self._lengths[index]
+    self._lengths[index] = length
+
+  def flush(self):
+    """Write any buffered objects to the file."""
+
+    if not self._write_buffer:
+      return
+
+    self.f.seek(self._flushed_eofp)
+    self.f.write(''.join(self._write_buffer))
+    self.fp = None
+    self._write_buffer = []
+    self._write_buffer_size = 0
+
+    # The block that used to be the last one in the file might be in
+    # memory without the data that were just written:
+    block_number = self._flushed_eofp // self.BLOCK_SIZE
+    if block_number in self._blocks:
+      del self._blocks[block_number]
+      del self._last_used[block_number]
+
+    self._flushed_eofp = self.eofp
+
+  def _evict(self, count):
+    """Discard blocks to make room for COUNT more blocks in memory.
+
+    Discard the least recently used quarter of the blocks (or more if
+    necessary)."""
+
+    excess = len(self._blocks) + count - self.CACHE_BLOCKS
+    if excess <= 0:
+      return
+
+    excess = max(excess, self.CACHE_BLOCKS // 4)
+    blocks = [
+        (tick, block_number)
+        for (block_number, tick) in self._last_used.iteritems()
+        ]
+    blocks.sort()
+    for (tick, block_number) in blocks[:excess]:
+      del self._blocks[block_number]
+      del self._last_used[block_number]
+
+  def _get_blocks(self, first, count):
+    """Return the concatenated data of COUNT blocks starting with FIRST.
+
+    Read any blocks that are not in memory, reading each run of
+    consecutive missing blocks with a single read."""
+
+    missing = [
+        block_number
+        for block_number in xrange(first, first + count)
+        if block_number not in self._blocks
+        ]
+    if missing:
+      self._evict(len(missing))
+      i = 0
+      while i < len(missing):
+        j = i + 1
+        while j < len(missing) and missing[j] == missing[j - 1] + 1:
+          j += 1
+        self.f.seek(missing[i] * self.BLOCK_SIZE)
+        data = self.f.read((j - i) * self.BLOCK_SIZE)
+        for k in xrange(i, j):
+          start = (k - i) * self.BLOCK_SIZE
+          self._blocks[missing[k]] = data[start:start + self.BLOCK_SIZE]
+        i = j
+      self.fp = None
+
+    self._tick += 1
+    for block_number in xrange(first, first + count):
+      self._last_used[block_number] = self._tick
+
+    if count == 1:
+      return self._blocks[first]
+    else:
+      return ''.join([
+          self._blocks[block_number]
+          for block_number in xrange(first, first + count)
+          ])
+
+  def _load(self, offset):
+    """Read the object at OFFSET by way of the blocks in memory."""
+
+    if offset >= self._flushed_eofp:
+      self.flush()
+
+    first = offset // self.BLOCK_SIZE
+    count = 1
+    while True:
+      f = cStringIO.StringIO(self._get_blocks(first, count))
+      f.seek(offset - first * self.BLOCK_SIZE)
+      try:
+        return self.serializer.loadf(f)
+      except EOFError:
+        # The object extends past the blocks that were read.
+        if (first + count) * self.BLOCK_SIZE >= self._flushed_eofp:
+          raise
+        count *= 2
+        if count > self.CACHE_BLOCKS // 4:
+          # The object is too large to be read through the block
+          # pool:
+          break
+      except Exception:
+        # The serializer may report an object that is cut off at the
+        # end of the blocks with other exceptions, too.  If the blocks
+        # contained the rest of the file, the object is really broken:
+        if (first + count) * self.BLOCK_SIZE >= self._flushed_eofp:
+          raise
+        break
+
+    # Read the object directly from the file:
+    self.f.seek(offset)
+    self.fp = None
+    return self.serializer.loadf(self.f)
+
   def _fetch(self, offset):
+    if self.buffered:
+      return self._load(offset)
+
     if self.fp != offset:
       self.f.seek(offset)
 
@@ -137,11 +367,152 @@ class IndexedDatabase:
     for (offset,index) in offsets:
       yield (index, self._fetch(offset))
 
+  def iter_in_offset_order(self):
+    """Yield (index, item) tuples for all items, in file offset order.
+
+    This reads the file sequentially, which is much faster than
+    reading the items in index order if they were not written in index
+    order.  The index entries are sorted one SCAN_REGION_SIZE region of
+    the file at a time, so that not all of them have to be sorted in
+    memory at once."""
+
+    self.flush()
+
+    region_count = self.eofp // self.SCAN_REGION_SIZE + 1
+    regions = [None] * region_count
+    for (index, offset) in self.index_table.iteritems():
+      (region_number, relative_offset) = divmod(offset, self.SCAN_REGION_SIZE)
+      region = regions[region_number]
+      if region is None:
+        region = regions[region_number] = (array('L'), array('L'),)
+      region[0].append(relative_offset)
+      region[1].append(index)
+
+    for region_number in xrange(region_count):
+      region = regions[region_number]
+      if region is None:
+        continue
+      regions[region_number] = None
+      entries = zip(region[0], region[1])
+      del region
+      entries.sort()
+      base = region_number * self.SCAN_REGION_SIZE
+      for (relative_offset, index) in entries:
+        yield (index, self._fetch(base + relative_offset))
+
   def __delitem__(self, index):
-    # We don't actually free the data in self.f.
+    # We don't actually free the data in self.f, but it is counted as
+    # dead space:
     del self.index_table[index]
+    self._record_length(index, 0)
+
+  def _scan_lengths(self):
+    """Determine the lengths of all live objects by reading them.
+
+    This starts the space accounting for a database that was not
+    created by this instance."""
+
+    self.flush()
+    self._lengths = array('I')
+    self._live_bytes = 0
+    for (index, offset) in self.index_table.iteritems():
+      self.f.seek(offset)
+      self.serializer.loadf(self.f)
+      self._record_length(index, self.f.tell() - offset)
+    self.fp = None
+
+  def get_space_usage(self):
+    """Return (live_bytes, dead_bytes) for the objects in the file.
+
+    LIVE_BYTES is the total size of the objects that can still be
+    reached through the index; DEAD_BYTES is the size of the objects
+    that were deleted or overwritten.  (The serializer at the start of
+    the file is not counted.)  If the database was not created by this
+    instance, the first call has to read all of the objects."""
+
+    if self._lengths is None:
+      self._scan_lengths()
+
+    return (
+        self._live_bytes,
+        self.eofp - self._data_start - self._live_bytes,
+        )
+
+  def compact(self):
+    """Rewrite the file, leaving out the deleted and overwritten objects.
+
+    The live objects are copied, in index order, into new data and
+    index files, which are then renamed over the old ones.  If
+    anything goes wrong before then, the old files are left intact."""
+
+    if self.mode == DB_OPEN_READ:
+      raise RuntimeError('Cannot compact %s, opened read-only' % (self,))
+
+    (live_bytes, dead_bytes) = self.get_space_usage()
+
+    self.flush()
+    new_filename = self.filename + '.compact'
+    new_index_filename = self.index_filename + '.compact'
+    new_f = open(new_filename, 'wb')
+    new_index_table = IndexTable(
+        new_index_filename, DB_OPEN_NEW, FileOffsetPacker()
+        )
+    try:
+      cPickle.dump(self.serializer, new_f, -1)
+      new_eofp = new_f.tell()
+      pending = []
+      pending_size = 0
+      for (index, offset) in self.index_table.iteritems():
+        length = self._lengths[index]
+        self.f.seek(offset)
+        pending.append(self.f.read(length))
+        pending_size += length
+        new_index_table[index] = new_eofp
+        new_eofp += length
+        if pending_size >= self.WRITE_BUFFER_SIZE:
+          new_f.write(''.join(pending))
+          pending = []
+          pending_size = 0
+      new_f.write(''.join(pending))
+    finally:
+      new_f.close()
+      new_index_table.close()
+
+    self.index_table.close()
+    self.f.close()
+    os.rename(new_filename, self.filename)
+    os.rename(new_index_filename, self.index_filename)
+
+    logger.verbose(
+        '%s: compaction reclaimed %d bytes, keeping %d bytes'
+        % (self, dead_bytes, live_bytes,)
+        )
+
+    # The new files have to be opened for writing even if this
+    # instance created the database:
+    self.mode = DB_OPEN_WRITE
+    self._open()
+
+  def _wants_compaction(self):
+    """Return True iff the database should be compacted when closed."""
+
+    if self.mode == DB_OPEN_READ or self.compact_min_dead_bytes is None:
+      return False
+
+    dead_bytes = self.get_space_usage()[1]
+    return (
+        dead_bytes >= self.compact_min_dead_bytes
+        and dead_bytes > self.compact_dead_fraction * (
+            self.eofp - self._data_start
+            )
+        )
 
   def close(self):
+    if self._wants_compaction():
+      self.compact()
+    self.flush()
+    self._blocks = None
+    self._last_used = None
     self.index_table.close()
     self.index_table = None
     self.f.close()
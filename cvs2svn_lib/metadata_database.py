@@ -37,7 +37,7 @@ def MetadataDatabase(store_filename, index_table_filename, mode):
 
   return IndexedDatabase(
       store_filename, index_table_filename,
-      mode, PrimedPickleSerializer((Metadata,)),
+      mode, PrimedPickleSerializer((Metadata,)), buffered=True,
       )
 
 
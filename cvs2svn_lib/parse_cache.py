@@ -0,0 +1,233 @@
+# (Be in -*- python -*- mode.)
+#
+# ====================================================================
+# Copyright (c) 2000-2009 CollabNet.  All rights reserved.
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution.
+#
+# This software consists of voluntary contributions made by many
+# individuals.  For exact contribution history, see the revision
+# history and logs.
+# ====================================================================
+
+"""A persistent cache of the results of parsing *,v files.
+
+When the same CVS repository is converted repeatedly (for example,
+while tuning the symbol strategy rules), most of the time spent in
+CollectRevsPass goes into parsing *,v files that have not changed
+since the previous run.  A ParseCache remembers the parse results of
+each file in a directory that survives between conversions, so that
+unchanged files do not have to be parsed again.
+
+Each cached file is identified by its absolute path; the cached
+results are only used if the file's size, modification time, and
+inode number (and optionally the SHA-1 checksum of its contents) are
+the same as when the results were stored.
+
+The cache directory contains one file per cached *,v file, plus an
+index file that records the size and the last use of each entry.  The
+index is used to evict the least recently used entries when the cache
+grows larger than its size limit.  A cache should not be used by more
+than one conversion at a time."""
+
+
+import os
+import cPickle
+
+try:
+  from hashlib import sha1
+except ImportError:
+  from sha import new as sha1
+
+from cvs2svn_lib.common import FatalError
+from cvs2svn_lib.log import logger
+
+
+# The basename of the index file within the cache directory:
+INDEX_FILENAME = 'index.pck'
+
+
+class ParseCache:
+  """An on-disk cache of parse results, keyed by *,v file."""
+
+  def __init__(self, directory, fingerprint, max_size=None, checksums=False):
+    """Open the cache in DIRECTORY, creating it if necessary.
+
+    FINGERPRINT is a picklable value that describes the format of the
+    parse results stored in the cache.  If it differs from the value
+    recorded in an existing cache, the old entries are discarded.
+    MAX_SIZE is the maximum total size of the cache entries in bytes,
+    or None if the size of the cache should not be limited.  If
+    CHECKSUMS is True, cached results are only used if the SHA-1
+    checksum of the file's contents also matches."""
+
+    self.directory = directory
+    self.fingerprint = fingerprint
+    self.max_size = max_size
+    self.checksums = checksums
+
+    if not os.path.isdir(self.directory):
+      try:
+        os.makedirs(self.directory)
+      except OSError, e:
+        raise FatalError(
+            'Cannot create parse cache directory %r: %s'
+            % (self.directory, e,)
+            )
+
+    # A map { key : (size, generation) } describing the entries that
+    # are in the cache.  SIZE is the size of the entry file in bytes;
+    # GENERATION is the value of self.generation during the last run
+    # that used the entry.
+    self._entries = {}
+
+    # The number of the current run, used to find the least recently
+    # used entries:
+    self.generation = 1
+
+    index_filename = os.path.join(self.directory, INDEX_FILENAME)
+    if os.path.exists(index_filename):
+      f = open(index_filename, 'rb')
+      try:
+        (fingerprint, generation, entries) = cPickle.load(f)
+      finally:
+        f.close()
+      if fingerprint == self.fingerprint:
+        self.generation = generation + 1
+        self._entries = entries
+      else:
+        logger.normal(
+            'The format of the parse cache has changed; discarding it.'
+            )
+        for key in entries:
+          self._remove_entry_file(key)
+
+    self.hits = 0
+    self.misses = 0
+
+  def _get_key(self, rcs_path):
+    return sha1(os.path.abspath(rcs_path)).hexdigest()
+
+  def _get_entry_filename(self, key):
+    return os.path.join(self.directory, key[:2], key[2:])
+
+  def _remove_entry_file(self, key):
+    try:
+      os.remove(self._get_entry_filename(key))
+    except OSError:
+      pass
+
+  def _get_file_id(self, rcs_path):
+    """Return a value that changes whenever the file at RCS_PATH changes."""
+
+    st = os.stat(rcs_path)
+    file_id = (st.st_size, st.st_mtime, st.st_ino,)
+    if self.checksums:
+      f = open(rcs_path, 'rb')
+      try:
+        file_id += (sha1(f.read()).hexdigest(),)
+      finally:
+        f.close()
+    return file_id
+
+  def get(self, rcs_path):
+    """Return (parse_results, file_id) for RCS_PATH.
+
+    FILE_ID identifies the current contents of the file.  PARSE_RESULTS
+    are the cached parse results, or None if the file is not in the
+    cache or if it has changed since its results were stored.  In the
+    latter case, the file should be parsed and its results stored
+    using put(), passing it FILE_ID; since FILE_ID was determined
+    before the parse, a change to the file during the parse causes
+    the next lookup to miss rather than to return stale results."""
+
+    file_id = self._get_file_id(rcs_path)
+    key = self._get_key(rcs_path)
+    if key in self._entries:
+      try:
+        f = open(self._get_entry_filename(key), 'rb')
+        try:
+          (cached_file_id, parse_results) = cPickle.load(f)
+        finally:
+          f.close()
+      except (IOError, EOFError, cPickle.UnpicklingError):
+        pass
+      else:
+        if cached_file_id == file_id:
+          (size, generation) = self._entries[key]
+          self._entries[key] = (size, self.generation)
+          self.hits += 1
+          return (parse_results, file_id)
+
+    self.misses += 1
+    return (None, file_id)
+
+  def put(self, rcs_path, file_id, parse_results):
+    """Store PARSE_RESULTS as the results of parsing RCS_PATH.
+
+    FILE_ID is the value that get() returned for RCS_PATH before the
+    file was parsed."""
+
+    key = self._get_key(rcs_path)
+    filename = self._get_entry_filename(key)
+    dirname = os.path.dirname(filename)
+    if not os.path.isdir(dirname):
+      os.mkdir(dirname)
+
+    # Write to a temporary file then rename it, so that an interrupted
+    # conversion cannot leave a partial entry behind:
+    tmp_filename = filename + '.tmp'
+    f = open(tmp_filename, 'wb')
+    try:
+      cPickle.dump((file_id, parse_results), f, -1)
+    finally:
+      f.close()
+    if os.path.exists(filename):
+      # (os.rename() cannot replace an existing file on Windows.)
+      os.remove(filename)
+    os.rename(tmp_filename, filename)
+
+    self._entries[key] = (os.path.getsize(filename), self.generation)
+
+  def _evict(self):
+    """Remove least recently used entries until the cache is small enough."""
+
+    total_size = sum([size for (size, generation) in self._entries.values()])
+    if total_size <= self.max_size:
+      return
+
+    entries = [
+        (generation, -size, key)
+        for (key, (size, generation)) in self._entries.iteritems()
+        ]
+    entries.sort()
+    for (generation, neg_size, key) in entries:
+      if total_size <= self.max_size:
+        break
+      self._remove_entry_file(key)
+      del self._entries[key]
+      total_size += neg_size
+
+  def close(self):
+    """Evict entries if necessary and write the index file."""
+
+    if self.max_size is not None:
+      self._evict()
+
+    logger.verbose(
+        'Parse cache: %d hits, %d misses' % (self.hits, self.misses,)
+        )
+
+    index_filename = os.path.join(self.directory, INDEX_FILENAME)
+    tmp_filename = index_filename + '.tmp'
+    f = open(tmp_filename, 'wb')
+    try:
+      cPickle.dump((self.fingerprint, self.generation, self._entries), f, -1)
+    finally:
+      f.close()
+    if os.path.exists(index_filename):
+      os.remove(index_filename)
+    os.rename(tmp_filename, index_filename)
+
+    self._entries = None
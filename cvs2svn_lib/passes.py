@@ -17,6 +17,8 @@
 import sys
 import shutil
 import cPickle
+import collections
+import multiprocessing
 
 from cvs2svn_lib import config
 from cvs2svn_lib.context import Ctx
@@ -29,9 +31,11 @@ from cvs2svn_lib.common import DB_OPEN_READ
 from cvs2svn_lib.common import DB_OPEN_WRITE
 from cvs2svn_lib.common import Timestamper
 from cvs2svn_lib.sort import sort_file
+from cvs2svn_lib.sort import merge_sorted_runs
+from cvs2svn_lib.sort import LINES
+from cvs2svn_lib.serializer import parse_compression_spec
 from cvs2svn_lib.log import logger
 from cvs2svn_lib.pass_manager import Pass
-from cvs2svn_lib.serializer import PrimedPickleSerializer
 from cvs2svn_lib.artifact_manager import artifact_manager
 from cvs2svn_lib.cvs_path_database import CVSPathDatabase
 from cvs2svn_lib.metadata_database import MetadataDatabase
@@ -52,18 +56,25 @@ from cvs2svn_lib.cvs_item import CVSRevision
 from cvs2svn_lib.cvs_item import CVSSymbol
 from cvs2svn_lib.cvs_item_database import OldCVSItemStore
 from cvs2svn_lib.cvs_item_database import IndexedCVSItemStore
-from cvs2svn_lib.cvs_item_database import cvs_item_primer
+from cvs2svn_lib.cvs_item_database import get_cvs_item_serializer
 from cvs2svn_lib.cvs_item_database import NewSortableCVSRevisionDatabase
 from cvs2svn_lib.cvs_item_database import OldSortableCVSRevisionDatabase
 from cvs2svn_lib.cvs_item_database import NewSortableCVSSymbolDatabase
 from cvs2svn_lib.cvs_item_database import OldSortableCVSSymbolDatabase
+from cvs2svn_lib.cvs_item_database import NewBinarySortableCVSRevisionDatabase
+from cvs2svn_lib.cvs_item_database import OldBinarySortableCVSRevisionDatabase
+from cvs2svn_lib.cvs_item_database import NewBinarySortableCVSSymbolDatabase
+from cvs2svn_lib.cvs_item_database import OldBinarySortableCVSSymbolDatabase
+from cvs2svn_lib.cvs_item_database import CVS_REVISION_RECORD_FORMAT
+from cvs2svn_lib.cvs_item_database import CVS_SYMBOL_RECORD_FORMAT
 from cvs2svn_lib.key_generator import KeyGenerator
 from cvs2svn_lib.changeset import RevisionChangeset
 from cvs2svn_lib.changeset import OrderedChangeset
 from cvs2svn_lib.changeset import SymbolChangeset
 from cvs2svn_lib.changeset import BranchChangeset
 from cvs2svn_lib.changeset import create_symbol_changeset
-from cvs2svn_lib.changeset_graph import ChangesetGraph
+from cvs2svn_lib.changeset_graph import create_changeset_graph
+from cvs2svn_lib.changeset_graph import SCCBreakerPool
 from cvs2svn_lib.changeset_graph_link import ChangesetGraphLink
 from cvs2svn_lib.changeset_database import ChangesetDatabase
 from cvs2svn_lib.changeset_database import CVSItemToChangesetTable
@@ -99,12 +110,18 @@ class CollectRevsPass(Pass):
     # Key generator for CVSFiles:
     file_key_generator = KeyGenerator()
 
-    for project in run_options.projects:
-      Ctx()._projects[project.id] = project
-      cd.process_project(
-          project,
-          walk_repository(project, file_key_generator, cd.record_fatal_error),
-          )
+    try:
+      for project in run_options.projects:
+        Ctx()._projects[project.id] = project
+        cd.process_project(
+            project,
+            walk_repository(
+                project, file_key_generator, cd.record_fatal_error
+                ),
+            )
+    except:
+      cd.terminate_workers()
+      raise
     run_options.projects = None
 
     fatal_errors = cd.close()
@@ -439,6 +456,8 @@ class FilterSymbolsPass(Pass):
     self._register_temp_file(config.ITEM_SERIALIZER)
     self._register_temp_file(config.CVS_REVS_DATAFILE)
     self._register_temp_file(config.CVS_SYMBOLS_DATAFILE)
+    self._register_temp_file(config.CVS_REVS_RUNS)
+    self._register_temp_file(config.CVS_SYMBOLS_RUNS)
     self._register_temp_file_needed(config.PROJECTS)
     self._register_temp_file_needed(config.SYMBOL_DB)
     self._register_temp_file_needed(config.METADATA_CLEAN_STORE)
@@ -461,19 +480,26 @@ class FilterSymbolsPass(Pass):
     cvs_item_store = OldCVSItemStore(
         artifact_manager.get_temp_file(config.CVS_ITEMS_STORE))
 
-    cvs_item_serializer = PrimedPickleSerializer(cvs_item_primer)
+    cvs_item_serializer = get_cvs_item_serializer()
     f = open(artifact_manager.get_temp_file(config.ITEM_SERIALIZER), 'wb')
     cPickle.dump(cvs_item_serializer, f, -1)
     f.close()
 
-    rev_db = NewSortableCVSRevisionDatabase(
+    if Ctx().binary_sortable_cvs_items:
+      new_rev_db = NewBinarySortableCVSRevisionDatabase
+      new_symbol_db = NewBinarySortableCVSSymbolDatabase
+    else:
+      new_rev_db = NewSortableCVSRevisionDatabase
+      new_symbol_db = NewSortableCVSSymbolDatabase
+
+    rev_db = new_rev_db(
         artifact_manager.get_temp_file(config.CVS_REVS_DATAFILE),
-        cvs_item_serializer,
+        cvs_item_serializer, presort=Ctx().presort_cvs_items,
         )
 
-    symbol_db = NewSortableCVSSymbolDatabase(
+    symbol_db = new_symbol_db(
         artifact_manager.get_temp_file(config.CVS_SYMBOLS_DATAFILE),
-        cvs_item_serializer,
+        cvs_item_serializer, presort=Ctx().presort_cvs_items,
         )
 
     revision_collector = Ctx().revision_collector
@@ -515,6 +541,16 @@ class FilterSymbolsPass(Pass):
 
     rev_db.close()
     symbol_db.close()
+
+    # Record where the sorted runs are (if any) for the sort passes:
+    for (filename, db) in [
+          (config.CVS_REVS_RUNS, rev_db),
+          (config.CVS_SYMBOLS_RUNS, symbol_db),
+          ]:
+      f = open(artifact_manager.get_temp_file(filename), 'wb')
+      cPickle.dump(db.run_starts, f, -1)
+      f.close()
+
     revision_collector.finish()
     cvs_item_store.close()
     Ctx()._symbol_db.close()
@@ -523,21 +559,73 @@ class FilterSymbolsPass(Pass):
     logger.quiet("Done")
 
 
+def _get_sort_options():
+  """Return the keyword arguments for sort_file() that come from Ctx."""
+
+  ctx = Ctx()
+  compression = None
+  if ctx.sort_compression is not None:
+    compression = parse_compression_spec(ctx.sort_compression)
+    if compression[0] == 'none':
+      compression = None
+  return dict(
+      tempdirs=[ctx.tmpdir] + list(ctx.sort_tmpdirs),
+      jobs=ctx.sort_jobs,
+      compression=compression,
+      memory_limit=ctx.sort_memory_limit,
+      )
+
+
+def _sort_cvs_items(input, output, runs, record_format):
+  """Sort the sortable CVSItem file INPUT into file OUTPUT.
+
+  RUNS is the name of the temporary file holding the offsets of the
+  sorted runs in INPUT, as recorded by FilterSymbolsPass.  If INPUT
+  was written as sorted runs, only merge them; otherwise sort the
+  whole file."""
+
+  f = open(artifact_manager.get_temp_file(runs), 'rb')
+  run_starts = cPickle.load(f)
+  f.close()
+
+  sort_options = _get_sort_options()
+  if run_starts is None:
+    sort_file(
+        artifact_manager.get_temp_file(input),
+        artifact_manager.get_temp_file(output),
+        record_format=record_format,
+        **sort_options
+        )
+  else:
+    merge_sorted_runs(
+        artifact_manager.get_temp_file(input),
+        run_starts,
+        artifact_manager.get_temp_file(output),
+        tempdirs=sort_options['tempdirs'],
+        record_format=record_format,
+        compression=sort_options['compression'],
+        )
+
+
 class SortRevisionsPass(Pass):
   """Sort the revisions file."""
 
   def register_artifacts(self):
     self._register_temp_file(config.CVS_REVS_SORTED_DATAFILE)
     self._register_temp_file_needed(config.CVS_REVS_DATAFILE)
+    self._register_temp_file_needed(config.CVS_REVS_RUNS)
 
   def run(self, run_options, stats_keeper):
     logger.quiet("Sorting CVS revision summaries...")
-    sort_file(
-        artifact_manager.get_temp_file(config.CVS_REVS_DATAFILE),
-        artifact_manager.get_temp_file(
-            config.CVS_REVS_SORTED_DATAFILE
-            ),
-        tempdirs=[Ctx().tmpdir],
+    if Ctx().binary_sortable_cvs_items:
+      record_format = CVS_REVISION_RECORD_FORMAT
+    else:
+      record_format = LINES
+    _sort_cvs_items(
+        config.CVS_REVS_DATAFILE,
+        config.CVS_REVS_SORTED_DATAFILE,
+        config.CVS_REVS_RUNS,
+        record_format,
         )
     logger.quiet("Done")
 
@@ -548,15 +636,19 @@ class SortSymbolsPass(Pass):
   def register_artifacts(self):
     self._register_temp_file(config.CVS_SYMBOLS_SORTED_DATAFILE)
     self._register_temp_file_needed(config.CVS_SYMBOLS_DATAFILE)
+    self._register_temp_file_needed(config.CVS_SYMBOLS_RUNS)
 
   def run(self, run_options, stats_keeper):
     logger.quiet("Sorting CVS symbol summaries...")
-    sort_file(
-        artifact_manager.get_temp_file(config.CVS_SYMBOLS_DATAFILE),
-        artifact_manager.get_temp_file(
-            config.CVS_SYMBOLS_SORTED_DATAFILE
-            ),
-        tempdirs=[Ctx().tmpdir],
+    if Ctx().binary_sortable_cvs_items:
+      record_format = CVS_SYMBOL_RECORD_FORMAT
+    else:
+      record_format = LINES
+    _sort_cvs_items(
+        config.CVS_SYMBOLS_DATAFILE,
+        config.CVS_SYMBOLS_SORTED_DATAFILE,
+        config.CVS_SYMBOLS_RUNS,
+        record_format,
         )
     logger.quiet("Done")
 
@@ -589,7 +681,12 @@ class InitializeChangesetsPass(Pass):
     old_timestamp = None
     changeset_items = []
 
-    db = OldSortableCVSRevisionDatabase(
+    if Ctx().binary_sortable_cvs_items:
+      old_rev_db = OldBinarySortableCVSRevisionDatabase
+    else:
+      old_rev_db = OldSortableCVSRevisionDatabase
+
+    db = old_rev_db(
         artifact_manager.get_temp_file(
             config.CVS_REVS_SORTED_DATAFILE
             ),
@@ -621,7 +718,12 @@ class InitializeChangesetsPass(Pass):
     old_symbol_id = None
     changeset_items = []
 
-    db = OldSortableCVSSymbolDatabase(
+    if Ctx().binary_sortable_cvs_items:
+      old_symbol_db = OldBinarySortableCVSSymbolDatabase
+    else:
+      old_symbol_db = OldSortableCVSSymbolDatabase
+
+    db = old_symbol_db(
         artifact_manager.get_temp_file(
             config.CVS_SYMBOLS_SORTED_DATAFILE
             ),
@@ -652,17 +754,24 @@ class InitializeChangesetsPass(Pass):
           or cmp(a.id, b.id))
 
   def break_internal_dependencies(self, changeset_items):
-    """Split up CHANGESET_ITEMS if necessary to break internal dependencies.
+    """Split up CHANGESET_ITEMS as necessary to break internal dependencies.
 
     CHANGESET_ITEMS is a list of CVSRevisions that could possibly
     belong in a single RevisionChangeset, but there might be internal
     dependencies among the items.  Return a list of lists, where each
-    sublist is a list of CVSRevisions and at least one internal
-    dependency has been eliminated.  Iff CHANGESET_ITEMS does not have
-    to be split, then the return value will contain a single value,
-    namely the original value of CHANGESET_ITEMS.  Split
-    CHANGESET_ITEMS at most once, even though the resulting changesets
-    might themselves have internal dependencies."""
+    sublist is a list of CVSRevisions that has no internal
+    dependencies.  Iff CHANGESET_ITEMS does not have to be split, then
+    the return value will contain a single value, namely the original
+    value of CHANGESET_ITEMS.
+
+    The items are sorted in a defined order (chronological to the
+    extent that the timestamps are correct and unique) and the list is
+    cut into consecutive pieces.  A dependency between the items at
+    indexes LO < HI is broken by any cut after an index in the range
+    [LO, HI).  The cuts are chosen in one sweep over the possible cut
+    positions so that there are as few of them as possible and, among
+    such choices, so that the sum of the time gaps at the cuts is as
+    large as possible (preferring earlier cuts in case of a tie)."""
 
     # We only look for succ dependencies, since by doing so we
     # automatically cover pred dependencies as well.  First create a
@@ -679,64 +788,88 @@ class InitializeChangesetsPass(Pass):
 
           dependencies.append((cvs_item.id, next_id,))
 
-    if dependencies:
-      # Sort the changeset_items in a defined order (chronological to the
-      # extent that the timestamps are correct and unique).
-      changeset_items.sort(self.compare_items)
-      indexes = {}
-      for (i, changeset_item) in enumerate(changeset_items):
-        indexes[changeset_item.id] = i
-
-      # How many internal dependencies would be broken by breaking the
-      # Changeset after a particular index?
-      breaks = [0] * len(changeset_items)
-      for (pred, succ,) in dependencies:
-        pred_index = indexes[pred]
-        succ_index = indexes[succ]
-        breaks[min(pred_index, succ_index)] += 1
-        breaks[max(pred_index, succ_index)] -= 1
-      for i in range(1, len(breaks)):
-        breaks[i] += breaks[i - 1]
-
-      best_i = None
-      best_count = -1
-      best_gap = 0
-      for i in range(0, len(breaks) - 1):
-        gap = changeset_items[i + 1].timestamp - changeset_items[i].timestamp
-        if (
-            breaks[i] > best_count
-            or breaks[i] == best_count and gap > best_gap
-            ):
-          best_i = i
-          best_count = breaks[i]
-          best_gap = gap
-
-      return [changeset_items[:best_i + 1], changeset_items[best_i + 1:]]
-    else:
+    if not dependencies:
       return [changeset_items]
 
+    # Sort the changeset_items in a defined order (chronological to the
+    # extent that the timestamps are correct and unique).
+    changeset_items.sort(self.compare_items)
+    n = len(changeset_items)
+    indexes = {}
+    for (i, changeset_item) in enumerate(changeset_items):
+      indexes[changeset_item.id] = i
+
+    # required[c] is the largest LO of any dependency (LO, HI) with HI
+    # <= c.  If the last cut before the cut after index c is after
+    # index p, then all dependencies that end by index c must already
+    # have been broken, so p must be at least required[c]:
+    required = [-1] * n
+    for (pred, succ,) in dependencies:
+      lo = min(indexes[pred], indexes[succ])
+      hi = max(indexes[pred], indexes[succ])
+      if lo > required[hi]:
+        required[hi] = lo
+    for c in range(1, n):
+      if required[c - 1] > required[c]:
+        required[c] = required[c - 1]
+
+    # best[c] is the cost (number_of_cuts, -sum_of_gaps) of the best
+    # way to break all dependencies that end by index c, with the last
+    # cut after index c; prev[c] is the previous cut in that solution
+    # (or None).  Since required[] is monotonic, the candidates for
+    # prev[c] form a sliding window, whose minimum is kept at the
+    # front of WINDOW:
+    best = [None] * (n - 1)
+    prev = [None] * (n - 1)
+    window = collections.deque()
+    for c in range(n - 1):
+      gap = changeset_items[c + 1].timestamp - changeset_items[c].timestamp
+      if c > 0:
+        # Cut c - 1 becomes a candidate predecessor:
+        while window and best[window[-1]] > best[c - 1]:
+          window.pop()
+        window.append(c - 1)
+      if required[c] < 0:
+        best[c] = (1, -gap)
+      else:
+        while window[0] < required[c]:
+          window.popleft()
+        p = window[0]
+        (count, neg_gaps) = best[p]
+        best[c] = (count + 1, neg_gaps - gap)
+        prev[c] = p
+
+    # The last cut must come after the start of every dependency:
+    last = None
+    for c in range(required[n - 1], n - 1):
+      if last is None or best[c] < best[last]:
+        last = c
+
+    cuts = []
+    while last is not None:
+      cuts.append(last)
+      last = prev[last]
+    cuts.reverse()
+
+    retval = []
+    start = 0
+    for c in cuts:
+      retval.append(changeset_items[start:c + 1])
+      start = c + 1
+    retval.append(changeset_items[start:])
+    return retval
+
   def break_all_internal_dependencies(self, changeset_items):
-    """Keep breaking CHANGESET_ITEMS up to break all internal dependencies.
+    """Break CHANGESET_ITEMS up to break all internal dependencies.
 
     CHANGESET_ITEMS is a list of CVSRevisions that could conceivably
-    be part of a single changeset.  Break this list into sublists,
-    where the CVSRevisions in each sublist are free of mutual
-    dependencies."""
-
-    # This method is written non-recursively to avoid any possible
-    # problems with recursion depth.
-
-    changesets_to_split = [changeset_items]
-    while changesets_to_split:
-      changesets = self.break_internal_dependencies(changesets_to_split.pop())
-      if len(changesets) == 1:
-        [changeset_items] = changesets
-        yield changeset_items
-      else:
-        # The changeset had to be split; see if either of the
-        # fragments have to be split:
-        changesets.reverse()
-        changesets_to_split.extend(changesets)
+    be part of a single changeset.  Generate the sublists into which
+    it has to be broken, where the CVSRevisions in each sublist are
+    free of mutual dependencies."""
+
+    for split_changeset_items \
+            in self.break_internal_dependencies(changeset_items):
+      yield split_changeset_items
 
   def get_changesets(self):
     """Generate (Changeset, [CVSItem,...]) for all changesets.
@@ -796,13 +929,22 @@ class InitializeChangesetsPass(Pass):
 
     self.changeset_key_generator = KeyGenerator()
 
+    # A list [(cvs_item_id, changeset_id)] of the entries that have not
+    # been written to cvs_item_to_changeset_id yet:
+    pending = []
+
     for (changeset, changeset_items) in self.get_changesets():
       if logger.is_on(logger.DEBUG):
         logger.debug(repr(changeset))
       changeset_db.store(changeset)
       for cvs_item in changeset_items:
         self.sorted_cvs_items_db.add(cvs_item)
-        cvs_item_to_changeset_id[cvs_item.id] = changeset.id
+        pending.append((cvs_item.id, changeset.id))
+      if len(pending) >= config.RECORD_TABLE_BATCH_SIZE:
+        cvs_item_to_changeset_id.set_many(pending)
+        pending = []
+
+    cvs_item_to_changeset_id.set_many(pending)
 
     self.sorted_cvs_items_db.close()
     cvs_item_to_changeset_id.close()
@@ -832,6 +974,173 @@ class ProcessedChangesetLogger:
       del self.processed_changeset_ids[:]
 
 
+def _cvs_item_to_changeset_needs_base(basename):
+  """Return True iff the stored table BASENAME is an overlay.
+
+  If ctx.cvs_item_to_changeset_overlay is set, the CVSItemToChangesetTables
+  written by the cycle-breaking passes only hold the pages that differ
+  from config.CVS_ITEM_TO_CHANGESET, which is needed to read them.
+  The table written by BreakAllChangesetCyclesPass is made into an
+  ordinary table again if ctx.consolidate_cvs_item_to_changeset is
+  also set."""
+
+  ctx = Ctx()
+  return (
+      ctx.cvs_item_to_changeset_overlay
+      and basename != config.CVS_ITEM_TO_CHANGESET
+      and not (
+          basename == config.CVS_ITEM_TO_CHANGESET_ALLBROKEN
+          and ctx.consolidate_cvs_item_to_changeset
+          )
+      )
+
+
+def _register_cvs_item_to_changeset_needed(which_pass, basename):
+  """Register that WHICH_PASS reads the CVSItemToChangesetTable BASENAME.
+
+  Also register config.CVS_ITEM_TO_CHANGESET if BASENAME depends on it."""
+
+  artifact_manager.register_temp_file_needed(basename, which_pass)
+  if _cvs_item_to_changeset_needs_base(basename):
+    artifact_manager.register_temp_file_needed(
+        config.CVS_ITEM_TO_CHANGESET, which_pass
+        )
+
+
+def _open_base_cvs_item_to_changeset_table():
+  return CVSItemToChangesetTable(
+      artifact_manager.get_temp_file(config.CVS_ITEM_TO_CHANGESET),
+      DB_OPEN_READ,
+      )
+
+
+def _open_cvs_item_to_changeset_table(basename):
+  """Open the stored CVSItemToChangesetTable BASENAME for reading."""
+
+  filename = artifact_manager.get_temp_file(basename)
+  if _cvs_item_to_changeset_needs_base(basename):
+    return CVSItemToChangesetTable(
+        filename, DB_OPEN_READ, base=_open_base_cvs_item_to_changeset_table()
+        )
+  else:
+    return CVSItemToChangesetTable(filename, DB_OPEN_READ)
+
+
+def _copy_cvs_item_to_changeset_table(source_basename, basename):
+  """Create table BASENAME as a copy of table SOURCE_BASENAME.
+
+  Return the new table, opened for writing.  If
+  ctx.cvs_item_to_changeset_overlay is set, open the new table as an
+  overlay on config.CVS_ITEM_TO_CHANGESET, so that only the delta file
+  of SOURCE_BASENAME (if any) has to be copied."""
+
+  filename = artifact_manager.get_temp_file(basename)
+  if not Ctx().cvs_item_to_changeset_overlay:
+    shutil.copyfile(artifact_manager.get_temp_file(source_basename), filename)
+    return CVSItemToChangesetTable(filename, DB_OPEN_WRITE)
+  elif source_basename == config.CVS_ITEM_TO_CHANGESET:
+    return CVSItemToChangesetTable(
+        filename, DB_OPEN_NEW, base=_open_base_cvs_item_to_changeset_table()
+        )
+  else:
+    shutil.copyfile(artifact_manager.get_temp_file(source_basename), filename)
+    return CVSItemToChangesetTable(
+        filename, DB_OPEN_WRITE, base=_open_base_cvs_item_to_changeset_table()
+        )
+
+
+def _break_changeset_cycle(changeset_graph, changeset_key_generator, cycle):
+  """Break up one changeset in CYCLE to help break the cycle.
+
+  CYCLE is a list of Changesets where
+
+      cycle[i] depends on cycle[i - 1]
+
+  Split the changeset whose link is the best one to break, using
+  CHANGESET_KEY_GENERATOR for the ids of the new changesets, and
+  update CHANGESET_GRAPH accordingly.  This is a module-level function
+  so that it can also be used in the worker processes of an
+  SCCBreakerPool."""
+
+  best_i = None
+  best_link = None
+  for i in range(len(cycle)):
+    # It's OK if this index wraps to -1:
+    link = ChangesetGraphLink(
+        cycle[i - 1], cycle[i], cycle[i + 1 - len(cycle)])
+
+    if best_i is None or link < best_link:
+      best_i = i
+      best_link = link
+
+  if logger.is_on(logger.DEBUG):
+    logger.debug(
+        'Breaking cycle %s by breaking node %x' % (
+        ' -> '.join(['%x' % node.id for node in (cycle + [cycle[0]])]),
+        best_link.changeset.id,))
+
+  new_changesets = best_link.break_changeset(changeset_key_generator)
+
+  changeset_graph.delete_changeset(best_link.changeset)
+
+  for changeset in new_changesets:
+    changeset_graph.add_new_changeset(changeset)
+
+
+def _init_cycle_breaking_worker():
+  """Prepare a worker process for breaking changeset cycles.
+
+  The worker inherits the databases of the parent process.  The
+  symbol and path databases are held in memory, but the CVSItem store
+  has to be opened again so that the worker does not share the file
+  position with its parent."""
+
+  Ctx()._cvs_items_db = IndexedCVSItemStore(
+      artifact_manager.get_temp_file(config.CVS_ITEMS_SORTED_STORE),
+      artifact_manager.get_temp_file(config.CVS_ITEMS_SORTED_INDEX_TABLE),
+      DB_OPEN_READ)
+
+
+def _create_cycle_breaking_pool():
+  """Return a pool of worker processes for breaking changeset cycles.
+
+  Return None if only one job was requested.  The pool should be
+  created before much memory has been allocated, to keep the forked
+  workers small."""
+
+  if Ctx().cycle_breaking_jobs > 1:
+    return multiprocessing.Pool(
+        Ctx().cycle_breaking_jobs, _init_cycle_breaking_worker
+        )
+  else:
+    return None
+
+
+def _consume_changeset_graph(
+      changeset_graph, break_cycle, changeset_key_generator, pool
+      ):
+  """Consume CHANGESET_GRAPH, breaking cycles using BREAK_CYCLE(cycle).
+
+  Use strongly connected components if ctx.scc_cycle_breaking is set
+  or if POOL, a pool as returned by _create_cycle_breaking_pool(), is
+  not None.  In the latter case, break the cycles of the larger
+  components in the worker processes.  Yield (changeset, time_range)
+  tuples as changeset_graph.consume_graph() does."""
+
+  if pool is not None:
+    scc_breaker_pool = SCCBreakerPool(
+        pool, _break_changeset_cycle, changeset_key_generator,
+        Ctx().cycle_breaking_min_parallel_scc_size,
+        )
+    return changeset_graph.consume_graph_by_scc(
+        break_cycle, scc_breaker_pool=scc_breaker_pool
+        )
+  elif Ctx().scc_cycle_breaking:
+    return changeset_graph.consume_graph_by_scc(break_cycle)
+  else:
+    return changeset_graph.consume_graph(cycle_breaker=break_cycle)
+
+
 class BreakRevisionChangesetCyclesPass(Pass):
   """Break up any dependency cycles involving only RevisionChangesets."""
 
@@ -876,29 +1185,9 @@ class BreakRevisionChangesetCyclesPass(Pass):
     this routine, but at least some progress must be made."""
 
     self.processed_changeset_logger.flush()
-    best_i = None
-    best_link = None
-    for i in range(len(cycle)):
-      # It's OK if this index wraps to -1:
-      link = ChangesetGraphLink(
-          cycle[i - 1], cycle[i], cycle[i + 1 - len(cycle)])
-
-      if best_i is None or link < best_link:
-        best_i = i
-        best_link = link
-
-    if logger.is_on(logger.DEBUG):
-      logger.debug(
-          'Breaking cycle %s by breaking node %x' % (
-          ' -> '.join(['%x' % node.id for node in (cycle + [cycle[0]])]),
-          best_link.changeset.id,))
-
-    new_changesets = best_link.break_changeset(self.changeset_key_generator)
-
-    self.changeset_graph.delete_changeset(best_link.changeset)
-
-    for changeset in new_changesets:
-      self.changeset_graph.add_new_changeset(changeset)
+    _break_changeset_cycle(
+        self.changeset_graph, self.changeset_key_generator, cycle
+        )
 
   def run(self, run_options, stats_keeper):
     logger.quiet("Breaking revision changeset dependency cycles...")
@@ -913,44 +1202,53 @@ class BreakRevisionChangesetCyclesPass(Pass):
         artifact_manager.get_temp_file(config.CVS_ITEMS_SORTED_INDEX_TABLE),
         DB_OPEN_READ)
 
-    shutil.copyfile(
-        artifact_manager.get_temp_file(
-            config.CVS_ITEM_TO_CHANGESET),
-        artifact_manager.get_temp_file(
-            config.CVS_ITEM_TO_CHANGESET_REVBROKEN))
-    cvs_item_to_changeset_id = CVSItemToChangesetTable(
-        artifact_manager.get_temp_file(
-            config.CVS_ITEM_TO_CHANGESET_REVBROKEN),
-        DB_OPEN_WRITE)
+    pool = _create_cycle_breaking_pool()
 
-    changeset_db = ChangesetDatabase(
-        artifact_manager.get_temp_file(config.CHANGESETS_REVBROKEN_STORE),
-        artifact_manager.get_temp_file(config.CHANGESETS_REVBROKEN_INDEX),
-        DB_OPEN_NEW)
+    # Stop the workers if anything goes wrong before they are shut
+    # down normally:
+    try:
+      cvs_item_to_changeset_id = _copy_cvs_item_to_changeset_table(
+          config.CVS_ITEM_TO_CHANGESET, config.CVS_ITEM_TO_CHANGESET_REVBROKEN
+          )
 
-    self.changeset_graph = ChangesetGraph(
-        changeset_db, cvs_item_to_changeset_id
-        )
+      changeset_db = ChangesetDatabase(
+          artifact_manager.get_temp_file(config.CHANGESETS_REVBROKEN_STORE),
+          artifact_manager.get_temp_file(config.CHANGESETS_REVBROKEN_INDEX),
+          DB_OPEN_NEW)
 
-    max_changeset_id = 0
-    for changeset in self.get_source_changesets():
-      changeset_db.store(changeset)
-      if isinstance(changeset, RevisionChangeset):
-        self.changeset_graph.add_changeset(changeset)
-      max_changeset_id = max(max_changeset_id, changeset.id)
+      self.changeset_graph = create_changeset_graph(
+          changeset_db, cvs_item_to_changeset_id
+          )
 
-    self.changeset_key_generator = KeyGenerator(max_changeset_id + 1)
+      max_changeset_id = 0
+      for changeset in self.get_source_changesets():
+        changeset_db.store(changeset)
+        if isinstance(changeset, RevisionChangeset):
+          self.changeset_graph.add_changeset(changeset)
+        max_changeset_id = max(max_changeset_id, changeset.id)
 
-    self.processed_changeset_logger = ProcessedChangesetLogger()
+      self.changeset_key_generator = KeyGenerator(max_changeset_id + 1)
 
-    # Consume the graph, breaking cycles using self.break_cycle():
-    for (changeset, time_range) in self.changeset_graph.consume_graph(
-          cycle_breaker=self.break_cycle
-          ):
-      self.processed_changeset_logger.log(changeset.id)
+      self.processed_changeset_logger = ProcessedChangesetLogger()
 
-    self.processed_changeset_logger.flush()
-    del self.processed_changeset_logger
+      # Consume the graph, breaking cycles using self.break_cycle():
+      for (changeset, time_range) in _consume_changeset_graph(
+            self.changeset_graph, self.break_cycle,
+            self.changeset_key_generator, pool,
+            ):
+        self.processed_changeset_logger.log(changeset.id)
+
+      self.processed_changeset_logger.flush()
+      del self.processed_changeset_logger
+    except:
+      if pool is not None:
+        pool.terminate()
+        pool.join()
+      raise
+
+    if pool is not None:
+      pool.close()
+      pool.join()
 
     self.changeset_graph.close()
     self.changeset_graph = None
@@ -976,7 +1274,9 @@ class RevisionTopologicalSortPass(Pass):
     self._register_temp_file_needed(config.CVS_ITEMS_SORTED_INDEX_TABLE)
     self._register_temp_file_needed(config.CHANGESETS_REVBROKEN_STORE)
     self._register_temp_file_needed(config.CHANGESETS_REVBROKEN_INDEX)
-    self._register_temp_file_needed(config.CVS_ITEM_TO_CHANGESET_REVBROKEN)
+    _register_cvs_item_to_changeset_needed(
+        self, config.CVS_ITEM_TO_CHANGESET_REVBROKEN
+        )
 
   def get_source_changesets(self, changeset_db):
     changeset_ids = changeset_db.keys()
@@ -991,13 +1291,10 @@ class RevisionTopologicalSortPass(Pass):
         DB_OPEN_READ,
         )
 
-    changeset_graph = ChangesetGraph(
+    changeset_graph = create_changeset_graph(
         changeset_db,
-        CVSItemToChangesetTable(
-            artifact_manager.get_temp_file(
-                config.CVS_ITEM_TO_CHANGESET_REVBROKEN
-                ),
-            DB_OPEN_READ,
+        _open_cvs_item_to_changeset_table(
+            config.CVS_ITEM_TO_CHANGESET_REVBROKEN
             )
         )
 
@@ -1069,7 +1366,9 @@ class BreakSymbolChangesetCyclesPass(Pass):
     self._register_temp_file_needed(config.CVS_ITEMS_SORTED_INDEX_TABLE)
     self._register_temp_file_needed(config.CHANGESETS_REVSORTED_STORE)
     self._register_temp_file_needed(config.CHANGESETS_REVSORTED_INDEX)
-    self._register_temp_file_needed(config.CVS_ITEM_TO_CHANGESET_REVBROKEN)
+    _register_cvs_item_to_changeset_needed(
+        self, config.CVS_ITEM_TO_CHANGESET_REVBROKEN
+        )
 
   def get_source_changesets(self):
     old_changeset_db = ChangesetDatabase(
@@ -1098,29 +1397,9 @@ class BreakSymbolChangesetCyclesPass(Pass):
     this routine, but at least some progress must be made."""
 
     self.processed_changeset_logger.flush()
-    best_i = None
-    best_link = None
-    for i in range(len(cycle)):
-      # It's OK if this index wraps to -1:
-      link = ChangesetGraphLink(
-          cycle[i - 1], cycle[i], cycle[i + 1 - len(cycle)])
-
-      if best_i is None or link < best_link:
-        best_i = i
-        best_link = link
-
-    if logger.is_on(logger.DEBUG):
-      logger.debug(
-          'Breaking cycle %s by breaking node %x' % (
-          ' -> '.join(['%x' % node.id for node in (cycle + [cycle[0]])]),
-          best_link.changeset.id,))
-
-    new_changesets = best_link.break_changeset(self.changeset_key_generator)
-
-    self.changeset_graph.delete_changeset(best_link.changeset)
-
-    for changeset in new_changesets:
-      self.changeset_graph.add_new_changeset(changeset)
+    _break_changeset_cycle(
+        self.changeset_graph, self.changeset_key_generator, cycle
+        )
 
   def run(self, run_options, stats_keeper):
     logger.quiet("Breaking symbol changeset dependency cycles...")
@@ -1135,44 +1414,54 @@ class BreakSymbolChangesetCyclesPass(Pass):
         artifact_manager.get_temp_file(config.CVS_ITEMS_SORTED_INDEX_TABLE),
         DB_OPEN_READ)
 
-    shutil.copyfile(
-        artifact_manager.get_temp_file(
-            config.CVS_ITEM_TO_CHANGESET_REVBROKEN),
-        artifact_manager.get_temp_file(
-            config.CVS_ITEM_TO_CHANGESET_SYMBROKEN))
-    cvs_item_to_changeset_id = CVSItemToChangesetTable(
-        artifact_manager.get_temp_file(
-            config.CVS_ITEM_TO_CHANGESET_SYMBROKEN),
-        DB_OPEN_WRITE)
+    pool = _create_cycle_breaking_pool()
 
-    changeset_db = ChangesetDatabase(
-        artifact_manager.get_temp_file(config.CHANGESETS_SYMBROKEN_STORE),
-        artifact_manager.get_temp_file(config.CHANGESETS_SYMBROKEN_INDEX),
-        DB_OPEN_NEW)
+    # Stop the workers if anything goes wrong before they are shut
+    # down normally:
+    try:
+      cvs_item_to_changeset_id = _copy_cvs_item_to_changeset_table(
+          config.CVS_ITEM_TO_CHANGESET_REVBROKEN,
+          config.CVS_ITEM_TO_CHANGESET_SYMBROKEN,
+          )
 
-    self.changeset_graph = ChangesetGraph(
-        changeset_db, cvs_item_to_changeset_id
-        )
+      changeset_db = ChangesetDatabase(
+          artifact_manager.get_temp_file(config.CHANGESETS_SYMBROKEN_STORE),
+          artifact_manager.get_temp_file(config.CHANGESETS_SYMBROKEN_INDEX),
+          DB_OPEN_NEW)
 
-    max_changeset_id = 0
-    for changeset in self.get_source_changesets():
-      changeset_db.store(changeset)
-      if isinstance(changeset, SymbolChangeset):
-        self.changeset_graph.add_changeset(changeset)
-      max_changeset_id = max(max_changeset_id, changeset.id)
+      self.changeset_graph = create_changeset_graph(
+          changeset_db, cvs_item_to_changeset_id
+          )
 
-    self.changeset_key_generator = KeyGenerator(max_changeset_id + 1)
+      max_changeset_id = 0
+      for changeset in self.get_source_changesets():
+        changeset_db.store(changeset)
+        if isinstance(changeset, SymbolChangeset):
+          self.changeset_graph.add_changeset(changeset)
+        max_changeset_id = max(max_changeset_id, changeset.id)
 
-    self.processed_changeset_logger = ProcessedChangesetLogger()
+      self.changeset_key_generator = KeyGenerator(max_changeset_id + 1)
 
-    # Consume the graph, breaking cycles using self.break_cycle():
-    for (changeset, time_range) in self.changeset_graph.consume_graph(
-          cycle_breaker=self.break_cycle
-          ):
-      self.processed_changeset_logger.log(changeset.id)
+      self.processed_changeset_logger = ProcessedChangesetLogger()
 
-    self.processed_changeset_logger.flush()
-    del self.processed_changeset_logger
+      # Consume the graph, breaking cycles using self.break_cycle():
+      for (changeset, time_range) in _consume_changeset_graph(
+            self.changeset_graph, self.break_cycle,
+            self.changeset_key_generator, pool,
+            ):
+        self.processed_changeset_logger.log(changeset.id)
+
+      self.processed_changeset_logger.flush()
+      del self.processed_changeset_logger
+    except:
+      if pool is not None:
+        pool.terminate()
+        pool.join()
+      raise
+
+    if pool is not None:
+      pool.close()
+      pool.join()
 
     self.changeset_graph.close()
     self.changeset_graph = None
@@ -1197,7 +1486,9 @@ class BreakAllChangesetCyclesPass(Pass):
     self._register_temp_file_needed(config.CVS_ITEMS_SORTED_INDEX_TABLE)
     self._register_temp_file_needed(config.CHANGESETS_SYMBROKEN_STORE)
     self._register_temp_file_needed(config.CHANGESETS_SYMBROKEN_INDEX)
-    self._register_temp_file_needed(config.CVS_ITEM_TO_CHANGESET_SYMBROKEN)
+    _register_cvs_item_to_changeset_needed(
+        self, config.CVS_ITEM_TO_CHANGESET_SYMBROKEN
+        )
 
   def get_source_changesets(self):
     old_changeset_db = ChangesetDatabase(
@@ -1355,22 +1646,17 @@ class BreakAllChangesetCyclesPass(Pass):
         artifact_manager.get_temp_file(config.CVS_ITEMS_SORTED_INDEX_TABLE),
         DB_OPEN_READ)
 
-    shutil.copyfile(
-        artifact_manager.get_temp_file(
-            config.CVS_ITEM_TO_CHANGESET_SYMBROKEN),
-        artifact_manager.get_temp_file(
-            config.CVS_ITEM_TO_CHANGESET_ALLBROKEN))
-    self.cvs_item_to_changeset_id = CVSItemToChangesetTable(
-        artifact_manager.get_temp_file(
-            config.CVS_ITEM_TO_CHANGESET_ALLBROKEN),
-        DB_OPEN_WRITE)
+    self.cvs_item_to_changeset_id = _copy_cvs_item_to_changeset_table(
+        config.CVS_ITEM_TO_CHANGESET_SYMBROKEN,
+        config.CVS_ITEM_TO_CHANGESET_ALLBROKEN,
+        )
 
     self.changeset_db = ChangesetDatabase(
         artifact_manager.get_temp_file(config.CHANGESETS_ALLBROKEN_STORE),
         artifact_manager.get_temp_file(config.CHANGESETS_ALLBROKEN_INDEX),
         DB_OPEN_NEW)
 
-    self.changeset_graph = ChangesetGraph(
+    self.changeset_graph = create_changeset_graph(
         self.changeset_db, self.cvs_item_to_changeset_id
         )
 
@@ -1457,6 +1743,17 @@ class BreakAllChangesetCyclesPass(Pass):
     self.cvs_item_to_changeset_id = None
     self.changeset_db = None
 
+    if Ctx().cvs_item_to_changeset_overlay \
+           and Ctx().consolidate_cvs_item_to_changeset:
+      logger.normal('Consolidating the CVSItem to changeset table...')
+      CVSItemToChangesetTable(
+          artifact_manager.get_temp_file(
+              config.CVS_ITEM_TO_CHANGESET_ALLBROKEN
+              ),
+          DB_OPEN_WRITE,
+          base=_open_base_cvs_item_to_changeset_table(),
+          ).consolidate()
+
     logger.quiet("Done")
 
 
@@ -1472,7 +1769,9 @@ class TopologicalSortPass(Pass):
     self._register_temp_file_needed(config.CVS_ITEMS_SORTED_INDEX_TABLE)
     self._register_temp_file_needed(config.CHANGESETS_ALLBROKEN_STORE)
     self._register_temp_file_needed(config.CHANGESETS_ALLBROKEN_INDEX)
-    self._register_temp_file_needed(config.CVS_ITEM_TO_CHANGESET_ALLBROKEN)
+    _register_cvs_item_to_changeset_needed(
+        self, config.CVS_ITEM_TO_CHANGESET_ALLBROKEN
+        )
 
   def get_source_changesets(self, changeset_db):
     for changeset_id in changeset_db.keys():
@@ -1486,13 +1785,10 @@ class TopologicalSortPass(Pass):
         artifact_manager.get_temp_file(config.CHANGESETS_ALLBROKEN_INDEX),
         DB_OPEN_READ)
 
-    changeset_graph = ChangesetGraph(
+    changeset_graph = create_changeset_graph(
         changeset_db,
-        CVSItemToChangesetTable(
-            artifact_manager.get_temp_file(
-                config.CVS_ITEM_TO_CHANGESET_ALLBROKEN
-                ),
-            DB_OPEN_READ,
+        _open_cvs_item_to_changeset_table(
+            config.CVS_ITEM_TO_CHANGESET_ALLBROKEN
             ),
         )
     symbol_changeset_ids = set()
@@ -1636,6 +1932,11 @@ class CreateRevsPass(Pass):
     logger.quiet("Done")
 
 
+def _symbol_openings_closings_sort_key(line):
+  line = line.split(' ', 2)
+  return (int(line[0], 16), int(line[1]), line[2],)
+
+
 class SortSymbolOpeningsClosingsPass(Pass):
   """This pass was formerly known as pass6."""
 
@@ -1646,17 +1947,13 @@ class SortSymbolOpeningsClosingsPass(Pass):
   def run(self, run_options, stats_keeper):
     logger.quiet("Sorting symbolic name source revisions...")
 
-    def sort_key(line):
-      line = line.split(' ', 2)
-      return (int(line[0], 16), int(line[1]), line[2],)
-
     sort_file(
         artifact_manager.get_temp_file(config.SYMBOL_OPENINGS_CLOSINGS),
         artifact_manager.get_temp_file(
             config.SYMBOL_OPENINGS_CLOSINGS_SORTED
             ),
-        key=sort_key,
-        tempdirs=[Ctx().tmpdir],
+        key=_symbol_openings_closings_sort_key,
+        **_get_sort_options()
         )
     logger.quiet("Done")
 
@@ -20,7 +20,7 @@ from cvs2svn_lib.common import DB_OPEN_READ
 from cvs2svn_lib.common import SVN_INVALID_REVNUM
 from cvs2svn_lib.artifact_manager import artifact_manager
 from cvs2svn_lib.record_table import SignedIntegerPacker
-from cvs2svn_lib.record_table import RecordTable
+from cvs2svn_lib.record_table import IndexTable
 from cvs2svn_lib.serializer import PrimedPickleSerializer
 from cvs2svn_lib.indexed_database import IndexedDatabase
 from cvs2svn_lib.svn_commit import SVNRevisionCommit
@@ -61,16 +61,27 @@ class PersistenceManager:
     self.svn_commit_db = IndexedDatabase(
         artifact_manager.get_temp_file(config.SVN_COMMITS_INDEX_TABLE),
         artifact_manager.get_temp_file(config.SVN_COMMITS_STORE),
-        mode, serializer)
-    self.cvs2svn_db = RecordTable(
+        mode, serializer, buffered=True)
+    self.cvs2svn_db = IndexTable(
         artifact_manager.get_temp_file(config.CVS_REVS_TO_SVN_REVNUMS),
         mode, SignedIntegerPacker(SVN_INVALID_REVNUM))
 
+    # A list [(cvs_rev_id, svn_revnum)] of the entries that have not
+    # been written to self.cvs2svn_db yet.  They are written in
+    # batches, so that runs of consecutive ids can be stored at once:
+    self._pending_revnums = []
+
+  def _flush_revnums(self):
+    if self._pending_revnums:
+      self.cvs2svn_db.set_many(self._pending_revnums)
+      self._pending_revnums = []
+
   def get_svn_revnum(self, cvs_rev_id):
     """Return the Subversion revision number in which CVS_REV_ID was
     committed, or SVN_INVALID_REVNUM if there is no mapping for
     CVS_REV_ID."""
 
+    self._flush_revnums()
     return self.cvs2svn_db.get(cvs_rev_id, SVN_INVALID_REVNUM)
 
   def get_svn_commit(self, svn_revnum):
@@ -93,9 +104,12 @@ class PersistenceManager:
 
     if isinstance(svn_commit, SVNRevisionCommit):
       for cvs_rev in svn_commit.cvs_revs:
-        self.cvs2svn_db[cvs_rev.id] = svn_commit.revnum
+        self._pending_revnums.append((cvs_rev.id, svn_commit.revnum))
+      if len(self._pending_revnums) >= config.RECORD_TABLE_BATCH_SIZE:
+        self._flush_revnums()
 
   def close(self):
+    self._flush_revnums()
     self.cvs2svn_db.close()
     self.cvs2svn_db = None
     self.svn_commit_db.close()
@@ -42,13 +42,23 @@ def select_python_parser():
   selected_parser = cvs2svn_rcsparse.default.Parser
 
 
+def select_mmap_parser():
+  """Configure this module to use the memory-mapping parser.
+
+  The memory-mapping parser maps the whole RCS file into memory and
+  finds tokens using regular expressions, so it avoids the per-chunk
+  copying done by the other parsers.  It only depends on the Python
+  standard library."""
+
+  global selected_parser
+  import cvs2svn_rcsparse.mmapped
+  selected_parser = cvs2svn_rcsparse.mmapped.Parser
+
+
 def select_parser():
   """Configure this module to use the best parser available."""
 
-  try:
-    select_texttools_parser()
-  except ImportError:
-    select_python_parser()
+  select_mmap_parser()
 
 
 def parse(file, sink):
@@ -66,6 +66,28 @@ class Packer(object):
 
     raise NotImplementedError()
 
+  def pack_many(self, values):
+    """Pack the records in the sequence VALUES into a single string."""
+
+    return ''.join([self.pack(v) for v in values])
+
+  def unpack_many(self, s, default):
+    """Unpack string S, which holds consecutive records, into a list.
+
+    Records that are equal to self.empty_value are returned as
+    DEFAULT."""
+
+    record_len = self.record_len
+    empty_value = self.empty_value
+    retval = []
+    for i in xrange(0, len(s), record_len):
+      record = s[i:i + record_len]
+      if record == empty_value:
+        retval.append(default)
+      else:
+        retval.append(self.unpack(record))
+    return retval
+
 
 class StructPacker(Packer):
   def __init__(self, format, empty_value=_unset):
@@ -78,12 +100,41 @@ class StructPacker(Packer):
     Packer.__init__(self, struct.calcsize(self.format),
                     empty_value=empty_value)
 
+    # If the format consists of a byte order character plus a single
+    # format character, many records can be packed or unpacked using a
+    # single call to struct.pack() or struct.unpack():
+    if len(self.format) == 2 and self.format[0] in '@=<>!':
+      self._many_format = self.format[0] + '%d' + self.format[1]
+      self._empty_unpacked = self.unpack(self.empty_value)
+    else:
+      self._many_format = None
+
   def pack(self, v):
     return struct.pack(self.format, v)
 
   def unpack(self, v):
     return struct.unpack(self.format, v)[0]
 
+  def pack_many(self, values):
+    if self._many_format is None:
+      return Packer.pack_many(self, values)
+
+    return struct.pack(self._many_format % (len(values),), *values)
+
+  def unpack_many(self, s, default):
+    if self._many_format is None:
+      return Packer.unpack_many(self, s, default)
+
+    retval = list(
+        struct.unpack(self._many_format % (len(s) // self.record_len,), s)
+        )
+    empty = self._empty_unpacked
+    if empty in retval:
+      for i in xrange(len(retval)):
+        if retval[i] == empty:
+          retval[i] = default
+    return retval
+
 
 class UnsignedIntegerPacker(StructPacker):
   def __init__(self, empty_value=0):
@@ -119,6 +170,30 @@ class FileOffsetPacker(Packer):
   def unpack(self, s):
     return struct.unpack(self.INDEX_FORMAT, s + self.PAD)[0]
 
+  def pack_many(self, values):
+    s = struct.pack('<%dQ' % (len(values),), *values)
+    return ''.join([
+        s[i:i + self.INDEX_FORMAT_LEN] for i in xrange(0, len(s), 8)
+        ])
+
+  def unpack_many(self, s, default):
+    n = len(s) // self.INDEX_FORMAT_LEN
+    if n == 0:
+      return []
+    retval = list(struct.unpack(
+        '<%dQ' % (n,),
+        self.PAD.join([
+            s[i:i + self.INDEX_FORMAT_LEN]
+            for i in xrange(0, len(s), self.INDEX_FORMAT_LEN)
+            ]) + self.PAD,
+        ))
+    # An offset of 0 is the empty value:
+    if 0 in retval:
+      for i in xrange(n):
+        if retval[i] == 0:
+          retval[i] = default
+    return retval
+
 
 class RecordTableAccessError(RuntimeError):
   pass
@@ -143,6 +218,49 @@ class AbstractRecordTable:
   def __setitem__(self, i, v):
     self._set_packed_record(i, self.packer.pack(v))
 
+  def _set_packed_records(self, start, s):
+    """Set the values for indexes START, START + 1, ... to the packed S.
+
+    S is the concatenation of the packed records."""
+
+    record_len = self._record_len
+    for j in xrange(len(s) // record_len):
+      self._set_packed_record(
+          start + j, s[j * record_len:(j + 1) * record_len]
+          )
+
+  def bulk_set(self, start, values):
+    """Set the items for indexes START, START + 1, ... to VALUES.
+
+    The values are packed all at once."""
+
+    self._set_packed_records(start, self.packer.pack_many(values))
+
+  def set_many(self, items):
+    """Set the items in ITEMS, which is a sequence of (index, value).
+
+    All values are packed at once, and runs of consecutive indexes are
+    stored together.  If an index appears more than once, the last
+    value wins."""
+
+    items = dict(items)
+    if not items:
+      return
+    indexes = items.keys()
+    indexes.sort()
+    s = self.packer.pack_many([items[i] for i in indexes])
+    record_len = self._record_len
+    start = prev = indexes[0]
+    k = 0
+    for j in xrange(1, len(indexes)):
+      i = indexes[j]
+      if i != prev + 1:
+        self._set_packed_records(start, s[k * record_len:j * record_len])
+        start = i
+        k = j
+      prev = i
+    self._set_packed_records(start, s[k * record_len:])
+
   def _get_packed_record(self, i):
     """Return the packed record for index I.
 
@@ -150,6 +268,20 @@ class AbstractRecordTable:
 
     raise NotImplementedError()
 
+  def _get_packed_records(self, start, count):
+    """Return the packed records for indexes START, START + 1, ...
+
+    Return the concatenation of COUNT packed records.  Records that
+    are not present are returned as self.packer.empty_value."""
+
+    pieces = []
+    for i in xrange(start, start + count):
+      try:
+        pieces.append(self._get_packed_record(i))
+      except KeyError:
+        pieces.append(self.packer.empty_value)
+    return ''.join(pieces)
+
   def __getitem__(self, i):
     """Return the item for index I.
 
@@ -180,6 +312,13 @@ class AbstractRecordTable:
     except KeyError:
       return default
 
+  def bulk_get(self, start, count, default=None):
+    """Return a list of the COUNT items starting at index START.
+
+    Items that are not defined are returned as DEFAULT."""
+
+    return [self.get(i, default) for i in xrange(start, start + count)]
+
   def __delitem__(self, i):
     """Delete the item for index I.
 
@@ -214,15 +353,38 @@ class AbstractRecordTable:
       except KeyError:
         pass
 
+  def iteritems(self):
+    """Yield the (key, value) pairs in the map in key order.
+
+    Skip over values that haven't been defined."""
+
+    for i in xrange(0, self._limit):
+      try:
+        yield (i, self[i])
+      except KeyError:
+        pass
+
 
 class RecordTable(AbstractRecordTable):
+  """A RecordTable that accesses its file through a page cache.
+
+  The file is read and written in pages of about PAGE_SIZE bytes.  Up
+  to CACHE_MEMORY bytes worth of pages are kept in memory.  When the
+  cache is full, the least recently used pages are evicted (and
+  written to disk, if they are dirty).  If the pages are read
+  sequentially, several pages are read at a time (up to
+  MAX_READ_AHEAD_PAGES), and get_many() reads runs of adjacent pages
+  using a single read."""
+
   # The approximate amount of memory that should be used for the cache
   # for each instance of this class:
   CACHE_MEMORY = 4 * 1024 * 1024
 
-  # Empirically, each entry in the cache table has an overhead of
-  # about 96 bytes on a 32-bit computer.
-  CACHE_OVERHEAD_PER_ENTRY = 96
+  # The approximate size of a cache page, in bytes:
+  PAGE_SIZE = 4 * 1024
+
+  # The maximum number of pages to read at a time:
+  MAX_READ_AHEAD_PAGES = 16
 
   def __init__(self, filename, mode, packer, cache_memory=CACHE_MEMORY):
     AbstractRecordTable.__init__(self, filename, mode, packer)
@@ -236,17 +398,35 @@ class RecordTable(AbstractRecordTable):
       raise RuntimeError('Invalid mode %r' % self.mode)
     self.cache_memory = cache_memory
 
-    # Number of items that can be stored in the write cache.
-    self._max_memory_cache = (
-        self.cache_memory
-        / (self.CACHE_OVERHEAD_PER_ENTRY + self._record_len))
+    # The number of records per page, and the size of a page in bytes:
+    self._page_records = max(1, self.PAGE_SIZE // self._record_len)
+    self._page_len = self._page_records * self._record_len
+
+    # The number of pages that can be held in the cache.  Make sure
+    # that the cache can hold a complete read-ahead plus some pages
+    # that are in use:
+    self._max_pages = max(
+        self.cache_memory // self._page_len, 2 * self.MAX_READ_AHEAD_PAGES
+        )
 
-    # Read and write cache; a map {i : (dirty, s)}, where i is an
-    # index, dirty indicates whether the value has to be written to
-    # disk, and s is the packed value for the index.  Up to
-    # self._max_memory_cache items can be stored here.  When the cache
-    # fills up, it is written to disk in one go and then cleared.
-    self._cache = {}
+    # The page cache; a map {page_number : page}, where page is a
+    # bytearray holding the packed records of the page:
+    self._pages = {}
+
+    # A map {page_number : tick} recording when each page in the cache
+    # was last used, and the current tick:
+    self._last_used = {}
+    self._tick = 0
+
+    # The set of the numbers of the pages that have to be written to
+    # disk:
+    self._dirty = set()
+
+    # The number of the last page that was read from disk, and the
+    # number of pages to read the next time if the reads continue
+    # sequentially:
+    self._last_page_read = None
+    self._read_ahead = 1
 
     # The index just beyond the last record ever written:
     self._limit = os.path.getsize(self.filename) // self._record_len
@@ -254,110 +434,458 @@ class RecordTable(AbstractRecordTable):
     # The index just beyond the last record ever written to disk:
     self._limit_written = self._limit
 
+  def _write_pages(self, page_numbers):
+    """Write the pages in PAGE_NUMBERS, which must be dirty, to disk."""
+
+    page_numbers = list(page_numbers)
+    page_numbers.sort()
+    f = self.f
+    pos = None
+    for page_number in page_numbers:
+      start = page_number * self._page_records
+      if start > self._limit_written:
+        # Fill the gap between the end of the file and this page with
+        # empty_values:
+        f.seek(self._limit_written * self._record_len)
+        f.write(self.packer.empty_value * (start - self._limit_written))
+      elif pos != start:
+        f.seek(start * self._record_len)
+      # Only write the records up to self._limit:
+      count = min(self._page_records, self._limit - start)
+      f.write(self._pages[page_number][:count * self._record_len])
+      pos = start + count
+      self._limit_written = max(self._limit_written, pos)
+      self._dirty.discard(page_number)
+
   def flush(self):
     logger.debug('Flushing cache for %s' % (self,))
 
-    pairs = [(i, s) for (i, (dirty, s)) in self._cache.items() if dirty]
-
-    if pairs:
-      pairs.sort()
-      old_i = None
-      f = self.f
-      for (i, s) in pairs:
-        if i == old_i:
-          # No seeking needed
-          pass
-        elif i <= self._limit_written:
-          # Just jump there:
-          f.seek(i * self._record_len)
-        else:
-          # Jump to the end of the file then write _empty_values until
-          # we reach the correct location:
-          f.seek(self._limit_written * self._record_len)
-          while self._limit_written < i:
-            f.write(self.packer.empty_value)
-            self._limit_written += 1
-        f.write(s)
-        old_i = i + 1
-        self._limit_written = max(self._limit_written, old_i)
-
+    if self._dirty:
+      self._write_pages(self._dirty)
       self.f.flush()
 
-    self._cache.clear()
+  def _evict(self):
+    """Remove the least recently used quarter of the pages from the cache.
+
+    Write any of them that are dirty to disk first."""
+
+    pages = [
+        (tick, page_number)
+        for (page_number, tick) in self._last_used.iteritems()
+        ]
+    pages.sort()
+    evicted = [
+        page_number for (tick, page_number) in pages[:len(pages) // 4 + 1]
+        ]
+    dirty = [
+        page_number for page_number in evicted if page_number in self._dirty
+        ]
+    if dirty:
+      self._write_pages(dirty)
+    for page_number in evicted:
+      del self._pages[page_number]
+      del self._last_used[page_number]
+
+  def _add_page(self, page_number, page):
+    if len(self._pages) >= self._max_pages:
+      self._evict()
+    self._pages[page_number] = page
+    self._tick += 1
+    self._last_used[page_number] = self._tick
+
+  def _read_pages(self, first, count):
+    """Read COUNT pages starting with page number FIRST into the cache.
+
+    Pages that are already in the cache are left alone."""
+
+    # Make room first, so that no dirty pages are written (and evicted)
+    # between reading the pages and adding them to the cache:
+    while len(self._pages) + count > self._max_pages:
+      self._evict()
+
+    self.f.seek(first * self._page_len)
+    s = self.f.read(count * self._page_len)
+    for page_number in range(first, first + count):
+      if page_number not in self._pages:
+        start = (page_number - first) * self._page_len
+        page = bytearray(s[start:start + self._page_len])
+        if len(page) < self._page_len:
+          # Pad the page beyond the end of the file:
+          page.extend(
+              self.packer.empty_value
+              * ((self._page_len - len(page)) // self._record_len)
+              )
+        self._add_page(page_number, page)
+    self._last_page_read = first + count - 1
+
+  def _get_page(self, page_number):
+    """Return the page with number PAGE_NUMBER, loading it if necessary."""
+
+    try:
+      page = self._pages[page_number]
+    except KeyError:
+      if page_number * self._page_records < self._limit_written:
+        if (
+            self._last_page_read is not None
+            and page_number == self._last_page_read + 1
+            ):
+          # The pages are being read sequentially; read more pages at a
+          # time:
+          self._read_ahead = min(
+              2 * self._read_ahead, self.MAX_READ_AHEAD_PAGES
+              )
+        else:
+          self._read_ahead = 1
+        last_page = (self._limit_written - 1) // self._page_records
+        self._read_pages(
+            page_number, min(self._read_ahead, last_page - page_number + 1)
+            )
+        page = self._pages[page_number]
+      else:
+        page = bytearray(self.packer.empty_value * self._page_records)
+        self._add_page(page_number, page)
+    else:
+      self._tick += 1
+      self._last_used[page_number] = self._tick
+    return page
 
   def _set_packed_record(self, i, s):
     if self.mode == DB_OPEN_READ:
       raise RecordTableAccessError()
     if i < 0:
       raise KeyError()
-    self._cache[i] = (True, s)
-    if len(self._cache) >= self._max_memory_cache:
-      self.flush()
+    (page_number, j) = divmod(i, self._page_records)
+    page = self._get_page(page_number)
+    page[j * self._record_len:(j + 1) * self._record_len] = s
+    self._dirty.add(page_number)
     self._limit = max(self._limit, i + 1)
 
   def _get_packed_record(self, i):
-    try:
-      return self._cache[i][1]
-    except KeyError:
-      if not 0 <= i < self._limit_written:
-        raise KeyError(i)
-      self.f.seek(i * self._record_len)
-      s = self.f.read(self._record_len)
-      self._cache[i] = (False, s)
-      if len(self._cache) >= self._max_memory_cache:
-        self.flush()
+    if not 0 <= i < self._limit:
+      raise KeyError(i)
+    (page_number, j) = divmod(i, self._page_records)
+    page = self._get_page(page_number)
+    return str(page[j * self._record_len:(j + 1) * self._record_len])
+
+  def _set_packed_records(self, start, s):
+    if self.mode == DB_OPEN_READ:
+      raise RecordTableAccessError()
+    if start < 0:
+      raise KeyError()
+
+    record_len = self._record_len
+    end = start + len(s) // record_len
+    # Set the limit first, so that pages that are evicted while this
+    # method runs are written completely:
+    self._limit = max(self._limit, end)
+    i = start
+    while i < end:
+      (page_number, j) = divmod(i, self._page_records)
+      n = min(self._page_records - j, end - i)
+      data = s[(i - start) * record_len:(i - start + n) * record_len]
+      if n == self._page_records and page_number not in self._pages:
+        # The whole page is overwritten, so there is no need to read
+        # it:
+        self._add_page(page_number, bytearray(data))
+      else:
+        page = self._get_page(page_number)
+        page[j * record_len:(j + n) * record_len] = data
+      self._dirty.add(page_number)
+      i += n
+
+  def _get_packed_records(self, start, count):
+    record_len = self._record_len
+    end = min(start + count, self._limit)
+    pieces = []
+    i = start
+    while i < end:
+      (page_number, j) = divmod(i, self._page_records)
+      n = min(self._page_records - j, end - i)
+      page = self._get_page(page_number)
+      pieces.append(str(page[j * record_len:(j + n) * record_len]))
+      i += n
+    if start + count > end:
+      pieces.append(
+          self.packer.empty_value * (start + count - max(start, end))
+          )
+    return ''.join(pieces)
+
+  def bulk_get(self, start, count, default=None):
+    if start < 0:
+      raise KeyError(start)
+
+    return self.packer.unpack_many(
+        self._get_packed_records(start, count), default
+        )
 
-      return s
+  def get_many(self, indexes, default=None):
+    """Yield (index, item) tuples for INDEXES in index order.
+
+    Yield (index,default) for indices for which not item is defined.
+    Runs of adjacent pages that are not in the cache are read using a
+    single read."""
+
+    indexes = list(indexes)
+    indexes.sort()
+
+    # The sorted numbers of the pages that have to be read from disk:
+    missing = set()
+    for i in indexes:
+      if 0 <= i < self._limit_written:
+        page_number = i // self._page_records
+        if page_number not in self._pages:
+          missing.add(page_number)
+    missing = list(missing)
+    missing.sort()
+    k = 0
+
+    for i in indexes:
+      if 0 <= i < self._limit_written:
+        page_number = i // self._page_records
+        while k < len(missing) and missing[k] < page_number:
+          k += 1
+        if (
+            page_number not in self._pages
+            and k < len(missing) and missing[k] == page_number
+            ):
+          # Read the run of adjacent missing pages starting with this
+          # one:
+          count = 1
+          while (
+              count < self.MAX_READ_AHEAD_PAGES
+              and k + count < len(missing)
+              and missing[k + count] == page_number + count
+              ):
+            count += 1
+          self._read_pages(page_number, count)
+      yield (i, self.get(i, default))
 
   def close(self):
     self.flush()
-    self._cache = None
+    self._pages = None
+    self._last_used = None
+    self._dirty = None
     self.f.close()
     self.f = None
 
 
+class OverlayRecordTable(RecordTable):
+  """A RecordTable that only stores the pages that differ from a base table.
+
+  BASE is a RecordTable of any kind that is only read from.  Pages of
+  records are read from BASE until they are changed for the first
+  time; then they are written to the delta file FILENAME, and read
+  from there afterwards.  So if only a fraction of the records are
+  changed, creating the table costs neither a copy of BASE nor the
+  disk space for one.
+
+  The delta file holds the changed pages, in the order that they were
+  first written, followed by a list of their page numbers and a
+  trailer.  The same BASE has to be supplied whenever the table is
+  opened again.  consolidate() turns the table into an ordinary
+  RecordTable file that does not depend on BASE anymore.  This table
+  closes BASE when it is closed itself."""
+
+  # The format of the trailer at the end of the delta file: the size
+  # of a page in bytes, the index just beyond the last record, and the
+  # number of pages in the file:
+  TRAILER_FORMAT = '=QQQ'
+
+  def __init__(
+        self, filename, mode, base, cache_memory=RecordTable.CACHE_MEMORY
+        ):
+    RecordTable.__init__(
+        self, filename, mode, base.packer, cache_memory=cache_memory
+        )
+    self._base = base
+
+    # A map {page_number : offset} of where each page that differs
+    # from BASE is stored in the delta file:
+    self._page_offsets = {}
+
+    # The offset just beyond the last page in the delta file:
+    self._delta_end = 0
+
+    if self.mode == DB_OPEN_NEW:
+      self._limit = self._base._limit
+    else:
+      self._read_trailer()
+
+    # All of the pages up to self._limit can be read from either the
+    # delta file or BASE:
+    self._limit_written = self._limit
+
+  def __str__(self):
+    return '%s(%r, %s)' % (self.__class__.__name__, self.filename, self._base,)
+
+  def _read_trailer(self):
+    trailer_len = struct.calcsize(self.TRAILER_FORMAT)
+    self.f.seek(-trailer_len, 2)
+    (page_len, self._limit, page_count) = struct.unpack(
+        self.TRAILER_FORMAT, self.f.read(trailer_len)
+        )
+    if page_len != self._page_len:
+      raise RecordTableAccessError(
+          '%s has pages of %d bytes rather than %d'
+          % (self.filename, page_len, self._page_len,)
+          )
+    self._delta_end = page_count * self._page_len
+    self.f.seek(self._delta_end)
+    page_numbers = struct.unpack(
+        '=%dQ' % (page_count,), self.f.read(8 * page_count)
+        )
+    for (k, page_number) in enumerate(page_numbers):
+      self._page_offsets[page_number] = k * self._page_len
+
+  def _write_trailer(self):
+    page_numbers = [None] * len(self._page_offsets)
+    for (page_number, offset) in self._page_offsets.iteritems():
+      page_numbers[offset // self._page_len] = page_number
+    self.f.seek(self._delta_end)
+    self.f.write(struct.pack('=%dQ' % (len(page_numbers),), *page_numbers))
+    self.f.write(struct.pack(
+        self.TRAILER_FORMAT, self._page_len, self._limit, len(page_numbers)
+        ))
+    self.f.truncate()
+
+  def _write_pages(self, page_numbers):
+    """Write the pages in PAGE_NUMBERS, which must be dirty, to disk.
+
+    Pages that are not yet in the delta file are appended to it."""
+
+    page_numbers = list(page_numbers)
+    page_numbers.sort()
+    for page_number in page_numbers:
+      offset = self._page_offsets.get(page_number)
+      if offset is None:
+        offset = self._delta_end
+        self._page_offsets[page_number] = offset
+        self._delta_end += self._page_len
+      self.f.seek(offset)
+      self.f.write(self._pages[page_number])
+      self._limit_written = max(
+          self._limit_written,
+          min(self._limit, (page_number + 1) * self._page_records),
+          )
+      self._dirty.discard(page_number)
+
+  def _read_pages(self, first, count):
+    """Read COUNT pages starting with page number FIRST into the cache.
+
+    Read each page from the delta file if it is there, otherwise from
+    the base table.  Pages that are already in the cache are left
+    alone."""
+
+    while len(self._pages) + count > self._max_pages:
+      self._evict()
+
+    for page_number in range(first, first + count):
+      if page_number not in self._pages:
+        offset = self._page_offsets.get(page_number)
+        if offset is None:
+          page = bytearray(self._base._get_packed_records(
+              page_number * self._page_records, self._page_records
+              ))
+        else:
+          self.f.seek(offset)
+          page = bytearray(self.f.read(self._page_len))
+        self._add_page(page_number, page)
+    self._last_page_read = first + count - 1
+
+  def consolidate(self):
+    """Replace the delta file with an ordinary RecordTable file.
+
+    Write all of the records of this table, whether they come from
+    the delta file or from the base table, to a file in the format of
+    RecordTable and MmapRecordTable, which then replaces the delta
+    file.  This closes the table."""
+
+    if self.mode == DB_OPEN_READ:
+      raise RecordTableAccessError()
+
+    logger.debug('Consolidating %s' % (self,))
+
+    self.flush()
+    tmp_filename = self.filename + '.tmp'
+    f = open(tmp_filename, 'wb')
+    chunk_records = self.MAX_READ_AHEAD_PAGES * self._page_records
+    for start in xrange(0, self._limit, chunk_records):
+      f.write(self._get_packed_records(
+          start, min(chunk_records, self._limit - start)
+          ))
+    f.close()
+
+    self._base.close()
+    self._base = None
+    RecordTable.close(self)
+    os.remove(self.filename)
+    os.rename(tmp_filename, self.filename)
+
+  def close(self):
+    self.flush()
+    if self.mode != DB_OPEN_READ:
+      self._write_trailer()
+    self._base.close()
+    self._base = None
+    RecordTable.close(self)
+
+
 class MmapRecordTable(AbstractRecordTable):
+  """A RecordTable that accesses its file via a memory map.
+
+  The file is enlarged geometrically (by a factor of GROWTH_FACTOR,
+  but at least by GROWTH_INCREMENT bytes) as records are added, to
+  limit the number of times that it has to be remapped.  When the
+  table is closed, the file is truncated to the records that have
+  actually been written."""
+
   GROWTH_INCREMENT = 65536
 
+  GROWTH_FACTOR = 1.5
+
+  # The number of records to unpack at a time when iterating over the
+  # table:
+  ITER_RECORDS = 65536
+
   def __init__(self, filename, mode, packer):
     AbstractRecordTable.__init__(self, filename, mode, packer)
     if self.mode == DB_OPEN_NEW:
       self.python_file = open(self.filename, 'wb+')
-      self.python_file.write('\0' * self.GROWTH_INCREMENT)
-      self.python_file.flush()
-      self._filesize = self.GROWTH_INCREMENT
-      self.f = mmap.mmap(
-          self.python_file.fileno(), self._filesize,
-          access=mmap.ACCESS_WRITE
-          )
-
-      # The index just beyond the last record ever written:
-      self._limit = 0
+      self._filesize = 0
     elif self.mode == DB_OPEN_WRITE:
       self.python_file = open(self.filename, 'rb+')
       self._filesize = os.path.getsize(self.filename)
-      self.f = mmap.mmap(
-          self.python_file.fileno(), self._filesize,
-          access=mmap.ACCESS_WRITE
-          )
-
-      # The index just beyond the last record ever written:
-      self._limit = os.path.getsize(self.filename) // self._record_len
     elif self.mode == DB_OPEN_READ:
       self.python_file = open(self.filename, 'rb')
       self._filesize = os.path.getsize(self.filename)
+    else:
+      raise RuntimeError('Invalid mode %r' % self.mode)
+
+    # The index just beyond the last record ever written:
+    self._limit = self._filesize // self._record_len
+
+    if self.mode == DB_OPEN_READ:
+      if self._filesize == 0:
+        # An empty file cannot be mapped:
+        self.f = ''
+      else:
+        self.f = mmap.mmap(
+            self.python_file.fileno(), self._filesize,
+            access=mmap.ACCESS_READ
+            )
+    else:
+      if self._filesize == 0:
+        self.python_file.write('\0' * self.GROWTH_INCREMENT)
+        self.python_file.flush()
+        self._filesize = self.GROWTH_INCREMENT
       self.f = mmap.mmap(
           self.python_file.fileno(), self._filesize,
-          access=mmap.ACCESS_READ
+          access=mmap.ACCESS_WRITE
           )
 
-      # The index just beyond the last record ever written:
-      self._limit = os.path.getsize(self.filename) // self._record_len
-    else:
-      raise RuntimeError('Invalid mode %r' % self.mode)
-
   def flush(self):
-    self.f.flush()
+    if self.mode != DB_OPEN_READ:
+      self.f.flush()
 
   def _set_packed_record(self, i, s):
     if self.mode == DB_OPEN_READ:
@@ -365,32 +893,168 @@ class MmapRecordTable(AbstractRecordTable):
     if i < 0:
       raise KeyError()
     if i >= self._limit:
-      # This write extends the range of valid indices.  First check
-      # whether the file has to be enlarged:
-      new_size = (i + 1) * self._record_len
-      if new_size > self._filesize:
-        self._filesize = (
-            (new_size + self.GROWTH_INCREMENT - 1)
-            // self.GROWTH_INCREMENT
-            * self.GROWTH_INCREMENT
-            )
-        self.f.resize(self._filesize)
-      if i > self._limit:
-        # Pad up to the new record with empty_value:
-        self.f[self._limit * self._record_len:i * self._record_len] = \
-            self.packer.empty_value * (i - self._limit)
-      self._limit = i + 1
+      self._extend(i + 1)
 
     self.f[i * self._record_len:(i + 1) * self._record_len] = s
 
+  def _extend(self, limit):
+    """Extend the range of valid indices to LIMIT.
+
+    Enlarge the file if necessary, and fill the records between the
+    old limit and index LIMIT - 1 with empty_value."""
+
+    new_size = limit * self._record_len
+    if new_size > self._filesize:
+      new_size = max(
+          new_size,
+          int(self._filesize * self.GROWTH_FACTOR),
+          self._filesize + self.GROWTH_INCREMENT,
+          )
+      self._filesize = (
+          (new_size + self.GROWTH_INCREMENT - 1)
+          // self.GROWTH_INCREMENT
+          * self.GROWTH_INCREMENT
+          )
+      self.f.resize(self._filesize)
+    if limit - 1 > self._limit:
+      # Pad up to the new record with empty_value:
+      self.f[self._limit * self._record_len:(limit - 1) * self._record_len] = \
+          self.packer.empty_value * (limit - 1 - self._limit)
+    self._limit = limit
+
+  def _set_packed_records(self, start, s):
+    if self.mode == DB_OPEN_READ:
+      raise RecordTableAccessError()
+    if start < 0:
+      raise KeyError()
+
+    end = start + len(s) // self._record_len
+    if end > self._limit:
+      self._extend(end)
+    self.f[start * self._record_len:end * self._record_len] = s
+
+  def _get_packed_records(self, start, count):
+    end = min(start + count, self._limit)
+    if end > start:
+      s = self.f[start * self._record_len:end * self._record_len]
+    else:
+      s = ''
+    if start + count > end:
+      s += self.packer.empty_value * (start + count - max(start, end))
+    return s
+
+  def bulk_get(self, start, count, default=None):
+    if start < 0:
+      raise KeyError(start)
+
+    end = min(start + count, self._limit)
+    if end > start:
+      retval = self.packer.unpack_many(
+          self.f[start * self._record_len:end * self._record_len], default
+          )
+    else:
+      retval = []
+    retval.extend([default] * (count - len(retval)))
+    return retval
+
   def _get_packed_record(self, i):
     if not 0 <= i < self._limit:
       raise KeyError(i)
     return self.f[i * self._record_len:(i + 1) * self._record_len]
 
+  def get_many(self, indexes, default=None):
+    """Yield (index, item) tuples for INDEXES in index order.
+
+    Yield (index,default) for indices for which not item is defined.
+    Runs of consecutive indexes are unpacked all at once."""
+
+    indexes = list(indexes)
+    indexes.sort()
+    record_len = self._record_len
+    k = 0
+    while k < len(indexes):
+      i = indexes[k]
+      if not 0 <= i < self._limit:
+        yield (i, default)
+        k += 1
+        continue
+
+      # Find the end of the run of consecutive indexes starting at i:
+      j = k + 1
+      while (
+          j < len(indexes)
+          and indexes[j] == indexes[j - 1] + 1
+          and indexes[j] < self._limit
+          ):
+        j += 1
+      values = self.packer.unpack_many(
+          self.f[i * record_len:(indexes[j - 1] + 1) * record_len], default
+          )
+      for item in zip(indexes[k:j], values):
+        yield item
+      k = j
+
+  def _iter_chunks(self):
+    """Yield (first_index, values) for chunks of the table.
+
+    Undefined values are represented by _unset."""
+
+    record_len = self._record_len
+    for first in xrange(0, self._limit, self.ITER_RECORDS):
+      last = min(first + self.ITER_RECORDS, self._limit)
+      yield (
+          first,
+          self.packer.unpack_many(
+              self.f[first * record_len:last * record_len], _unset
+              ),
+          )
+
+  def iterkeys(self):
+    for (first, values) in self._iter_chunks():
+      for (j, value) in enumerate(values):
+        if value is not _unset:
+          yield first + j
+
+  def itervalues(self):
+    for (first, values) in self._iter_chunks():
+      for value in values:
+        if value is not _unset:
+          yield value
+
+  def iteritems(self):
+    for (first, values) in self._iter_chunks():
+      for (j, value) in enumerate(values):
+        if value is not _unset:
+          yield (first + j, value)
+
   def close(self):
     self.flush()
-    self.f.close()
+    if self._filesize:
+      self.f.close()
+    if self.mode != DB_OPEN_READ:
+      # Discard the space beyond the last record:
+      self.python_file.truncate(self._limit * self._record_len)
     self.python_file.close()
 
 
+# Should the RecordTables that are used as indexes (by IndexedDatabase,
+# PersistenceManager, and CVSItemToChangesetTable) be memory mapped?
+# Memory mapping makes random lookups in these tables considerably
+# faster, but a large conversion can exhaust the virtual address
+# space of a 32-bit computer.  Therefore memory mapping is only used
+# by default if pointers are at least 64 bits wide.  This option can
+# be changed externally (e.g., in an options file), affecting any
+# tables opened subsequent to the change:
+use_mmap_for_index_tables = (struct.calcsize('P') >= 8)
+
+
+def IndexTable(filename, mode, packer):
+  """Return a RecordTable that is to be used as an index.
+
+  Return a MmapRecordTable or a RecordTable depending on
+  use_mmap_for_index_tables."""
+
+  if use_mmap_for_index_tables:
+    return MmapRecordTable(filename, mode, packer)
+  else:
+    return RecordTable(filename, mode, packer)
@@ -16,6 +16,9 @@
 
 import os
 import stat
+from multiprocessing.pool import ThreadPool
+
+from cvs2svn_lib import config
 
 from cvs2svn_lib.common import path_join
 from cvs2svn_lib.common import FatalError
@@ -28,11 +31,149 @@ from cvs2svn_lib.cvs_path import CVSDirectory
 from cvs2svn_lib.cvs_path import CVSFile
 
 
+def _list_directory(pathname):
+  """Return the contents of directory PATHNAME, with their stat results.
+
+  Return a map {fname : stat_result} for the entries of PATHNAME.
+  STAT_RESULT is the result of os.stat() for the entry, or None if it
+  could not be stat()ed (for example, because it is a dangling
+  symlink).  This function is also run in the walker's thread pool."""
+
+  listing = {}
+  for fname in os.listdir(pathname):
+    try:
+      listing[fname] = os.stat(os.path.join(pathname, fname))
+    except OSError:
+      listing[fname] = None
+  return listing
+
+
+def _isdir(file_stat):
+  """Return True iff FILE_STAT is the stat of a directory."""
+
+  return file_stat is not None and stat.S_ISDIR(file_stat.st_mode)
+
+
 class _RepositoryWalker(object):
-  def __init__(self, file_key_generator, error_handler):
+  def __init__(self, file_key_generator, error_handler, threads=1):
+    """Create a walker that lists directories using THREADS threads.
+
+    If THREADS is greater than one, directories are listed (and their
+    entries stat()ed) ahead of time in a pool of worker threads, in
+    the order in which the walk will need them.  This hides the
+    latency of the filesystem, which can be considerable (for example,
+    over NFS).  The order in which CVSPaths are generated does not
+    depend on the number of threads."""
+
     self.file_key_generator = file_key_generator
     self.error_handler = error_handler
 
+    # A map {rcs_path : listing} for the directories that are currently
+    # being processed, where LISTING is the value returned by
+    # _list_directory().  The listings serve as a cache of the stat()
+    # results of the entries in those directories.
+    self._listings = {}
+
+    if threads > 1:
+      self._pool = ThreadPool(threads)
+    else:
+      self._pool = None
+
+    # The maximum number of directory listings to request ahead of
+    # time:
+    self._read_ahead = threads * config.WALK_READ_AHEAD_DIRECTORIES_PER_THREAD
+
+    # A map {rcs_path : AsyncResult} for the directory listings that
+    # have been requested from the thread pool but not used yet:
+    self._pending = {}
+
+    # A stack of rcs_paths of directories that will be walked but whose
+    # listings have not been requested yet.  The directory that will be
+    # walked next is at the end of the list.
+    self._unrequested = []
+
+  def _request_listings(self):
+    """Request directory listings until enough are pending."""
+
+    while self._unrequested and len(self._pending) < self._read_ahead:
+      pathname = self._unrequested.pop()
+      self._pending[pathname] = self._pool.apply_async(
+          _list_directory, (pathname,)
+          )
+
+  def _expect_directories(self, pathnames):
+    """Note that the directories in PATHNAMES will be walked next.
+
+    PATHNAMES are the rcs_paths of the directories, in the order in
+    which they will be walked."""
+
+    if self._pool is not None:
+      self._unrequested.extend(reversed(pathnames))
+      self._request_listings()
+
+  def _open_directory(self, cvs_directory):
+    """Read the listing of CVS_DIRECTORY into self._listings.
+
+    Return the sorted list of the names of its entries.  Use a listing
+    that was requested ahead of time, if available."""
+
+    pathname = cvs_directory.rcs_path
+    if self._pool is None:
+      listing = _list_directory(pathname)
+    else:
+      if self._unrequested and self._unrequested[-1] == pathname:
+        self._unrequested.pop()
+      result = self._pending.pop(pathname, None)
+      self._request_listings()
+      if result is None:
+        listing = _list_directory(pathname)
+      else:
+        listing = result.get()
+
+    self._listings[pathname] = listing
+    fnames = listing.keys()
+    fnames.sort()
+    return fnames
+
+  def _close_directory(self, cvs_directory):
+    """Discard the listing of CVS_DIRECTORY."""
+
+    del self._listings[cvs_directory.rcs_path]
+
+  def _stat(self, dirname, fname):
+    """Return the os.stat() result for file FNAME in directory DIRNAME.
+
+    Use the result from the directory listing if possible."""
+
+    try:
+      file_stat = self._listings[dirname][fname]
+    except KeyError:
+      file_stat = None
+    if file_stat is None:
+      # Let os.stat() raise the appropriate exception if the file
+      # cannot be stat()ed:
+      file_stat = os.stat(os.path.join(dirname, fname))
+    return file_stat
+
+  def _exists(self, dirname, fname):
+    """Return True iff file FNAME exists in directory DIRNAME.
+
+    Use the directory listing if possible."""
+
+    listing = self._listings.get(dirname)
+    if listing is None:
+      return os.path.exists(os.path.join(dirname, fname))
+    else:
+      return listing.get(fname) is not None
+
+  def close(self):
+    """Shut down the thread pool, if any."""
+
+    if self._pool is not None:
+      self._pool.close()
+      self._pool.join()
+      self._pool = None
+
   def _get_cvs_file(
         self, parent_directory, basename,
         file_in_attic=False, leave_in_attic=False,
@@ -75,16 +216,16 @@ class _RepositoryWalker(object):
 
       # If this file also exists outside of the attic, it's a fatal
       # error:
-      non_attic_filename = os.path.join(
-          logical_parent_directory.rcs_path, basename,
-          )
-      if os.path.exists(non_attic_filename):
+      if self._exists(logical_parent_directory.rcs_path, basename):
+        non_attic_filename = os.path.join(
+            logical_parent_directory.rcs_path, basename,
+            )
         raise FileInAndOutOfAtticException(non_attic_filename, filename)
     else:
       in_attic = False
       logical_parent_directory = parent_directory
 
-    file_stat = os.stat(filename)
+    file_stat = self._stat(parent_directory.rcs_path, basename)
 
     # The size of the file in bytes:
     file_size = file_stat.st_size
@@ -143,8 +284,8 @@ class _RepositoryWalker(object):
 
     retained_attic_files = []
 
-    fnames = os.listdir(cvs_directory.rcs_path)
-    fnames.sort()
+    fnames = self._open_directory(cvs_directory)
+    listing = self._listings[cvs_directory.rcs_path]
     for fname in fnames:
       pathname = os.path.join(cvs_directory.rcs_path, fname)
       path_in_repository = path_join(cvs_directory.get_cvs_path(), fname)
@@ -152,7 +293,7 @@ class _RepositoryWalker(object):
         logger.normal(
             "Excluding file from conversion: %s" % (path_in_repository,)
             )
-      elif os.path.isdir(pathname):
+      elif _isdir(listing[fname]):
         if fname == '.svn' or fname == 'CVS':
           logger.debug(
               "Directory %s found within Attic; ignoring" % (pathname,)
@@ -171,6 +312,8 @@ class _RepositoryWalker(object):
           # were located one directory up:
           yield cvs_file
 
+    self._close_directory(cvs_directory)
+
     if retained_attic_files:
       # There was at least one file in the attic that will be retained
       # in the attic.  First include the Attic directory itself in the
@@ -204,8 +347,8 @@ class _RepositoryWalker(object):
     # Non-Attic subdirectories of cvs_directory (to be recursed into):
     dirs = []
 
-    fnames = os.listdir(cvs_directory.rcs_path)
-    fnames.sort()
+    fnames = self._open_directory(cvs_directory)
+    listing = self._listings[cvs_directory.rcs_path]
     for fname in fnames:
       pathname = os.path.join(cvs_directory.rcs_path, fname)
       path_in_repository = path_join(cvs_directory.get_cvs_path(), fname)
@@ -214,7 +357,7 @@ class _RepositoryWalker(object):
             "Excluding file from conversion: %s" % (path_in_repository,)
             )
         pass
-      elif os.path.isdir(pathname):
+      elif _isdir(listing[fname]):
         if fname == 'Attic':
           attic_dir = fname
         elif fname == '.svn' or fname == 'CVS':
@@ -229,6 +372,17 @@ class _RepositoryWalker(object):
         # Silently ignore other files:
         pass
 
+    # The subdirectories will be walked next, in this order:
+    if attic_dir is not None:
+      self._expect_directories(
+          [os.path.join(cvs_directory.rcs_path, fname)
+           for fname in [attic_dir] + dirs]
+          )
+    else:
+      self._expect_directories(
+          [os.path.join(cvs_directory.rcs_path, fname) for fname in dirs]
+          )
+
     # Map {cvs_file.rcs_basename : cvs_file.rcs_path} for files in an
     # Attic directory within cvs_directory:
     attic_rcsfiles = {}
@@ -250,6 +404,10 @@ class _RepositoryWalker(object):
     else:
       alldirs = dirs
 
+    # The listing of cvs_directory was needed only to check for
+    # conflicts with Attic files:
+    self._close_directory(cvs_directory)
+
     # Check for conflicts between directory names and the filenames
     # that will result from the rcs files (both in this directory and
     # in attic).  (We recurse into the subdirectories nevertheless, to
@@ -321,10 +479,15 @@ def walk_repository(project, file_key_generator, error_handler):
       file_key_generator.gen_id(), project, None, ''
       )
   project.root_cvs_directory_id = root_cvs_directory.id
-  repository_walker = _RepositoryWalker(file_key_generator, error_handler)
-  for cvs_path in repository_walker.generate_cvs_paths(
-        root_cvs_directory, project.exclude_paths
-        ):
-    yield cvs_path
+  repository_walker = _RepositoryWalker(
+      file_key_generator, error_handler, Ctx().walk_threads
+      )
+  try:
+    for cvs_path in repository_walker.generate_cvs_paths(
+          root_cvs_directory, project.exclude_paths
+          ):
+      yield cvs_path
+  finally:
+    repository_walker.close()
 
 
@@ -37,6 +37,8 @@ from cvs2svn_lib.rcs_revision_manager import RCSRevisionReader
 from cvs2svn_lib.cvs_revision_manager import CVSRevisionReader
 from cvs2svn_lib.checkout_internal import InternalRevisionCollector
 from cvs2svn_lib.checkout_internal import InternalRevisionReader
+from cvs2svn_lib.serializer import COMPRESSION_CODECS
+from cvs2svn_lib.serializer import parse_compression_spec
 from cvs2svn_lib.symbol_strategy import AllBranchRule
 from cvs2svn_lib.symbol_strategy import AllExcludedRule
 from cvs2svn_lib.symbol_strategy import AllTagRule
@@ -289,7 +291,15 @@ class RunOptions(object):
             '\\fB--help-passes\\fR, \\fB--version\\fR, '
             '\\fB-v\\fR/\\fB--verbose\\fR, \\fB-q\\fR/\\fB--quiet\\fR, '
             '\\fB-p\\fR/\\fB--pass\\fR/\\fB--passes\\fR, \\fB--dry-run\\fR, '
-            '\\fB--profile\\fR, \\fB--trunk-only\\fR, \\fB--encoding\\fR, '
+            '\\fB--profile\\fR, \\fB--trunk-only\\fR, \\fB--jobs\\fR, '
+            '\\fB--walk-threads\\fR, \\fB--sort-jobs\\fR, '
+            '\\fB--sort-compression\\fR, \\fB--sort-tmpdir\\fR, '
+            '\\fB--sort-memory\\fR, '
+            '\\fB--cycle-breaking-jobs\\fR, '
+            '\\fB--parse-cache\\fR, '
+            '\\fB--parse-cache-size\\fR, '
+            '\\fB--parse-cache-checksums\\fR, '
+            '\\fB--encoding\\fR, '
             'and \\fB--fallback-encoding\\fR. '
             'Options are processed in the order specified on the command '
             'line.'
@@ -666,6 +676,48 @@ class RunOptions(object):
             ),
         ))
 
+  def _add_internal_co_compression_option(self, group):
+    self.parser.set_default('internal_co_compression', None)
+    group.add_option(IncompatibleOption(
+        '--internal-co-compression', type='string',
+        action='store',
+        help=(
+            'compress the temporary files of --use-internal-co using CODEC '
+            '(one of %s), optionally at compression LEVEL '
+            '(default: zlib:9)' % (', '.join(COMPRESSION_CODECS),)
+            ),
+        man_help=(
+            'Compress the RCS deltas and fulltexts that '
+            '\\fB--use-internal-co\\fR stores in temporary files using '
+            '\\fIcodec\\fR, which can be \\fBzlib\\fR (the default), '
+            '\\fBbz2\\fR, \\fBlzma\\fR (if the lzma module is installed), '
+            'or \\fBnone\\fR.  \\fIlevel\\fR is the compression level to '
+            'use; its range and default depend on the codec.  The default '
+            'is \\fBzlib:9\\fR, which compresses well but is expensive in '
+            'CPU time; a lower level is often faster overall.  The amount '
+            'of data compressed and the time spent are logged in verbose '
+            'mode.'
+            ),
+        metavar='CODEC[:LEVEL]',
+        ))
+    self.parser.set_default('internal_co_dictionaries', False)
+    group.add_option(IncompatibleOption(
+        '--internal-co-dictionaries',
+        action='store_true',
+        help=(
+            'compress the RCS deltas of each file against a dictionary '
+            'taken from the file (requires zlib compression)'
+            ),
+        man_help=(
+            'Compress the RCS deltas that \\fB--use-internal-co\\fR stores '
+            'for each file against a preset dictionary sampled from the '
+            'HEAD revision of the file.  Small deltas compress much better '
+            'this way, which reduces the size of the temporary files for '
+            'repositories with many small commits.  This option requires '
+            'the zlib codec (see \\fB--internal-co-compression\\fR).'
+            ),
+        ))
+
   def _add_use_cvs_option(self, group):
     self.parser.set_default('use_cvs', False)
     group.add_option(IncompatibleOption(
@@ -711,6 +763,181 @@ class RunOptions(object):
             ) % (tempfile.gettempdir(),),
         metavar='PATH',
         ))
+    group.add_option(ContextOption(
+        '--jobs', '-j', type='int',
+        action='store',
+        compatible_with_option=True,
+        help=(
+            'use N worker processes to parse the CVS repository '
+            '(default 1)'
+            ),
+        man_help=(
+            'Use \\fIn\\fR worker processes to parse the *,v files in '
+            'the CVS repository during CollectRevsPass.  The results do '
+            'not depend on the number of jobs.  The default is 1, which '
+            'parses all files in the main process.'
+            ),
+        metavar='N',
+        ))
+    group.add_option(ContextOption(
+        '--walk-threads', type='int',
+        action='store',
+        compatible_with_option=True,
+        help=(
+            'use N threads to list the directories of the CVS repository '
+            '(default 1)'
+            ),
+        man_help=(
+            'Use \\fIn\\fR threads to list the directories of the CVS '
+            'repository and to stat() the files in them ahead of time '
+            'during CollectRevsPass.  This can speed up the conversion of '
+            'a repository on a filesystem with a high latency (for '
+            'example, over NFS).  The results do not depend on the number '
+            'of threads.  The default is 1.'
+            ),
+        metavar='N',
+        ))
+    group.add_option(ContextOption(
+        '--sort-jobs', type='int',
+        action='store',
+        compatible_with_option=True,
+        help=(
+            'use N worker processes to sort the intermediate data files '
+            '(default 1)'
+            ),
+        man_help=(
+            'Use \\fIn\\fR worker processes to sort the intermediate data '
+            'files in SortRevisionsPass, SortSymbolsPass, and '
+            'SortSymbolOpeningsClosingsPass.  The workers sort pieces of '
+            'each file and then merge them, each worker taking one range '
+            'of the sort keys.  The results do not depend on the number '
+            'of jobs.  The default is 1.'
+            ),
+        metavar='N',
+        ))
+    group.add_option(ContextOption(
+        '--sort-compression', type='string',
+        action='store',
+        compatible_with_option=True,
+        help=(
+            'compress the temporary files written while sorting using '
+            'codec CODEC (one of %s), optionally at compression LEVEL'
+            ) % (', '.join(COMPRESSION_CODECS),),
+        man_help=(
+            'Compress the temporary files that are written while sorting '
+            'the intermediate data files, using codec \\fIcodec\\fR '
+            '(one of %s), optionally at compression level \\fIlevel\\fR.  '
+            'This reduces the amount of temporary disk space and I/O '
+            'needed for sorting, at the cost of CPU time.  A fast setting '
+            'such as \\fBzlib:1\\fR is usually best.  By default the '
+            'temporary files are not compressed.'
+            ) % (', '.join(COMPRESSION_CODECS),),
+        metavar='CODEC[:LEVEL]',
+        ))
+    group.add_option(ManOption(
+        '--sort-tmpdir', type='string',
+        action='callback', callback=self.callback_sort_tmpdir,
+        help=(
+            'also put temporary files written while sorting into directory '
+            'PATH (this option can be specified multiple times)'
+            ),
+        man_help=(
+            'Also use directory \\fIpath\\fR for the temporary files that '
+            'are written while sorting the intermediate data files.  Each '
+            'temporary file is put into whichever of these directories '
+            'and the \\fB--tmpdir\\fR directory currently has the most '
+            'free space.  This option can be specified multiple times, for '
+            'example to spread the temporary files over several disks.'
+            ),
+        metavar='PATH',
+        ))
+    group.add_option(ManOption(
+        '--sort-memory', type='int',
+        action='callback', callback=self.callback_sort_memory,
+        help=(
+            'sort intermediate data files in memory if that is estimated '
+            'to need at most MB MiB of RAM (default %d)'
+            ) % (config.SORT_MEMORY_LIMIT // (1024 * 1024),),
+        man_help=(
+            'Sort the intermediate data files in memory in one step, '
+            'rather than sorting pieces of them and merging those via '
+            'temporary files, if that is estimated to need no more than '
+            '\\fImb\\fR MiB of RAM.  The estimate includes the overhead '
+            'of each record, so it is larger than the size of the file.  '
+            'Sorting in memory is faster, but it raises the peak memory '
+            'use of the sorting passes up to about this limit.  A value '
+            'of 0 makes all sorts use temporary files.  The default is %d.'
+            ) % (config.SORT_MEMORY_LIMIT // (1024 * 1024),),
+        metavar='MB',
+        ))
+    group.add_option(ContextOption(
+        '--cycle-breaking-jobs', type='int',
+        action='store',
+        compatible_with_option=True,
+        help=(
+            'use N worker processes to break changeset dependency cycles '
+            '(default 1)'
+            ),
+        man_help=(
+            'Use \\fIn\\fR worker processes to break the dependency '
+            'cycles among changesets in BreakRevisionChangesetCyclesPass '
+            'and BreakSymbolChangesetCyclesPass.  The cycles are then '
+            'broken one strongly connected component of the changeset '
+            'graph at a time, and the large components are handled by '
+            'the workers.  The results do not depend on the number of '
+            'jobs, but cycles can be broken in slightly different ways '
+            'than with the default of 1.'
+            ),
+        metavar='N',
+        ))
+    group.add_option(ContextOption(
+        '--parse-cache', type='string',
+        action='store', dest='parse_cache_dir',
+        compatible_with_option=True,
+        help=(
+            'cache the results of parsing the CVS repository in '
+            'directory PATH, to speed up later conversions'
+            ),
+        man_help=(
+            'Store the results of parsing each *,v file in directory '
+            '\\fIpath\\fR, and reuse them in later conversions for '
+            'files that have not changed in the meantime (as judged by '
+            'their size, modification time, and inode number).  This can '
+            'speed up CollectRevsPass a lot if the same repository is '
+            'converted repeatedly, for example while tuning the symbol '
+            'handling options.  The directory is not removed when the '
+            'conversion is over.'
+            ),
+        metavar='PATH',
+        ))
+    group.add_option(ManOption(
+        '--parse-cache-size', type='int',
+        action='callback', callback=self.callback_parse_cache_size,
+        help='limit the size of the --parse-cache directory to MB MiB',
+        man_help=(
+            'Limit the size of the \\fB--parse-cache\\fR directory to '
+            '\\fImb\\fR MiB by discarding the entries that were used '
+            'least recently.  By default the size is not limited.'
+            ),
+        metavar='MB',
+        ))
+    group.add_option(ContextOption(
+        '--parse-cache-checksums',
+        action='store_true',
+        compatible_with_option=True,
+        help=(
+            'only reuse cached parse results if the checksum of the '
+            'file also matches'
+            ),
+        man_help=(
+            'Only reuse the parse results stored in the '
+            '\\fB--parse-cache\\fR directory if the SHA-1 checksum of '
+            'the contents of the *,v file has not changed either.  This '
+            'protects against files that are modified without changing '
+            'their size or modification time, at the cost of reading '
+            'every *,v file in CollectRevsPass.'
+            ),
+        ))
     self.parser.set_default('co_executable', config.CO_EXECUTABLE)
     group.add_option(IncompatibleOption(
         '--co', type='string',
@@ -933,6 +1160,15 @@ class RunOptions(object):
           self.start_pass = \
           self.pass_manager.get_pass_number(value)
 
+  def callback_parse_cache_size(self, option, opt_str, value, parser):
+    Ctx().parse_cache_max_size = value * 1024 * 1024
+
+  def callback_sort_memory(self, option, opt_str, value, parser):
+    Ctx().sort_memory_limit = value * 1024 * 1024
+
+  def callback_sort_tmpdir(self, option, opt_str, value, parser):
+    Ctx().sort_tmpdirs.append(value)
+
   def callback_profile(self, option, opt_str, value, parser):
     self.profiling = True
 
@@ -981,6 +1217,18 @@ class RunOptions(object):
     not_both(options.use_cvs, '--use-cvs',
              options.use_internal_co, '--use-internal-co')
 
+    not_both(options.use_rcs, '--use-rcs',
+             options.internal_co_compression, '--internal-co-compression')
+
+    not_both(options.use_cvs, '--use-cvs',
+             options.internal_co_compression, '--internal-co-compression')
+
+    not_both(options.use_rcs, '--use-rcs',
+             options.internal_co_dictionaries, '--internal-co-dictionaries')
+
+    not_both(options.use_cvs, '--use-cvs',
+             options.internal_co_dictionaries, '--internal-co-dictionaries')
+
     if options.use_rcs:
       ctx.revision_collector = NullRevisionCollector()
       ctx.revision_reader = RCSRevisionReader(options.co_executable)
@@ -989,8 +1237,21 @@ class RunOptions(object):
       ctx.revision_reader = CVSRevisionReader(options.cvs_executable)
     else:
       # --use-internal-co is the default:
-      ctx.revision_collector = InternalRevisionCollector(compress=True)
-      ctx.revision_reader = InternalRevisionReader(compress=True)
+      (compress, codec, level) = (True, 'zlib', None)
+      if options.internal_co_compression is not None:
+        (codec, level) = parse_compression_spec(
+            options.internal_co_compression
+            )
+        if codec == 'none':
+          compress = False
+      ctx.revision_collector = InternalRevisionCollector(
+          compress=compress, codec=codec, level=level,
+          dictionaries=options.internal_co_dictionaries,
+          )
+      ctx.revision_reader = InternalRevisionReader(
+          compress=compress, codec=codec, level=level,
+          dictionaries=options.internal_co_dictionaries,
+          )
 
   def process_symbol_strategy_options(self):
     """Process symbol strategy-related options."""
@@ -1088,6 +1349,36 @@ class RunOptions(object):
       raise InvalidPassError(
           'Ending pass must not come before starting pass.')
 
+    if ctx.jobs < 1:
+      raise FatalError('The number of jobs must be at least 1.')
+
+    if ctx.walk_threads < 1:
+      raise FatalError('The number of walk threads must be at least 1.')
+
+    if ctx.sort_jobs < 1:
+      raise FatalError('The number of sort jobs must be at least 1.')
+
+    if ctx.cycle_breaking_jobs < 1:
+      raise FatalError(
+          'The number of cycle-breaking jobs must be at least 1.'
+          )
+
+    if ctx.cycle_breaking_min_parallel_scc_size < 1:
+      raise FatalError(
+          'The minimum size of the strongly connected components that are '
+          'handed to the cycle-breaking jobs must be at least 1.'
+          )
+
+    if ctx.sort_memory_limit is not None and ctx.sort_memory_limit < 0:
+      raise FatalError('The sort memory limit must not be negative.')
+
+    if ctx.sort_compression is not None:
+      parse_compression_spec(ctx.sort_compression)
+
+    for tmpdir in ctx.sort_tmpdirs:
+      if not os.path.isdir(tmpdir):
+        raise FatalError('Sort directory %r does not exist.' % (tmpdir,))
+
     if not ctx.dry_run and ctx.output_option is None:
       raise FatalError('No output option specified.')
 
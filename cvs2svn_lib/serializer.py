@@ -17,8 +17,12 @@
 import cStringIO
 import marshal
 import cPickle
+import time
 import zlib
 
+from cvs2svn_lib.common import FatalError
+from cvs2svn_lib.log import logger
+
 
 class Serializer:
   """An object able to serialize/deserialize some class of objects."""
@@ -119,25 +123,247 @@ class PrimedPickleSerializer(Serializer):
     return self.loadf(cStringIO.StringIO(s))
 
 
-class CompressingSerializer(Serializer):
-  """This class wraps other Serializers to compress their serialized data."""
+def _get_zlib_codec(level):
+  return (lambda s: zlib.compress(s, level), zlib.decompress,)
+
+
+def _get_bz2_codec(level):
+  import bz2
+
+  return (lambda s: bz2.compress(s, level), bz2.decompress,)
+
+
+def _get_lzma_codec(level):
+  try:
+    import lzma
+  except ImportError:
+    # The Python 2 backport of the Python 3 lzma module:
+    from backports import lzma
+
+  return (lambda s: lzma.compress(s, preset=level), lzma.decompress,)
+
+
+def _get_none_codec(level):
+  return (lambda s: s, lambda s: s,)
+
+
+# A map {codec_name : (get_codec, min_level, max_level, default_level)}
+# describing the compression codecs that can be used by
+# CompressingSerializer.  GET_CODEC(LEVEL) returns a tuple
+# (compress, decompress) of functions that take and return strings.
+_codecs = {
+    'zlib' : (_get_zlib_codec, 0, 9, 9,),
+    'bz2' : (_get_bz2_codec, 1, 9, 9,),
+    'lzma' : (_get_lzma_codec, 0, 9, 6,),
+    'none' : (_get_none_codec, 0, 0, 0,),
+    }
+
+COMPRESSION_CODECS = sorted(_codecs.keys())
+
+
+def get_compression_codec(codec, level=None):
+  """Return (compress, decompress) functions for CODEC at LEVEL.
 
-  def __init__(self, wrapee):
+  If LEVEL is None, use the codec's default level.  Raise FatalError
+  if CODEC is unknown or cannot be used, or if LEVEL is out of range."""
+
+  try:
+    (get_codec, min_level, max_level, default_level) = _codecs[codec]
+  except KeyError:
+    raise FatalError(
+        'Unknown compression codec %r (choose from %s)'
+        % (codec, ', '.join(COMPRESSION_CODECS),)
+        )
+
+  if level is None:
+    level = default_level
+  elif not min_level <= level <= max_level:
+    raise FatalError(
+        'The compression level for codec %r must be between %d and %d'
+        % (codec, min_level, max_level,)
+        )
+
+  try:
+    return get_codec(level)
+  except ImportError, e:
+    raise FatalError(
+        'Compression codec %r is not available: %s' % (codec, e,)
+        )
+
+
+def parse_compression_spec(spec):
+  """Parse a compression spec of the form CODEC[:LEVEL].
+
+  Return the tuple (codec, level), where LEVEL is None if it was not
+  specified.  Raise FatalError if SPEC is invalid."""
+
+  if ':' in spec:
+    (codec, level) = spec.split(':', 1)
+    try:
+      level = int(level)
+    except ValueError:
+      raise FatalError('Invalid compression level in %r' % (spec,))
+  else:
+    (codec, level) = (spec, None)
+
+  # Check that the codec can be used:
+  get_compression_codec(codec, level)
+  return (codec, level)
+
+
+class ZlibPresetDictionary:
+  """zlib compression of strings against a preset dictionary.
+
+  Each string is compressed separately, but as if it followed
+  DICTIONARY in a single zlib stream, so that it can refer back to
+  the contents of the dictionary.  This makes short strings that
+  resemble the dictionary compress much better.
+
+  Python 2's zlib module does not support preset dictionaries, so they
+  are emulated: a compressor and a decompressor are primed by passing
+  the dictionary through them (with a Z_SYNC_FLUSH, so that the
+  dictionary is completely processed), and each string is then
+  processed by a copy of the primed object.  Only the zlib window (the
+  last 32 kiB) of the dictionary is used."""
+
+  def __init__(self, dictionary, level=9):
+    self.dictionary = dictionary
+    self.level = level
+
+    # The primed compressor and decompressor, created when needed:
+    self._compressor = None
+    self._decompressor = None
+
+  def compress(self, s):
+    if self._compressor is None:
+      self._compressor = zlib.compressobj(self.level)
+      self._compressor.compress(self.dictionary)
+      self._compressor.flush(zlib.Z_SYNC_FLUSH)
+    compressor = self._compressor.copy()
+    return compressor.compress(s) + compressor.flush()
+
+  def decompress(self, compressed):
+    if self._decompressor is None:
+      # The decompressor only needs to see the dictionary, not the
+      # same encoding of it that the compressor produced, so prime it
+      # with a (cheap) uncompressed encoding:
+      compressor = zlib.compressobj(0)
+      self._decompressor = zlib.decompressobj()
+      self._decompressor.decompress(
+          compressor.compress(self.dictionary)
+          + compressor.flush(zlib.Z_SYNC_FLUSH)
+          )
+    decompressor = self._decompressor.copy()
+    return decompressor.decompress(compressed) + decompressor.flush()
+
+
+class CompressingSerializer(Serializer):
+  """This class wraps other Serializers to compress their serialized data.
+
+  The codec and compression level are pickled along with the
+  serializer, so a database that stores its serializer is read back
+  with the codec that it was written with.  The serializer also keeps
+  statistics about the data that it has compressed and decompressed
+  (which are not pickled); see log_stats()."""
+
+  # The codec used by serializers that were pickled before the codec
+  # could be chosen:
+  codec = 'zlib'
+  level = 9
+
+  def _get_description(self):
+    if self.level is None:
+      return self.codec
+    else:
+      return '%s:%d' % (self.codec, self.level,)
+
+  def __init__(self, wrapee, codec='zlib', level=None):
     """Constructor.  WRAPEE is the Serializer whose bitstream ought to be
-    compressed."""
+    compressed.  CODEC is one of COMPRESSION_CODECS and LEVEL is the
+    compression level to use, or None to use the codec's default."""
 
     self.wrapee = wrapee
+    self.codec = codec
+    self.level = level
+    self._init_codec()
+
+  def _init_codec(self):
+    (self._compress, self._decompress) = get_compression_codec(
+        self.codec, self.level
+        )
+
+    # The number of bytes passed to and returned by self._compress, and
+    # the time spent in it:
+    self.raw_bytes_written = 0
+    self.compressed_bytes_written = 0
+    self.compress_time = 0.0
+
+    # The number of bytes passed to and returned by self._decompress,
+    # and the time spent in it:
+    self.compressed_bytes_read = 0
+    self.raw_bytes_read = 0
+    self.decompress_time = 0.0
+
+  def __getstate__(self):
+    return (self.wrapee, self.codec, self.level,)
+
+  def __setstate__(self, state):
+    if isinstance(state, dict):
+      # Pickled before the codec could be chosen:
+      self.wrapee = state['wrapee']
+    else:
+      (self.wrapee, self.codec, self.level,) = state
+    self._init_codec()
+
+  def _compress_string(self, s):
+    start = time.time()
+    compressed = self._compress(s)
+    self.compress_time += time.time() - start
+    self.raw_bytes_written += len(s)
+    self.compressed_bytes_written += len(compressed)
+    return compressed
+
+  def _decompress_string(self, compressed):
+    start = time.time()
+    s = self._decompress(compressed)
+    self.decompress_time += time.time() - start
+    self.compressed_bytes_read += len(compressed)
+    self.raw_bytes_read += len(s)
+    return s
 
   def dumpf(self, f, object):
-    marshal.dump(zlib.compress(self.wrapee.dumps(object), 9), f)
+    marshal.dump(self._compress_string(self.wrapee.dumps(object)), f)
 
   def dumps(self, object):
-    return marshal.dumps(zlib.compress(self.wrapee.dumps(object), 9))
+    return marshal.dumps(self._compress_string(self.wrapee.dumps(object)))
 
   def loadf(self, f):
-    return self.wrapee.loads(zlib.decompress(marshal.load(f)))
+    return self.wrapee.loads(self._decompress_string(marshal.load(f)))
 
   def loads(self, s):
-    return self.wrapee.loads(zlib.decompress(marshal.loads(s)))
+    return self.wrapee.loads(self._decompress_string(marshal.loads(s)))
+
+  def log_stats(self, name):
+    """Log the compression statistics, describing the data as NAME."""
+
+    if self.raw_bytes_written:
+      logger.verbose(
+          '%s (%s): compressed %d bytes to %d (%.1f%%) in %.2f seconds'
+          % (
+              name, self._get_description(),
+              self.raw_bytes_written, self.compressed_bytes_written,
+              100.0 * self.compressed_bytes_written / self.raw_bytes_written,
+              self.compress_time,
+              )
+          )
+    if self.compressed_bytes_read:
+      logger.verbose(
+          '%s (%s): decompressed %d bytes to %d in %.2f seconds'
+          % (
+              name, self._get_description(),
+              self.compressed_bytes_read, self.raw_bytes_read,
+              self.decompress_time,
+              )
+          )
 
 
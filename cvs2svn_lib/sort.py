@@ -26,15 +26,167 @@ under the MIT license.
 
 
 import os
+import sys
+import struct
 import shutil
 import heapq
+import bisect
 import itertools
 import tempfile
+import threading
+import Queue
+import cStringIO
+import multiprocessing
+
+from cvs2svn_lib.log import logger
+from cvs2svn_lib.serializer import get_compression_codec
 
 
 # The buffer size to use for open files:
 BUFSIZE = 64 * 1024
 
+# While merging, the buffers of the input files together take up
+# about this much memory, but each is at least BUFSIZE and at most
+# MAX_BUFSIZE bytes large.  The buffer of the output file is
+# MAX_BUFSIZE bytes large.
+MERGE_BUFFER_MEMORY = 32 * 1024 * 1024
+MAX_BUFSIZE = 4 * 1024 * 1024
+
+# If the temporary files are compressed, they consist of blocks, each
+# holding the compressed data of records totaling about this many
+# bytes:
+RUN_BLOCK_SIZE = 256 * 1024
+
+# While merging, each input file is read by a thread that reads
+# batches of READ_AHEAD_BATCH_SIZE records and keeps up to
+# READ_AHEAD_BATCHES of them ready for the merge:
+READ_AHEAD_BATCH_SIZE = 256
+READ_AHEAD_BATCHES = 4
+
+# The memory that an in-memory sort needs is estimated from this many
+# records at the start of the file:
+MEMORY_ESTIMATE_SAMPLE_SIZE = 1000
+
+# The size of a slot in a list, and of the objects that list.sort()
+# uses to pair each record with its key:
+LIST_SLOT_SIZE = struct.calcsize('P')
+SORT_WRAPPER_SIZE = 4 * struct.calcsize('P')
+
+
+class LineFormat(object):
+  """The records of a file are its lines (each ending with a newline).
+
+  A record format tells the functions in this module how to divide
+  a file into the records that are to be sorted.  Records are sorted
+  as strings, or by the sort key that a KEY function computes from
+  them."""
+
+  def iter_records(self, f):
+    """Iterate over the records in file F, starting at its position."""
+
+    return iter(f)
+
+  def split(self, filename, piece_size):
+    """Return a list [(start, end)] splitting file FILENAME into pieces.
+
+    Each piece is at least PIECE_SIZE bytes long (except maybe the
+    last one) and starts at the start of a record."""
+
+    size = os.path.getsize(filename)
+    offsets = [0]
+    f = open(filename, 'rb')
+    try:
+      while True:
+        f.seek(offsets[-1] + piece_size)
+        f.readline()
+        offset = f.tell()
+        if offset >= size:
+          break
+        offsets.append(offset)
+    finally:
+      f.close()
+    offsets.append(size)
+    return zip(offsets[:-1], offsets[1:])
+
+
+class LengthPrefixedFormat(object):
+  """Each record consists of a key, a length, and a payload.
+
+  The key is KEY_SIZE bytes long.  It is followed by the length of the
+  payload, as a 32-bit big-endian integer, and then by the payload
+  itself.  If the keys are unique and compare (as strings) in the
+  desired order, the records can be sorted as strings without a KEY
+  function, and the comparisons never look past the keys."""
+
+  _length = struct.Struct('>I')
+
+  # The size of the blocks in which the headers are read by split():
+  SPLIT_BLOCK_SIZE = 1024 * 1024
+
+  def __init__(self, key_size):
+    self.key_size = key_size
+    self.header_size = key_size + self._length.size
+
+  def pack(self, key, payload):
+    """Return the record with KEY (a string) and PAYLOAD."""
+
+    return key + self._length.pack(len(payload)) + payload
+
+  def get_payload(self, record):
+    """Return the payload of RECORD."""
+
+    return record[self.header_size:]
+
+  def iter_records(self, f):
+    header_size = self.header_size
+    key_size = self.key_size
+    unpack_from = self._length.unpack_from
+    read = f.read
+    while True:
+      header = read(header_size)
+      if len(header) < header_size:
+        if header:
+          raise EOFError('Truncated record in %r' % (getattr(f, 'name', f),))
+        return
+      (length,) = unpack_from(header, key_size)
+      payload = read(length)
+      if len(payload) < length:
+        raise EOFError('Truncated record in %r' % (getattr(f, 'name', f),))
+      yield header + payload
+
+  def split(self, filename, piece_size):
+    """Return a list [(start, end)] splitting file FILENAME into pieces.
+
+    See LineFormat.split().  The record boundaries are found by
+    walking through the record headers."""
+
+    size = os.path.getsize(filename)
+    offsets = [0]
+    f = open(filename, 'rb')
+    try:
+      block_start = 0
+      block = ''
+      pos = 0
+      while pos < size:
+        if pos + self.header_size > block_start + len(block):
+          f.seek(pos)
+          block = f.read(self.SPLIT_BLOCK_SIZE)
+          block_start = pos
+        (length,) = self._length.unpack_from(
+            block, pos - block_start + self.key_size
+            )
+        pos += self.header_size + length
+        if pos < size and pos - offsets[-1] >= piece_size:
+          offsets.append(pos)
+    finally:
+      f.close()
+    offsets.append(size)
+    return zip(offsets[:-1], offsets[1:])
+
+
+# The default record format:
+LINES = LineFormat()
+
 
 def get_default_max_merge():
   """Return the default maximum number of files to merge at once."""
@@ -59,6 +211,24 @@ def get_default_max_merge():
 DEFAULT_MAX_MERGE = get_default_max_merge()
 
 
+# When sorting in parallel, the sort key of every INDEX_INTERVAL-th
+# record of each sorted run (or of the first record of each block, if
+# the runs are compressed) is recorded, together with the record's
+# offset in the file.  These samples are used to split the final merge
+# into key ranges:
+INDEX_INTERVAL = 1024
+
+# When sorting in parallel, the input file is divided into about this
+# many pieces per job for generating the sorted runs, but no piece is
+# smaller than MIN_PIECE_SIZE bytes:
+PIECES_PER_JOB = 4
+MIN_PIECE_SIZE = 1024 * 1024
+
+# When sorting in parallel, the final merge is split into this many
+# key ranges per job:
+RANGES_PER_JOB = 2
+
+
 def merge(iterables, key=None):
   """Merge (in the sense of mergesort) ITERABLES.
 
@@ -92,24 +262,195 @@ def merge(iterables, key=None):
       heapq.heappush(values, (key(value), index, value, iterator))
 
 
-def merge_files_onepass(input_filenames, output_filename, key=None):
+def _get_merge_bufsize(fan_in):
+  """Return the buffer size to use for each of FAN_IN merge inputs."""
+
+  return max(BUFSIZE, min(MAX_BUFSIZE, MERGE_BUFFER_MEMORY // max(fan_in, 1)))
+
+
+class _RunWriter(object):
+  """Write sorted records to a run file, and record the run's index.
+
+  If COMPRESSION is None, the records are written as they are.
+  Otherwise it is a tuple (codec, level) as accepted by
+  serializer.get_compression_codec(), and the records are collected
+  into blocks of about RUN_BLOCK_SIZE bytes.  Each block is written as
+  the length of its compressed data (as a 32-bit big-endian integer)
+  followed by the compressed data.  Blocks always end at the end of a
+  record.
+
+  The index is a list [(key, offset)] of the sort keys of some of the
+  records and their offsets in the file: of every INDEX_INTERVAL-th
+  record starting with the first one, or, if the run is compressed, of
+  the first record of each block.  (If KEY is None, the key of a
+  record is the record itself.)"""
+
+  _length = struct.Struct('>I')
+
+  def __init__(self, filename, key=None, compression=None, bufsize=BUFSIZE):
+    self.key = key
+    if compression is None:
+      self._compress = None
+    else:
+      self._compress = get_compression_codec(*compression)[0]
+    self.f = open(filename, 'wb', bufsize)
+    self.index = []
+    self._offset = 0
+    self._count = 0
+    self._block = []
+    self._block_size = 0
+
+  def _add_to_index(self, record):
+    if self.key is None:
+      self.index.append((record, self._offset))
+    else:
+      self.index.append((self.key(record), self._offset))
+
+  def _write_block(self):
+    s = self._compress(''.join(self._block))
+    self.f.write(self._length.pack(len(s)))
+    self.f.write(s)
+    self._offset += self._length.size + len(s)
+    self._block = []
+    self._block_size = 0
+
+  def write(self, record):
+    if self._compress is None:
+      if self._count % INDEX_INTERVAL == 0:
+        self._add_to_index(record)
+      self.f.write(record)
+      self._offset += len(record)
+    else:
+      if not self._block:
+        self._add_to_index(record)
+      self._block.append(record)
+      self._block_size += len(record)
+      if self._block_size >= RUN_BLOCK_SIZE:
+        self._write_block()
+    self._count += 1
+
+  def writelines(self, records):
+    for record in records:
+      self.write(record)
+
+  def close(self):
+    """Close the file and return the index."""
+
+    if self._block:
+      self._write_block()
+    self.f.close()
+    self.f = None
+    return self.index
+
+
+def _iter_run_records(f, record_format=LINES, compression=None):
+  """Iterate over the records of a run file F, written by _RunWriter.
+
+  Start at the current position of F, which must be at the start of a
+  record (or, if COMPRESSION is set, of a block)."""
+
+  if compression is None:
+    for record in record_format.iter_records(f):
+      yield record
+    return
+
+  decompress = get_compression_codec(*compression)[1]
+  length = _RunWriter._length
+  while True:
+    header = f.read(length.size)
+    if not header:
+      return
+    (n,) = length.unpack(header)
+    block = decompress(f.read(n))
+    for record in record_format.iter_records(cStringIO.StringIO(block)):
+      yield record
+
+
+def _read_ahead(records):
+  """Iterate over RECORDS, reading them in a separate thread.
+
+  This allows reading (and decompressing) the input files of a merge
+  to overlap with the merge itself."""
+
+  queue = Queue.Queue(READ_AHEAD_BATCHES)
+  stopped = []
+
+  def read():
+    try:
+      batch = []
+      for record in records:
+        batch.append(record)
+        if len(batch) >= READ_AHEAD_BATCH_SIZE:
+          queue.put(batch)
+          batch = []
+          if stopped:
+            return
+      queue.put(batch)
+      queue.put(None)
+    except:
+      queue.put(sys.exc_info())
+
+  thread = threading.Thread(target=read)
+  thread.setDaemon(True)
+  thread.start()
+  try:
+    while True:
+      batch = queue.get()
+      if batch is None:
+        break
+      elif isinstance(batch, tuple):
+        raise batch[0], batch[1], batch[2]
+      for record in batch:
+        yield record
+  finally:
+    # If the iteration was stopped early, let the thread finish:
+    stopped.append(True)
+    while thread.isAlive():
+      try:
+        queue.get(True, 0.1)
+      except Queue.Empty:
+        pass
+
+
+def merge_files_onepass(
+    input_filenames, output_filename, key=None, record_format=LINES,
+    input_compression=None, output_compression=None,
+    ):
   """Merge a number of input files into one output file.
 
   This is a merge in the sense of mergesort; namely, it is assumed
   that the input files are each sorted, and (under that assumption)
-  the output file will also be sorted."""
+  the output file will also be sorted.  The files consist of records
+  in RECORD_FORMAT.  The input files and the output file are
+  compressed according to INPUT_COMPRESSION and OUTPUT_COMPRESSION
+  (see _RunWriter)."""
 
   input_filenames = list(input_filenames)
-  if len(input_filenames) == 1:
+  if len(input_filenames) == 1 and input_compression == output_compression:
     shutil.move(input_filenames[0], output_filename)
   else:
-    output_file = file(output_filename, 'wb', BUFSIZE)
+    bufsize = _get_merge_bufsize(len(input_filenames))
+    output_file = _RunWriter(
+        output_filename, compression=output_compression, bufsize=MAX_BUFSIZE,
+        )
     try:
       chunks = []
       try:
         for input_filename in input_filenames:
-          chunks.append(open(input_filename, 'rb', BUFSIZE))
-        output_file.writelines(merge(chunks, key))
+          chunks.append(open(input_filename, 'rb', bufsize))
+        output_file.writelines(
+            merge(
+                [
+                    _read_ahead(
+                        _iter_run_records(
+                            chunk, record_format, input_compression
+                            )
+                        )
+                    for chunk in chunks
+                    ],
+                key,
+                )
+            )
       finally:
         for chunk in chunks:
           try:
@@ -130,21 +471,45 @@ def _try_delete_files(filenames):
       pass
 
 
+def _get_free_space(path):
+  """Return the number of bytes available in the filesystem of PATH."""
+
+  s = os.statvfs(path)
+  return s.f_bavail * s.f_frsize
+
+
 def tempfile_generator(tempdirs=[]):
-  """Yield filenames of temporary files."""
+  """Yield filenames of temporary files.
+
+  If there are several TEMPDIRS, put each file into the one that
+  currently has the most free space, trying them in turn when there
+  is a tie.  If the free space cannot be determined, simply use them
+  in turn."""
+
+  if not tempdirs:
+    tempdirs = [tempfile.gettempdir()]
 
   # Create an iterator that will choose directories to hold the
   # temporary files:
-  if tempdirs:
-    tempdirs = itertools.cycle(tempdirs)
-  else:
-    tempdirs = itertools.repeat(tempfile.gettempdir())
+  tempdirs_cycle = itertools.cycle(tempdirs)
 
   i = 0
   while True:
-    (fd, filename) = tempfile.mkstemp(
-        '', 'sort%06i-' % (i,), tempdirs.next(), False
-        )
+    # The directories in the order in which they would be used in
+    # turn:
+    candidates = [tempdirs_cycle.next() for tempdir in tempdirs]
+    tempdir = candidates[0]
+    if len(candidates) > 1:
+      try:
+        free_space = [_get_free_space(candidate) for candidate in candidates]
+      except (AttributeError, OSError):
+        pass
+      else:
+        tempdir = candidates[free_space.index(max(free_space))]
+    # Start the next cycle after the first candidate:
+    for j in range(len(candidates) - 1):
+      tempdirs_cycle.next()
+    (fd, filename) = tempfile.mkstemp('', 'sort%06i-' % (i,), tempdir, False)
     os.close(fd)
     yield filename
     i += 1
@@ -152,7 +517,8 @@ def tempfile_generator(tempdirs=[]):
 
 def _merge_file_generation(
     input_filenames, delete_inputs, key=None,
-    max_merge=DEFAULT_MAX_MERGE, tempfiles=None,
+    max_merge=DEFAULT_MAX_MERGE, tempfiles=None, record_format=LINES,
+    input_compression=None, compression=None,
     ):
   """Merge multiple input files into fewer output files.
 
@@ -166,7 +532,9 @@ def _merge_file_generation(
   they are no longer needed.
 
   If temporary files need to be used, they will be created using the
-  specified TEMPFILES tempfile generator.
+  specified TEMPFILES tempfile generator.  The input files are
+  compressed according to INPUT_COMPRESSION, the output files
+  according to COMPRESSION (see _RunWriter).
 
   Generate the names of the output files."""
 
@@ -184,7 +552,10 @@ def _merge_file_generation(
     group = filenames[:max_merge]
     del filenames[:max_merge]
     group_output = tempfiles.next()
-    merge_files_onepass(group, group_output, key=key)
+    merge_files_onepass(
+        group, group_output, key=key, record_format=record_format,
+        input_compression=input_compression, output_compression=compression,
+        )
     if delete_inputs:
       _try_delete_files(group)
     yield group_output
@@ -192,7 +563,8 @@ def _merge_file_generation(
 
 def merge_files(
     input_filenames, output_filename, key=None, delete_inputs=False,
-    max_merge=DEFAULT_MAX_MERGE, tempfiles=None,
+    max_merge=DEFAULT_MAX_MERGE, tempfiles=None, record_format=LINES,
+    input_compression=None, compression=None,
     ):
   """Merge a number of input files into one output file.
 
@@ -206,7 +578,12 @@ def merge_files(
   they are no longer needed.
 
   If temporary files need to be used, they will be created using the
-  specified TEMPFILES tempfile generator."""
+  specified TEMPFILES tempfile generator, and compressed according to
+  COMPRESSION (see _RunWriter).
+
+  The files consist of records in RECORD_FORMAT.  The input files are
+  compressed according to INPUT_COMPRESSION; the output file is not
+  compressed."""
 
   filenames = list(input_filenames)
   if not filenames:
@@ -220,33 +597,381 @@ def merge_files(
       filenames = list(
           _merge_file_generation(
               filenames, delete_inputs, key=key,
-              max_merge=max_merge, tempfiles=tempfiles
+              max_merge=max_merge, tempfiles=tempfiles,
+              record_format=record_format,
+              input_compression=input_compression, compression=compression,
               )
           )
       # After the first iteration, we are only working with temporary
       # files so they can definitely be deleted them when we are done
       # with them:
       delete_inputs = True
+      input_compression = compression
 
     # The last merge writes the results directly into the output
     # file:
-    merge_files_onepass(filenames, output_filename, key=key)
+    merge_files_onepass(
+        filenames, output_filename, key=key, record_format=record_format,
+        input_compression=input_compression,
+        )
     if delete_inputs:
       _try_delete_files(filenames)
 
 
+def _sort_piece(args):
+  """Sort the records of one piece of an input file into sorted runs.
+
+  ARGS is a tuple (input, start, end, key, buffer_size, tempdirs,
+  record_format, compression).  Sort the records between byte offsets
+  START and END of file INPUT (which must both be at the start of a
+  record) in chunks of BUFFER_SIZE records, and write each chunk to a
+  temporary file in one of TEMPDIRS, compressed according to
+  COMPRESSION.  Return a list [(filename, index)] for the runs, in the
+  order of their records in the input.  This function is run in
+  worker processes by _parallel_sort_file()."""
+
+  (
+      input, start, end, key, buffer_size, tempdirs, record_format,
+      compression,
+      ) = args
+  tempfiles = tempfile_generator(tempdirs)
+
+  def iter_records(f):
+    pos = start
+    for record in record_format.iter_records(f):
+      if pos >= end:
+        break
+      yield record
+      pos += len(record)
+
+  runs = []
+  input_file = open(input, 'rb', BUFSIZE)
+  try:
+    input_file.seek(start)
+    input_iterator = iter_records(input_file)
+    while True:
+      current_chunk = list(itertools.islice(input_iterator, buffer_size))
+      if not current_chunk:
+        break
+      current_chunk.sort(key=key)
+      filename = tempfiles.next()
+      writer = _RunWriter(filename, key, compression)
+      writer.writelines(current_chunk)
+      runs.append((filename, writer.close()))
+  finally:
+    input_file.close()
+  return runs
+
+
+def _iter_run(
+      filename, start, key=None, lo=None, hi=None, record_format=LINES,
+      compression=None, bufsize=BUFSIZE,
+      ):
+  """Iterate over the records of a sorted run in a key range.
+
+  Read file FILENAME from offset START, which must be an offset from
+  the run's index.  Skip records whose keys are less than or equal to
+  LO, and stop at the first record whose key is greater than HI.  A
+  value of None for LO or HI means that there is no bound on that
+  side."""
+
+  f = open(filename, 'rb', bufsize)
+  try:
+    f.seek(start)
+    for record in _iter_run_records(f, record_format, compression):
+      if key is None:
+        k = record
+      else:
+        k = key(record)
+      if lo is not None and k <= lo:
+        continue
+      if hi is not None and k > hi:
+        break
+      yield record
+  finally:
+    f.close()
+
+
+def _merge_runs(args):
+  """Merge (parts of) sorted runs into one output run.
+
+  ARGS is a tuple (inputs, output, key, lo, hi, record_format,
+  input_compression, output_compression), where INPUTS is a list
+  [(filename, start)].  Merge the records of the input files whose
+  keys are in the range (LO, HI] (see _iter_run()) into file OUTPUT.
+  Records with equal keys are taken from the input files in the order
+  that they are listed.  Return the index of the output (see
+  _RunWriter).  This function is run in worker processes by
+  _parallel_sort_file()."""
+
+  (
+      inputs, output, key, lo, hi, record_format,
+      input_compression, output_compression,
+      ) = args
+  bufsize = _get_merge_bufsize(len(inputs))
+  iterables = [
+      _read_ahead(
+          _iter_run(
+              filename, start, key, lo, hi, record_format,
+              input_compression, bufsize,
+              )
+          )
+      for (filename, start) in inputs
+      ]
+  writer = _RunWriter(output, key, output_compression, MAX_BUFSIZE)
+  writer.writelines(merge(iterables, key))
+  return writer.close()
+
+
+def _choose_splitters(runs, range_count):
+  """Choose the keys that split the final merge into key ranges.
+
+  RUNS is a list [(filename, index)].  Return a sorted list of at
+  most RANGE_COUNT - 1 distinct keys, chosen from the run indexes so
+  that the ranges contain roughly equal numbers of records."""
+
+  samples = []
+  for (filename, index) in runs:
+    samples.extend([k for (k, offset) in index])
+  samples.sort()
+  if not samples:
+    return []
+
+  splitters = []
+  for i in range(1, range_count):
+    k = samples[i * len(samples) // range_count]
+    if not splitters or k > splitters[-1]:
+      splitters.append(k)
+  return splitters
+
+
+def _range_inputs(runs, lo):
+  """Return a list [(filename, start)] for merging the range above LO.
+
+  START is the offset in each run from which the records with keys
+  greater than LO can be found, according to the run's index."""
+
+  inputs = []
+  for (filename, index) in runs:
+    if lo is None:
+      inputs.append((filename, 0))
+    else:
+      i = bisect.bisect_right([k for (k, offset) in index], lo) - 1
+      if i < 0:
+        inputs.append((filename, 0))
+      else:
+        inputs.append((filename, index[i][1]))
+  return inputs
+
+
+def _parallel_sort_file(
+      input, output, key, buffer_size, tempfiles, tempdirs, max_merge, jobs,
+      record_format, compression,
+      ):
+  """Sort file INPUT into file OUTPUT using JOBS worker processes.
+
+  The workers first sort pieces of the input into runs.  If there are
+  more than MAX_MERGE runs, groups of neighboring runs are merged
+  until there are few enough.  Then the runs are merged in parallel,
+  one key range at a time, and the merged ranges are concatenated to
+  form the output.  Since the runs are always merged in the order of
+  their records in the input and the key ranges do not overlap, the
+  output is identical to that of a serial sort."""
+
+  runs = []
+  pool = multiprocessing.Pool(jobs)
+  try:
+    try:
+      piece_size = max(
+          os.path.getsize(input) // (jobs * PIECES_PER_JOB), MIN_PIECE_SIZE
+          )
+      pieces = record_format.split(input, piece_size)
+      for piece_runs in pool.map(
+            _sort_piece,
+            [
+                (input, start, end, key, buffer_size, tempdirs,
+                 record_format, compression)
+                for (start, end) in pieces
+                ],
+            chunksize=1,
+            ):
+        runs.extend(piece_runs)
+
+      while len(runs) > max_merge:
+        groups = [
+            runs[i:i + max_merge]
+            for i in range(0, len(runs), max_merge)
+            ]
+        outputs = [tempfiles.next() for group in groups]
+        indexes = pool.map(
+            _merge_runs,
+            [
+                ([(filename, 0) for (filename, index) in group],
+                 group_output, key, None, None, record_format,
+                 compression, compression)
+                for (group, group_output) in zip(groups, outputs)
+                ],
+            chunksize=1,
+            )
+        _try_delete_files([filename for (filename, index) in runs])
+        runs = zip(outputs, indexes)
+
+      bounds = [None] + _choose_splitters(runs, jobs * RANGES_PER_JOB) + [None]
+      range_outputs = [tempfiles.next() for i in range(len(bounds) - 1)]
+      try:
+        pool.map(
+            _merge_runs,
+            [
+                (_range_inputs(runs, lo), range_output, key, lo, hi,
+                 record_format, compression, None)
+                for (lo, hi, range_output) in zip(
+                    bounds[:-1], bounds[1:], range_outputs
+                    )
+                ],
+            chunksize=1,
+            )
+        _try_delete_files([filename for (filename, index) in runs])
+        runs = []
+
+        output_file = open(output, 'wb', MAX_BUFSIZE)
+        try:
+          for range_output in range_outputs:
+            f = open(range_output, 'rb', MAX_BUFSIZE)
+            try:
+              shutil.copyfileobj(f, output_file, MAX_BUFSIZE)
+            finally:
+              f.close()
+            os.remove(range_output)
+        finally:
+          output_file.close()
+      finally:
+        _try_delete_files(range_outputs)
+    finally:
+      pool.close()
+      pool.join()
+  finally:
+    _try_delete_files([filename for (filename, index) in runs])
+
+
+def _sizeof(o):
+  """Return the number of bytes of memory taken up by O.
+
+  The items of tuples are included (even if they are shared with other
+  objects, so the result can be too high)."""
+
+  size = sys.getsizeof(o)
+  if isinstance(o, tuple):
+    for item in o:
+      size += _sizeof(item)
+  return size
+
+
+def _estimate_sort_memory(input, key, record_format):
+  """Estimate how much memory _sort_file_in_memory() needs for INPUT.
+
+  The estimate is extrapolated from the records at the start of the
+  file.  Each record takes up a string object and a slot in the list
+  of records.  If KEY is set, list.sort() also holds the key of each
+  record and an object pairing it with the record."""
+
+  f = open(input, 'rb', BUFSIZE)
+  try:
+    sample = list(
+        itertools.islice(
+            record_format.iter_records(f), MEMORY_ESTIMATE_SAMPLE_SIZE
+            )
+        )
+  finally:
+    f.close()
+
+  sample_size = sum([len(record) for record in sample])
+  if sample_size == 0:
+    return 0
+
+  sample_memory = 0
+  for record in sample:
+    sample_memory += sys.getsizeof(record) + LIST_SLOT_SIZE
+    if key is not None:
+      sample_memory += _sizeof(key(record)) + SORT_WRAPPER_SIZE
+
+  return os.path.getsize(input) * sample_memory // sample_size
+
+
+def _sort_file_in_memory(input, output, key, record_format):
+  """Sort the records of file INPUT into file OUTPUT in one step."""
+
+  input_file = open(input, 'rb', MAX_BUFSIZE)
+  try:
+    records = list(record_format.iter_records(input_file))
+  finally:
+    input_file.close()
+
+  records.sort(key=key)
+
+  output_file = open(output, 'wb', MAX_BUFSIZE)
+  try:
+    output_file.writelines(records)
+  finally:
+    output_file.close()
+
+
 def sort_file(
       input, output, key=None,
-      buffer_size=32000, tempdirs=[], max_merge=DEFAULT_MAX_MERGE,
+      buffer_size=32000, tempdirs=[], max_merge=DEFAULT_MAX_MERGE, jobs=1,
+      record_format=LINES, compression=None, memory_limit=None,
       ):
+  """Sort the records of file INPUT into file OUTPUT.
+
+  The files consist of records in RECORD_FORMAT (by default, lines).
+  If MEMORY_LIMIT is set and sorting INPUT in memory is estimated to
+  take no more than MEMORY_LIMIT bytes of memory (see
+  _estimate_sort_memory()), read the whole file, sort it in memory,
+  and write it out.  This takes more memory than the file's size,
+  especially if its records are short or KEY is set.  Otherwise, sort
+  chunks of BUFFER_SIZE records in memory, write them
+  to temporary files in TEMPDIRS, and merge those.  If KEY is
+  specified, it should be a function that returns the sort key of a
+  record.  Records with equal keys are kept in their input order.
+
+  If COMPRESSION is set, it is a tuple (codec, level) as accepted by
+  serializer.get_compression_codec(), and the temporary files are
+  compressed using that codec.
+
+  If JOBS is greater than one, sort using that many worker processes
+  (see _parallel_sort_file()).  The output is the same either way, but
+  in that case KEY must be picklable (e.g., a module-level function)."""
+
+  size = os.path.getsize(input)
+  # An in-memory sort always needs at least the size of the file:
+  if memory_limit is not None and size <= memory_limit:
+    memory = _estimate_sort_memory(input, key, record_format)
+    if memory <= memory_limit:
+      logger.normal(
+          'Sorting %d bytes in memory (about %d bytes needed, limit %d).'
+          % (size, memory, memory_limit,)
+          )
+      _sort_file_in_memory(input, output, key, record_format)
+      return
+
+  logger.normal(
+      'Sorting %d bytes using temporary files with %d job(s).' % (size, jobs,)
+      )
+
   tempfiles = tempfile_generator(tempdirs)
 
+  if jobs > 1:
+    _parallel_sort_file(
+        input, output, key, buffer_size, tempfiles, tempdirs, max_merge, jobs,
+        record_format, compression,
+        )
+    return
+
   filenames = []
 
   input_file = file(input, 'rb', BUFSIZE)
   try:
     try:
-      input_iterator = iter(input_file)
+      input_iterator = record_format.iter_records(input_file)
       while True:
         current_chunk = list(itertools.islice(input_iterator, buffer_size))
         if not current_chunk:
@@ -254,19 +979,135 @@ def sort_file(
         current_chunk.sort(key=key)
         filename = tempfiles.next()
         filenames.append(filename)
-        f = open(filename, 'w+b', BUFSIZE)
+        writer = _RunWriter(filename, compression=compression)
         try:
-          f.writelines(current_chunk)
+          writer.writelines(current_chunk)
         finally:
-          f.close()
+          writer.close()
     finally:
       input_file.close()
 
     merge_files(
         filenames, output, key=key,
         delete_inputs=True, max_merge=max_merge, tempfiles=tempfiles,
+        record_format=record_format,
+        input_compression=compression, compression=compression,
         )
   finally:
     _try_delete_files(filenames)
 
 
+class SortedRunWriter(object):
+  """Write records to a file as a sequence of sorted runs.
+
+  The records passed to write() (one record per call) are collected in
+  memory.  Whenever there are BUFFER_SIZE of them, they are sorted by
+  KEY and appended to the file as one run.  The file can then be
+  sorted by merge_sorted_runs(), which only has to merge the runs.
+  Records with equal keys end up in their input order, as with
+  sort_file()."""
+
+  def __init__(self, filename, key=None, buffer_size=32000):
+    self.key = key
+    self.buffer_size = buffer_size
+    self.f = open(filename, 'wb', MAX_BUFSIZE)
+    self.run_starts = []
+    self._records = []
+
+  def _write_run(self):
+    self._records.sort(key=self.key)
+    self.run_starts.append(self.f.tell())
+    self.f.writelines(self._records)
+    self._records = []
+
+  def write(self, record):
+    self._records.append(record)
+    if len(self._records) >= self.buffer_size:
+      self._write_run()
+
+  def close(self):
+    """Close the file and return a list of the offsets of the runs."""
+
+    if self._records:
+      self._write_run()
+    self.f.close()
+    self.f = None
+    return self.run_starts
+
+
+def _iter_segment(filename, start, end, record_format=LINES, bufsize=BUFSIZE):
+  """Iterate over the records between offsets START and END of FILENAME."""
+
+  f = open(filename, 'rb', bufsize)
+  try:
+    f.seek(start)
+    pos = start
+    for record in record_format.iter_records(f):
+      if pos >= end:
+        break
+      yield record
+      pos += len(record)
+  finally:
+    f.close()
+
+
+def merge_sorted_runs(
+      input, run_starts, output, key=None,
+      tempdirs=[], max_merge=DEFAULT_MAX_MERGE, record_format=LINES,
+      compression=None,
+      ):
+  """Merge the sorted runs of file INPUT into file OUTPUT.
+
+  RUN_STARTS is the list of the offsets of the runs in INPUT, as
+  returned by SortedRunWriter.close().  If there are more than
+  MAX_MERGE runs, groups of them are first merged into temporary files
+  in TEMPDIRS, compressed according to COMPRESSION (see sort_file()).
+  The output is the same as that of sort_file() for the same records."""
+
+  size = os.path.getsize(input)
+  logger.normal(
+      'Merging %d sorted runs of %d bytes.' % (len(run_starts), size,)
+      )
+
+  segments = zip(run_starts, run_starts[1:] + [size])
+
+  def merge_segments(segments, output_filename, output_compression):
+    bufsize = _get_merge_bufsize(len(segments))
+    output_file = _RunWriter(
+        output_filename, compression=output_compression, bufsize=MAX_BUFSIZE,
+        )
+    try:
+      output_file.writelines(
+          merge(
+              [
+                  _read_ahead(
+                      _iter_segment(input, start, end, record_format, bufsize)
+                      )
+                  for (start, end) in segments
+                  ],
+              key,
+              )
+          )
+    finally:
+      output_file.close()
+
+  if len(segments) <= max_merge:
+    merge_segments(segments, output, None)
+    return
+
+  tempfiles = tempfile_generator(tempdirs)
+  filenames = []
+  try:
+    for i in range(0, len(segments), max_merge):
+      filename = tempfiles.next()
+      filenames.append(filename)
+      merge_segments(segments[i:i + max_merge], filename, compression)
+
+    merge_files(
+        filenames, output, key=key,
+        delete_inputs=True, max_merge=max_merge, tempfiles=tempfiles,
+        record_format=record_format,
+        input_compression=compression, compression=compression,
+        )
+  finally:
+    _try_delete_files(filenames)
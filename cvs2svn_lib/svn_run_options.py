@@ -339,6 +339,7 @@ A directory under \\fI%s\\fR (or the directory specified by
   def _get_extraction_options_group(self):
     group = RunOptions._get_extraction_options_group(self)
     self._add_use_internal_co_option(group)
+    self._add_internal_co_compression_option(group)
     self._add_use_cvs_option(group)
     self._add_use_rcs_option(group)
     return group
@@ -0,0 +1,191 @@
+#!/usr/bin/env python
+# (Be in -*- python -*- mode.)
+#
+# ====================================================================
+# Copyright (c) 2010 CollabNet.  All rights reserved.
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution.
+#
+# This software consists of voluntary contributions made by many
+# individuals.  For exact contribution history, see the revision
+# history and logs.
+# ====================================================================
+
+"""This program tests the IndexedDatabase class.
+
+When executed, this program conducts a number of unit tests of the
+IndexedDatabase class, in both its buffered and unbuffered modes."""
+
+import sys
+import os
+import shutil
+import unittest
+
+SRCPATH = os.path.normpath(os.path.join(os.path.dirname(__file__), '..', '..'))
+sys.path.insert(0, SRCPATH)
+
+from cvs2svn_lib.common import DB_OPEN_NEW
+from cvs2svn_lib.common import DB_OPEN_READ
+from cvs2svn_lib.common import DB_OPEN_WRITE
+from cvs2svn_lib.serializer import PrimedPickleSerializer
+from cvs2svn_lib.indexed_database import IndexedDatabase
+
+TMPDIR = os.path.join(SRCPATH, 'cvs2svn-tmp')
+
+
+class IndexedDatabaseTestCase(unittest.TestCase):
+  def __init__(self, name, buffered):
+    unittest.TestCase.__init__(self, name)
+    self.buffered = buffered
+
+  def __str__(self):
+    return '%s (buffered=%s)' % (self._testMethodName, self.buffered,)
+
+  def setUp(self):
+    self.dirname = os.path.join(
+        TMPDIR, 'indexed-database-%s-%s'
+        % (self._testMethodName, self.buffered,)
+        )
+    if os.path.exists(self.dirname):
+      shutil.rmtree(self.dirname)
+    os.makedirs(self.dirname)
+    self.filename = os.path.join(self.dirname, 'db.dat')
+    self.index_filename = os.path.join(self.dirname, 'db.idx')
+
+  def open_db(self, mode, **kw):
+    return IndexedDatabase(
+        self.filename, self.index_filename, mode,
+        serializer=PrimedPickleSerializer(()), buffered=self.buffered, **kw
+        )
+
+  def test_large_ints(self):
+    # cPickle writes ints of 2**31 or more using a text opcode, which
+    # raises UnpicklingError rather than EOFError if it is cut off at
+    # the end of a block.  Write enough such objects that many of them
+    # straddle block boundaries:
+    def make_item(i):
+      return (i, [2**40 + i * 7919 for j in range(i % 50)], 'x' * (i % 13))
+
+    db = self.open_db(DB_OPEN_NEW)
+    for i in range(3000):
+      db[i] = make_item(i)
+    db.close()
+
+    db = self.open_db(DB_OPEN_READ)
+    for i in range(3000):
+      self.assertEqual(db[i], make_item(i))
+    self.assertEqual(
+        sorted(db.get_many(range(3000))),
+        [(i, make_item(i)) for i in range(3000)],
+        )
+    db.close()
+
+  def check_contents(self, db, expected, count):
+    """Check that DB holds EXPECTED, a map {index : item}.
+
+    The indexes from 0 to COUNT that are not in EXPECTED should not be
+    defined."""
+
+    self.assertEqual(list(db.iterkeys()), sorted(expected.keys()))
+    for i in range(count):
+      if i in expected:
+        self.assertEqual(db[i], expected[i])
+      else:
+        self.assertRaises(KeyError, db.__getitem__, i)
+
+  def get_live_bytes(self, db, expected):
+    return sum([len(db.serializer.dumps(item)) for item in expected.values()])
+
+  def test_compaction(self):
+    # Small thresholds, so that closing the database compacts it:
+    db = self.open_db(
+        DB_OPEN_NEW, compact_min_dead_bytes=1000, compact_dead_fraction=0.25,
+        )
+    expected = {}
+    written = 0
+    for i in range(1000):
+      expected[i] = (i, 'a' * (i % 37))
+      db[i] = expected[i]
+      written += len(db.serializer.dumps(expected[i]))
+    for i in range(0, 1000, 3):
+      expected[i] = (i, 'b' * (i % 41))
+      db[i] = expected[i]
+      written += len(db.serializer.dumps(expected[i]))
+    for i in range(1, 1000, 5):
+      del expected[i]
+      del db[i]
+
+    live_bytes = self.get_live_bytes(db, expected)
+    self.assertEqual(db.get_space_usage(), (live_bytes, written - live_bytes))
+    self.check_contents(db, expected, 1000)
+    db.close()
+
+    self.assertFalse(os.path.exists(self.filename + '.compact'))
+    self.assertFalse(os.path.exists(self.index_filename + '.compact'))
+
+    # The space usage of a database that was not created by this
+    # instance is determined by reading its objects:
+    db = self.open_db(DB_OPEN_READ)
+    self.assertEqual(db.get_space_usage(), (live_bytes, 0))
+    self.check_contents(db, expected, 1000)
+    db.close()
+
+    # Compact a database that was opened for writing explicitly, and
+    # keep using it afterwards:
+    db = self.open_db(DB_OPEN_WRITE)
+    for i in range(0, 1000, 2):
+      expected[i] = (i, 'c' * (i % 43))
+      db[i] = expected[i]
+    live_bytes = self.get_live_bytes(db, expected)
+    self.assertEqual(db.get_space_usage()[0], live_bytes)
+    self.assertTrue(db.get_space_usage()[1] > 0)
+    db.compact()
+    self.assertEqual(db.get_space_usage(), (live_bytes, 0))
+    self.check_contents(db, expected, 1000)
+    for i in range(1000, 1100):
+      expected[i] = (i, 'd')
+      db[i] = expected[i]
+    self.check_contents(db, expected, 1100)
+    db.close()
+
+    db = self.open_db(DB_OPEN_READ)
+    self.assertEqual(
+        db.get_space_usage(), (self.get_live_bytes(db, expected), 0)
+        )
+    self.check_contents(db, expected, 1100)
+    db.close()
+
+  def test_no_compaction(self):
+    # A database with few dead objects is not compacted when it is
+    # closed:
+    db = self.open_db(
+        DB_OPEN_NEW, compact_min_dead_bytes=1000, compact_dead_fraction=0.25,
+        )
+    expected = {}
+    for i in range(1000):
+      expected[i] = (i, 'a' * (i % 37))
+      db[i] = expected[i]
+    del expected[0]
+    del db[0]
+    (live_bytes, dead_bytes) = db.get_space_usage()
+    self.assertTrue(0 < dead_bytes < 1000)
+    db.close()
+
+    db = self.open_db(DB_OPEN_READ)
+    self.assertEqual(db.get_space_usage(), (live_bytes, dead_bytes))
+    self.check_contents(db, expected, 1000)
+    db.close()
+
+  def tearDown(self):
+    shutil.rmtree(self.dirname)
+
+
+suite = unittest.TestSuite()
+
+for buffered in [False, True]:
+  for name in unittest.getTestCaseNames(IndexedDatabaseTestCase, 'test'):
+    suite.addTest(IndexedDatabaseTestCase(name, buffered))
+
+
+unittest.TextTestRunner(verbosity=2).run(suite)
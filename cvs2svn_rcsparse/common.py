@@ -21,7 +21,16 @@ class Sink:
 
   All these methods have stub implementations that do nothing, so you only
   have to override the callbacks that you care about.
+
+  A sink that does not need the contents of the revisions can set
+  NEEDS_TEXT to False.  Then the parser skips over the deltatext bodies
+  without building strings for them if the token stream supports it,
+  and the TEXT argument of set_revision_info() is the length of the
+  deltatext rather than the deltatext itself.
   """
+
+  needs_text = True
+
   def set_head_revision(self, revision):
     """Reports the head revision for this RCS file.
 
@@ -199,7 +208,8 @@ class Sink:
     LOG is a string containing the log message.  This may be multi-line.
     TEXT is the contents of the file in this revision, either as full-text or
     as a diff.  This is usually multi-line, and often quite large and/or
-    binary.
+    binary.  If the sink's NEEDS_TEXT attribute is False, TEXT is instead
+    the length of that string (so it is zero iff the deltatext is empty).
     """
     pass
 
@@ -434,18 +444,35 @@ class _Parser:
     self.ts.match('desc')
     self.sink.set_description(self.ts.get())
 
+  def _skip_text(self):
+    """Read the next token, which should be a deltatext; return its length.
+
+    This is used if the token stream cannot skip strings itself."""
+
+    text = self.ts.get()
+    if text is None:
+      return 0
+    return len(text)
+
   def parse_rcs_deltatext(self):
+    if getattr(self.sink, 'needs_text', True):
+      get_text = self.ts.get
+    else:
+      get_text = getattr(self.ts, 'skip_string', self._skip_text)
+
     while 1:
       revision = self.ts.get()
       if revision is None:
         # EOF
         break
-      text, sym2, log, sym1 = self.ts.mget(4)
+      sym1 = self.ts.get()
+      log = self.ts.get()
+      sym2 = self.ts.get()
       if sym1 != 'log':
-        print `text[:100], sym2[:100], log[:100], sym1[:100]`
         raise RCSExpected(sym1, 'log')
       if sym2 != 'text':
         raise RCSExpected(sym2, 'text')
+      text = get_text()
       ### need to add code to chew up "newphrase"
       self.sink.set_revision_info(revision, log, text)
 
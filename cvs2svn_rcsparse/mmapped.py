@@ -0,0 +1,184 @@
+# -*-python-*-
+#
+# Copyright (C) 1999-2014 The ViewCVS Group. All Rights Reserved.
+#
+# By using this file, you agree to the terms and conditions set forth in
+# the LICENSE.html file which can be found at the top level of the ViewVC
+# distribution or at http://viewvc.org/license-1.html.
+#
+# For more information, visit http://viewvc.org/
+#
+# -----------------------------------------------------------------------
+#
+# This file is not part of the upstream rcsparse distribution; it was
+# added for cvs2svn (see README.cvs2svn).
+#
+# -----------------------------------------------------------------------
+
+"""A token stream that scans a memory-mapped RCS file using regexps.
+
+The whole file is mapped into memory, so tokens never straddle a
+buffer boundary and each token can be returned as a single slice of
+the map.  Strings are un-doubled ('@@' -> '@') only if they actually
+contain a doubled '@'.  Strings that the sink does not need (see
+Sink.needs_text) are skipped without being extracted.  If the file
+cannot be mapped (for example, because it is not a regular file or
+because mapping it fails), its remaining contents are read into a
+string, which is scanned the same way.  The map is closed when parsing
+ends."""
+
+import os
+import re
+import stat
+import mmap
+
+import common
+
+
+class _TokenStream:
+  # Skip whitespace, then match a one-character token (';' or ':'), the
+  # start of a string ('@'), or any other token, which extends to the
+  # next whitespace, ';', or ':':
+  _token_re = re.compile(r'\s*([;:@]|[^\s;:@][^\s;:]*)')
+
+  def __init__(self, file):
+    self.buf = None
+    try:
+      fileno = file.fileno()
+      st = os.fstat(fileno)
+    except (AttributeError, EnvironmentError):
+      st = None
+
+    # Only regular files can be mapped; the size of other kinds of
+    # files (pipes, for example) is not known in advance:
+    if st is not None and stat.S_ISREG(st.st_mode) and st.st_size > 0:
+      try:
+        self.buf = mmap.mmap(fileno, st.st_size, access=mmap.ACCESS_READ)
+      except (EnvironmentError, ValueError, OverflowError):
+        pass
+      else:
+        self.idx = file.tell()
+
+    if self.buf is None:
+      self.buf = file.read()
+      self.idx = 0
+
+    if self.idx >= len(self.buf):
+      self.close()
+      raise RuntimeError, 'EOF'
+
+    # A token that was pushed back using unget(), or None:
+    self.pushed = None
+
+  def close(self):
+    "Release the map of the RCS file, if any."
+
+    if isinstance(self.buf, mmap.mmap):
+      self.buf.close()
+    self.buf = ''
+    self.idx = 0
+
+  def get(self):
+    "Get the next token from the RCS file."
+
+    if self.pushed is not None:
+      token = self.pushed
+      self.pushed = None
+      return token
+
+    m = self._token_re.match(self.buf, self.idx)
+    if m is None:
+      # Only whitespace (if anything) remains; signal EOF by returning
+      # None as the token:
+      self.idx = len(self.buf)
+      return None
+
+    token = m.group(1)
+    if token != '@':
+      self.idx = m.end()
+      return token
+
+    # A string, which starts with the "@" character:
+    start = m.end()
+    (end, doubled) = self._scan_string(start)
+    self.idx = end + 1
+    token = self.buf[start:end]
+    if doubled:
+      token = token.replace('@@', '@')
+    return token
+
+  def _scan_string(self, start):
+    """Find the end of the string whose contents begin at START.
+
+    Return (end, doubled), where END is the index of the "@" that
+    terminates the string and DOUBLED is the number of doubled "@@"
+    that it contains."""
+
+    buf = self.buf
+    idx = start
+    doubled = 0
+    while 1:
+      i = buf.find('@', idx)
+      if i == -1:
+        raise RuntimeError, 'EOF'
+      if buf[i + 1:i + 2] == '@':
+        doubled += 1
+        idx = i + 2
+        continue
+      return (i, doubled)
+
+  def skip_string(self):
+    """Skip over the next token, which should be a string.
+
+    Return the length that the string would have after un-doubling any
+    "@@", without extracting it from the file."""
+
+    if self.pushed is None:
+      m = self._token_re.match(self.buf, self.idx)
+      if m is not None and m.group(1) == '@':
+        start = m.end()
+        (end, doubled) = self._scan_string(start)
+        self.idx = end + 1
+        return end - start - doubled
+
+    # Not a string; let get() deal with whatever it is:
+    token = self.get()
+    if token is None:
+      return 0
+    return len(token)
+
+  def match(self, match):
+    "Try to match the next token from the input buffer."
+
+    token = self.get()
+    if token != match:
+      raise common.RCSExpected(token, match)
+
+  def unget(self, token):
+    "Put this token back, for the next get() to return."
+
+    self.pushed = token
+
+  def mget(self, count):
+    "Return multiple tokens. 'next' is at the end."
+    result = [ ]
+    for i in range(count):
+      result.append(self.get())
+    result.reverse()
+    return result
+
+
+class Parser(common._Parser):
+  def stream_class(self, file):
+    # Remember the token stream, so that parse() can close it:
+    self._stream = _TokenStream(file)
+    return self._stream
+
+  def parse(self, file, sink):
+    self._stream = None
+    try:
+      common._Parser.parse(self, file, sink)
+    finally:
+      if self._stream is not None:
+        self._stream.close()
+        self._stream = None
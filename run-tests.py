@@ -46,6 +46,7 @@ import locale
 import textwrap
 import calendar
 import types
+import cPickle
 try:
   from hashlib import md5
 except ImportError:
@@ -53,9 +54,9 @@ except ImportError:
 from difflib import Differ
 
 # Make sure that a supported version of Python is being used:
-if not (0x02040000 <= sys.hexversion < 0x03000000):
+if not (0x02060000 <= sys.hexversion < 0x03000000):
   sys.stderr.write(
-      'error: Python 2, version 2.4 or higher required.\n'
+      'error: Python 2, version 2.6 or higher required.\n'
       )
   sys.exit(1)
 
@@ -3116,6 +3117,95 @@ def options_option():
   conv = ensure_conversion('main', options_file='cvs2svn.options')
 
 
+@Cvs2SvnTestFunction
+def columnar_cvs_item_store():
+  "store the CVSItems in columns"
+
+  conv = ensure_conversion('main', options_file='cvs2svn.options')
+  conv_columnar = ensure_conversion(
+      'main', options_file='cvs2svn-columnar.options'
+      )
+
+  if conv_columnar.logs != conv.logs:
+    raise Failure()
+
+
+@Cvs2SvnTestFunction
+def struct_cvs_item_serializer():
+  "serialize the CVSItems with struct"
+
+  conv = ensure_conversion('main', options_file='cvs2svn.options')
+  conv_struct = ensure_conversion(
+      'main', options_file='cvs2svn-struct-serializer.options'
+      )
+
+  if conv_struct.logs != conv.logs:
+    raise Failure()
+
+
+@Cvs2SvnTestFunction
+def binary_sortable_cvs_items():
+  "sort the CVSItems in a binary format"
+
+  conv = ensure_conversion('main', options_file='cvs2svn.options')
+  conv_binary = ensure_conversion(
+      'main', options_file='cvs2svn-binary-sort.options'
+      )
+
+  if conv_binary.logs != conv.logs:
+    raise Failure()
+
+
+@Cvs2SvnTestFunction
+def presort_cvs_items():
+  "write the sortable CVSItems as sorted runs"
+
+  conv = ensure_conversion('main', options_file='cvs2svn.options')
+  conv_presort = ensure_conversion(
+      'main', options_file='cvs2svn-presort.options'
+      )
+
+  if conv_presort.logs != conv.logs:
+    raise Failure()
+
+
+@Cvs2SvnTestFunction
+def compact_changeset_graph():
+  "keep the changeset graph in compact arrays"
+
+  conv = ensure_conversion('main', options_file='cvs2svn.options')
+  conv_compact = ensure_conversion(
+      'main', options_file='cvs2svn-compact-graph.options'
+      )
+
+  if conv_compact.logs != conv.logs:
+    raise Failure()
+
+
+@Cvs2SvnTestFunction
+def scc_cycle_breaking():
+  "break changeset cycles by SCC"
+
+  conv = ensure_conversion('main', options_file='cvs2svn.options')
+  conv_scc = ensure_conversion('main', options_file='cvs2svn-scc.options')
+
+  if conv_scc.logs != conv.logs:
+    raise Failure()
+
+
+@Cvs2SvnTestFunction
+def cvs_item_to_changeset_overlay():
+  "store CVSItem-changeset tables as overlays"
+
+  conv = ensure_conversion('main', options_file='cvs2svn.options')
+  conv_overlay = ensure_conversion(
+      'main', options_file='cvs2svn-overlay.options'
+      )
+
+  if conv_overlay.logs != conv.logs:
+    raise Failure()
+
+
 @Cvs2SvnTestFunction
 def multiproject():
   "multiproject conversion"
@@ -4071,6 +4161,158 @@ def vendor_1_1_not_root():
       )
 
 
+@Cvs2SvnTestFunction
+def parallel_collect_revs():
+  "parse the repository using several jobs"
+
+  conv = ensure_conversion('main')
+  conv_jobs = ensure_conversion('main', args=['--jobs=3'])
+
+  if conv_jobs.logs != conv.logs:
+    raise Failure()
+
+
+@Cvs2SvnTestFunction
+def walk_threads():
+  "walk the repository using several threads"
+
+  conv = ensure_conversion('main')
+  conv_threads = ensure_conversion('main', args=['--walk-threads=3'])
+
+  if conv_threads.logs != conv.logs:
+    raise Failure()
+
+
+@Cvs2SvnTestFunction
+def sort_jobs():
+  "sort the intermediate files using several jobs"
+
+  conv = ensure_conversion('main')
+  conv_jobs = ensure_conversion(
+      'main', args=['--sort-memory=0', '--sort-jobs=3']
+      )
+
+  if conv_jobs.logs != conv.logs:
+    raise Failure()
+
+
+@Cvs2SvnTestFunction
+def sort_compression():
+  "compress and spread the temporary sort files"
+
+  conv = ensure_conversion('main')
+  conv_compressed = ensure_conversion(
+      'main',
+      args=[
+          '--sort-memory=0', '--sort-compression=zlib:1',
+          '--sort-tmpdir=%s' % (tmp_dir,), '--sort-jobs=2',
+          ],
+      )
+
+  if conv_compressed.logs != conv.logs:
+    raise Failure()
+
+
+@Cvs2SvnTestFunction
+def cycle_breaking_jobs():
+  "break changeset cycles using several jobs"
+
+  conv = ensure_conversion('preferred-parent-cycle')
+  conv_jobs = ensure_conversion(
+      'preferred-parent-cycle', args=['--cycle-breaking-jobs=3']
+      )
+  # The components of this repository are too small to be handed to
+  # the workers by default, so also lower the threshold:
+  conv_workers = ensure_conversion(
+      'preferred-parent-cycle',
+      options_file='cvs2svn-cycle-breaking-jobs.options',
+      )
+
+  if conv_jobs.logs != conv.logs or conv_workers.logs != conv.logs:
+    raise Failure()
+
+
+def read_parse_cache(cache_dir):
+  """Return (generation, entries) describing the parse cache in CACHE_DIR.
+
+  GENERATION is the number of the last conversion that used the
+  cache.  ENTRIES is a map { path : (generation, inode) } with one
+  item for each entry file in the cache, where GENERATION is the
+  number of the last conversion that used the entry and INODE is the
+  inode number of the entry file (which changes whenever the entry is
+  rewritten)."""
+
+  f = open(os.path.join(cache_dir, 'index.pck'), 'rb')
+  try:
+    (fingerprint, generation, index) = cPickle.load(f)
+  finally:
+    f.close()
+
+  entries = {}
+  for (key, (size, entry_generation)) in index.items():
+    path = os.path.join(cache_dir, key[:2], key[2:])
+    entries[path] = (entry_generation, os.stat(path).st_ino)
+  return (generation, entries)
+
+
+@Cvs2SvnTestFunction
+def parse_cache():
+  "reuse the parse results of an earlier conversion"
+
+  conv = ensure_conversion('main')
+  for args in [[], ['--parse-cache-checksums']]:
+    cache_dir = os.path.join(tmp_dir, 'main-parse-cache')
+    if os.path.exists(cache_dir):
+      safe_rmtree(cache_dir)
+    args = args + ['--parse-cache=%s' % (cache_dir,)]
+
+    # The first conversion fills the cache:
+    conv_fill = ensure_conversion('main', args=args)
+    (generation, entries) = read_parse_cache(cache_dir)
+    if generation != 1 or not entries:
+      raise Failure()
+
+    # The second one takes the results of every file from the cache,
+    # so it marks each entry as used without rewriting any of them:
+    conv_reuse = ensure_conversion('main', args=args + ['--jobs=2'])
+    (generation, reused_entries) = read_parse_cache(cache_dir)
+    if generation != 2:
+      raise Failure()
+    for (path, (entry_generation, inode)) in entries.items():
+      if reused_entries.get(path) != (2, inode):
+        raise Failure()
+
+    if conv_fill.logs != conv.logs or conv_reuse.logs != conv.logs:
+      raise Failure()
+
+
+@Cvs2SvnTestFunction
+def internal_co_compression():
+  "compress internal co databases with other codecs"
+
+  conv = ensure_conversion('internal-co', args=['--default-eol=native'])
+  for spec in ['zlib:1', 'bz2', 'none']:
+    conv_spec = ensure_conversion(
+        'internal-co',
+        args=['--default-eol=native', '--internal-co-compression=%s' % spec],
+        )
+    if conv_spec.logs != conv.logs:
+      raise Failure()
+
+
+@Cvs2SvnTestFunction
+def internal_co_dictionaries():
+  "compress RCS deltas using per-file dictionaries"
+
+  conv = ensure_conversion('internal-co', args=['--default-eol=native'])
+  conv_dictionaries = ensure_conversion(
+      'internal-co',
+      args=['--default-eol=native', '--internal-co-dictionaries'],
+      )
+  if conv_dictionaries.logs != conv.logs:
+    raise Failure()
+
+
 ########################################################################
 # Run the tests
 
@@ -4290,6 +4532,21 @@ test_list = [
     missing_vendor_branch,
     newphrases,
     vendor_1_1_not_root,
+    parallel_collect_revs,
+    parse_cache,
+    walk_threads,
+    columnar_cvs_item_store,
+    struct_cvs_item_serializer,
+    binary_sortable_cvs_items,
+    internal_co_compression,
+    internal_co_dictionaries,
+    sort_jobs,
+    sort_compression,
+    cycle_breaking_jobs,
+    presort_cvs_items,
+    compact_changeset_graph,
+    scc_cycle_breaking,
+    cvs_item_to_changeset_overlay,
     ]
 
 if __name__ == '__main__':